@@ -6,23 +6,20 @@ from flask import Flask
 from werkzeug.middleware.proxy_fix import ProxyFix
 from config import Config
 
-# Configure logging
-if not os.path.exists('logs'):
-    os.makedirs('logs')
+# Configure logging to file (unless LOG_FILE is empty) and console
+handlers = [logging.StreamHandler(sys.stdout)] # Add StreamHandler to output logs to console
+if Config.LOG_FILE:
+    log_dir = os.path.dirname(Config.LOG_FILE)
+    if log_dir and not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    handlers.insert(0, RotatingFileHandler(Config.LOG_FILE, maxBytes=10000000, backupCount=10))
 
-# Configure logging to file and console
 logging.basicConfig(
-    handlers=[
-        RotatingFileHandler('logs/app.log', maxBytes=10000000, backupCount=10),
-        logging.StreamHandler(sys.stdout) # Add StreamHandler to output logs to console
-    ],
-    level=logging.DEBUG, # Set to DEBUG for more detailed logging
+    handlers=handlers,
+    level=getattr(logging, Config.LOG_LEVEL, logging.INFO), # LOG_LEVEL=DEBUG for detailed logging
     format='%(asctime)s %(levelname)s %(name)s %(message)s'
 )
 
-# Set Werkzeug logger to DEBUG as well for detailed request/response info
-logging.getLogger('werkzeug').setLevel(logging.DEBUG)
-
 def create_app():
     app = Flask(__name__)
     app.config.from_object(Config)
@@ -43,10 +40,33 @@ def create_app():
 
     from blueprints.api import api_bp
     from blueprints.ui import ui_bp
+    from blueprints.metrics import metrics_bp
 
     # Register blueprints. Flask will handle the APPLICATION_ROOT prefix automatically.
     app.register_blueprint(api_bp, url_prefix='/api')
     app.register_blueprint(ui_bp, url_prefix='/')
+    app.register_blueprint(metrics_bp, url_prefix='/')
+
+    from services.metrics import Metrics
+    Metrics.init_app(app)
+
+    from cli import register_commands
+    register_commands(app)
+
+    from services.backends import StorageBackend
+    StorageBackend.init_app(app)
+
+    from services.bulk import BulkService
+    BulkService.init_app(app)
+
+    from services.thumb_queue import ThumbnailWorker
+    ThumbnailWorker.init_app(app)
+
+    from services.replication import ReplicationWorker
+    ReplicationWorker.init_app(app)
+
+    from services.watcher import FolderWatcher
+    FolderWatcher.init_app(app)
 
     return app
 
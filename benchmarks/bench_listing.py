@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for folder listings.
+
+Builds a synthetic folder (originals + sidecar JSON + .thumbs/) and compares
+the filesystem calls and wall time of:
+
+  legacy   - the original os.listdir loop (isfile, stat, exists thumb, exists json, open)
+  scandir  - services.scanner.scan_directory
+  index    - IndexService.list_folder (SQLite, no filesystem access per file)
+
+Syscalls are counted by instrumenting os.stat/os.listdir/os.scandir/open and
+DirEntry.stat, which is what the listing code paths go through.
+
+Usage: python benchmarks/bench_listing.py [--files 10000]
+"""
+import argparse
+import builtins
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import Flask  # noqa: E402
+from services import scanner  # noqa: E402
+from services.index import IndexService  # noqa: E402
+
+
+def build_folder(root, count):
+    folder = os.path.join(root, 'bench')
+    os.makedirs(os.path.join(folder, '.thumbs'))
+    for i in range(count):
+        name = f'IMG_{i:05d}'
+        with open(os.path.join(folder, name + '.jpg'), 'wb') as f:
+            f.write(b'\xff\xd8' + b'0' * 64)
+        with open(os.path.join(folder, name + '.json'), 'w') as f:
+            json.dump({'display_name': name, 'upload_date': datetime.now().isoformat(),
+                       'mimetype': 'image/jpeg'}, f)
+        if i % 10:  # Leave some originals without a thumbnail
+            with open(os.path.join(folder, '.thumbs', name + '.jpg'), 'wb') as f:
+                f.write(b'\xff\xd8')
+    return folder
+
+
+def legacy_list(full_path, path):
+    """The per-entry loop StorageService.list_files used before the scanner/index."""
+    files = []
+    for item in os.listdir(full_path):
+        if item.startswith('.') or item.endswith('.json'):
+            continue
+        item_path = os.path.join(full_path, item)
+        relative_path = os.path.join(path, item)
+        if os.path.isfile(item_path):
+            stats = os.stat(item_path)
+            thumb_name = Path(item).stem + '.jpg'
+            thumb_url = None
+            if os.path.exists(os.path.join(full_path, '.thumbs', thumb_name)):
+                thumb_url = os.path.join(path, '.thumbs', thumb_name)
+            metadata = {}
+            json_path = os.path.join(full_path, Path(item).stem + '.json')
+            if os.path.exists(json_path):
+                with open(json_path, 'r') as f:
+                    metadata = json.load(f)
+            files.append({'name': item, 'path': relative_path, 'size': stats.st_size, 'thumb': thumb_url,
+                          'display_name': metadata.get('display_name', Path(item).stem)})
+        elif os.path.isdir(item_path):
+            files.append({'name': item, 'path': relative_path, 'type': 'directory'})
+    return files
+
+
+class _CountingEntry:
+    def __init__(self, entry, counter):
+        self._entry = entry
+        self._counter = counter
+
+    def stat(self, **kwargs):
+        self._counter['stat'] += 1
+        return self._entry.stat(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._entry, name)
+
+
+class _CountingScandir:
+    def __init__(self, iterator, counter):
+        self._iterator = iterator
+        self._counter = counter
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._iterator.close()
+
+    def __iter__(self):
+        for entry in self._iterator:
+            yield _CountingEntry(entry, self._counter)
+
+
+class SyscallCounter:
+    """Context manager that counts stat/listdir/scandir/open calls."""
+
+    def __enter__(self):
+        self.counts = Counter()
+        self._orig = (os.stat, os.listdir, os.scandir, builtins.open)
+        orig_stat, orig_listdir, orig_scandir, orig_open = self._orig
+        counts = self.counts
+
+        def stat(*args, **kwargs):
+            counts['stat'] += 1
+            return orig_stat(*args, **kwargs)
+
+        def listdir(*args, **kwargs):
+            counts['readdir'] += 1
+            return orig_listdir(*args, **kwargs)
+
+        def scandir(*args, **kwargs):
+            counts['readdir'] += 1
+            return _CountingScandir(orig_scandir(*args, **kwargs), counts)
+
+        def open_(*args, **kwargs):
+            counts['open'] += 1
+            return orig_open(*args, **kwargs)
+
+        os.stat, os.listdir, os.scandir, builtins.open = stat, listdir, scandir, open_
+        return self.counts
+
+    def __exit__(self, *exc):
+        os.stat, os.listdir, os.scandir, builtins.open = self._orig
+
+
+def measure(label, func, repeat):
+    with SyscallCounter() as counts:
+        func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.perf_counter() - start) / repeat
+    total = sum(counts.values())
+    print(f"{label:<8} {counts['readdir']:>8} {counts['stat']:>8} {counts['open']:>8} {total:>8} {elapsed * 1000:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        folder = build_folder(root, args.files)
+        app = Flask(__name__)
+        app.config.update(UPLOAD_FOLDER=root, METADATA_INDEX=True, INDEX_PATH=None)
+
+        print(f"{args.files} files in {folder}")
+        print(f"{'engine':<8} {'readdir':>8} {'stat':>8} {'open':>8} {'total':>8} {'ms/list':>10}")
+        measure('legacy', lambda: legacy_list(folder, 'bench'), args.repeat)
+        measure('scandir', lambda: scanner.scan_directory(folder, 'bench'), args.repeat)
+        with app.app_context():
+            IndexService.connect()  # Build the index outside of the measurement
+            measure('index', lambda: IndexService.list_folder('bench'), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for collision handling when saving an already taken file name.
+
+Fills a folder with IMG.jpg, IMG-1.jpg ... IMG-<N-1>.jpg (indexed) and then
+names --uploads more "IMG.jpg" uploads with:
+
+  legacy   - the old get_unique_filename loop (os.path.exists on name-1, name-2, ...)
+  counter  - services.naming.NamingService.reserve (O_EXCL + per-folder counter)
+
+stat counts come from instrumenting os.stat (os.path.exists goes through it).
+
+Usage: python benchmarks/bench_naming.py [--files 5000] [--uploads 200]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import Flask  # noqa: E402
+from services.index import IndexService  # noqa: E402
+from services.naming import NamingService  # noqa: E402
+
+
+def legacy_unique_filename(directory, filename):
+    """The probing loop StorageService.get_unique_filename used before NamingService."""
+    if not os.path.exists(os.path.join(directory, filename)):
+        return filename
+    name, ext = os.path.splitext(filename)
+    counter = 1
+    while os.path.exists(os.path.join(directory, f"{name}-{counter}{ext}")):
+        counter += 1
+    return f"{name}-{counter}{ext}"
+
+
+def build_folder(root, folder, count):
+    full = os.path.join(root, folder)
+    os.makedirs(full)
+    for i in range(count):
+        open(os.path.join(full, 'IMG.jpg' if i == 0 else f'IMG-{i}.jpg'), 'wb').close()
+    return full
+
+
+def measure(label, func, uploads):
+    stats = [0]
+    orig_stat = os.stat
+
+    def stat(*args, **kwargs):
+        stats[0] += 1
+        return orig_stat(*args, **kwargs)
+
+    os.stat = stat
+    try:
+        start = time.perf_counter()
+        for _ in range(uploads):
+            func()
+        elapsed = time.perf_counter() - start
+    finally:
+        os.stat = orig_stat
+    print(f"{label:<8} {stats[0] / uploads:>10.1f} {elapsed / uploads * 1000:>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=5000)
+    parser.add_argument('--uploads', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        app = Flask(__name__)
+        app.config.update(UPLOAD_FOLDER=root, METADATA_INDEX=True, INDEX_PATH=None)
+        print(f"{args.files} existing IMG*.jpg, {args.uploads} more uploads of IMG.jpg")
+        print(f"{'engine':<8} {'stat/name':>10} {'ms/name':>10}")
+
+        legacy_dir = build_folder(root, 'legacy', args.files)
+
+        def legacy():
+            name = legacy_unique_filename(legacy_dir, 'IMG.jpg')
+            open(os.path.join(legacy_dir, name), 'wb').close()
+
+        measure('legacy', legacy, args.uploads)
+
+        counter_dir = build_folder(root, 'counter', args.files)
+        with app.app_context():
+            IndexService.connect()  # Build the index outside of the measurement
+            measure('counter', lambda: NamingService.reserve(counter_dir, 'counter', 'IMG.jpg'), args.uploads)
+
+
+if __name__ == '__main__':
+    main()
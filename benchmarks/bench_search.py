@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for IndexService.search.
+
+Fills an index with --files synthetic rows spread over nested folders (no
+files on disk; the index is all search reads) and times typical queries:
+a word, a word prefix, a folder subtree, a date range, a size/type filter,
+a combination of them, and the second page of a broad query.
+
+Usage: python benchmarks/bench_search.py [--files 500000] [--runs 20]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import Flask  # noqa: E402
+from services.index import IndexService  # noqa: E402
+
+WORDS = ['urlaub', 'strand', 'berg', 'hochzeit', 'geburtstag', 'büro', 'team', 'produkt',
+         'logo', 'banner', 'winter', 'sommer', 'garten', 'küche', 'auto', 'hund', 'katze']
+MIMETYPES = ['image/jpeg', 'image/png', 'image/webp', 'image/gif']
+
+
+def build_index(count):
+    rng = random.Random(42)
+    start = datetime(2020, 1, 1)
+    step = timedelta(days=5 * 365) / count  # Five years of uploads, whatever the count
+    records = []
+    for i in range(count):
+        folder = f"kunden/k{i % 50:02d}/{2020 + i % 5}"
+        words = rng.sample(WORDS, 2)
+        name = f"{words[0]}_{words[1]}_{i:06d}.jpg"
+        records.append({
+            'path': f"{folder}/{name}", 'folder': folder, 'name': name,
+            'size': rng.randint(10_000, 10_000_000), 'mtime': 0, 'thumb': None,
+            'thumb_status': 'ready', 'display_name': f"{words[0].title()} {words[1].title()} {i}",
+            'original_name': f"DSC{i:06d}.JPG",
+            'upload_date': (start + i * step).isoformat(),
+            'mimetype': MIMETYPES[i % len(MIMETYPES)], 'sha256': None,
+        })
+    IndexService.upsert_files(records)
+
+
+def measure(label, runs, **criteria):
+    IndexService.search(**criteria)  # Warm the page cache
+    start = time.perf_counter()
+    for _ in range(runs):
+        page = IndexService.search(**criteria)
+    elapsed = (time.perf_counter() - start) / runs
+    print(f"{label:<24} {len(page['items']):>6} {elapsed * 1000:>10.2f}")
+    return page
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=500_000)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        app = Flask(__name__)
+        app.config.update(UPLOAD_FOLDER=root, METADATA_INDEX=True, INDEX_PATH=None)
+        with app.app_context():
+            start = time.perf_counter()
+            build_index(args.files)
+            print(f"Indexed {args.files} rows in {time.perf_counter() - start:.1f}s")
+            print(f"{'query':<24} {'items':>6} {'ms/query':>10}")
+
+            measure('word', args.runs, query='hochzeit')
+            measure('prefix', args.runs, query='geburt')
+            measure('umlaut folded', args.runs, query='kuche')
+            measure('folder subtree', args.runs, folder='kunden/k07')
+            measure('date range', args.runs, date_from='2021-03-01', date_to='2021-03-08')
+            measure('size + type', args.runs, min_size=9_900_000, mimetypes=['image/png'])
+            measure('word + folder + date', args.runs, query='strand', folder='kunden/k03',
+                    date_from='2021-01-01', date_to='2022-01-01')
+            first = IndexService.search(query='team')
+            measure('word, page 2', args.runs, query='team', cursor=first['next_cursor'])
+
+
+if __name__ == '__main__':
+    main()
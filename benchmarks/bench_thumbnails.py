@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Benchmark thumbnail generation: time and peak RSS of the original decode path
+(convert to RGB at full size, then thumbnail) against
+ThumbnailService.generate_thumbnail (draft/reduce first, convert afterwards).
+
+One synthetic image per type in Config.ALLOWED_TYPES is generated; every
+measurement runs in a fresh process so peak RSS is not shared between runs.
+
+Usage: python benchmarks/bench_thumbnails.py [--megapixels 24] [--repeat 3]
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from PIL import Image  # noqa: E402
+from config import Config  # noqa: E402
+
+# (Pillow format, extension, image mode) variants per mimetype
+FORMATS = {
+    'image/jpeg': [('JPEG', 'jpg', 'RGB'), ('JPEG', 'jpg', 'L'), ('JPEG', 'jpg', 'CMYK')],
+    'image/png': [('PNG', 'png', 'RGB'), ('PNG', 'png', 'RGBA')],
+    'image/gif': [('GIF', 'gif', 'P')],
+    'image/webp': [('WEBP', 'webp', 'RGB')],
+}
+
+
+def make_image(directory, fmt, ext, mode, megapixels):
+    width = int((megapixels * 1e6 * 1.5) ** 0.5)
+    height = int(width / 1.5)
+    noise = Image.effect_noise((width, height), 48)
+    gradient = Image.linear_gradient('L').resize((width, height))
+    img = Image.merge('RGB', (noise, gradient, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    if mode == 'RGBA':
+        img.putalpha(gradient)
+    elif mode == 'P':
+        img = img.quantize(64)
+    elif mode != 'RGB':
+        img = img.convert(mode)
+    path = os.path.join(directory, f'sample-{mode}.{ext}')
+    img.save(path, fmt)
+    return path
+
+
+def legacy_thumbnail(original_path, thumbnail_path, size):
+    """Decode path of ThumbnailService.generate_thumbnail before draft/reduce."""
+    with Image.open(original_path) as img:
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.thumbnail(size, Image.Resampling.LANCZOS)
+        img.save(thumbnail_path, 'JPEG', optimize=True, quality=85)
+        if os.path.getsize(thumbnail_path) > 30 * 1024:
+            img.save(thumbnail_path, 'JPEG', optimize=True, quality=60)
+    return True
+
+
+def _peak_rss_kib(reset=False):
+    """Peak RSS in KiB. On Linux VmHWM is reset via clear_refs, because
+    ru_maxrss is inherited from the (large) parent across fork/exec."""
+    try:
+        if reset:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run(engine, original_path, thumbnail_path, size, queue):
+    if engine == 'legacy':
+        func = legacy_thumbnail
+    else:
+        from services.thumbs import ThumbnailService
+        encoding = {'format': 'JPEG', 'max_bytes': 30 * 1024,
+                    'quality_min': Config.THUMBNAIL_QUALITY_MIN, 'quality_max': Config.THUMBNAIL_QUALITY_MAX}
+
+        def func(original, thumb, size):
+            return ThumbnailService.generate_thumbnail(original, thumb, size, encoding)
+    baseline = _peak_rss_kib(reset=True)
+    start = time.perf_counter()
+    func(original_path, thumbnail_path, size)
+    elapsed = time.perf_counter() - start
+    queue.put((elapsed, max(0, _peak_rss_kib() - baseline)))
+
+
+def measure(engine, original_path, thumbnail_path, size, repeat):
+    ctx = multiprocessing.get_context('spawn')
+    times, peaks = [], []
+    for _ in range(repeat):
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_run, args=(engine, original_path, thumbnail_path, size, queue))
+        proc.start()
+        elapsed, peak = queue.get()
+        proc.join()
+        times.append(elapsed)
+        peaks.append(peak)
+    return min(times), max(peaks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--megapixels', type=float, default=24)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        thumb = os.path.join(directory, 'thumb.jpg')
+        print(f"{args.megapixels:g} MP originals, thumbnail {Config.THUMBNAIL_SIZE}")
+        print(f"{'type':<18} {'legacy ms':>10} {'new ms':>10} {'legacy MB':>10} {'new MB':>10}")
+        for mimetype in Config.ALLOWED_TYPES:
+            for fmt, ext, mode in FORMATS.get(mimetype, []):
+                original = make_image(directory, fmt, ext, mode, args.megapixels)
+                legacy = measure('legacy', original, thumb, Config.THUMBNAIL_SIZE, args.repeat)
+                new = measure('new', original, thumb, Config.THUMBNAIL_SIZE, args.repeat)
+                label = f"{mimetype} {mode}"
+                print(f"{label:<18} {legacy[0] * 1000:>10.0f} {new[0] * 1000:>10.0f} "
+                      f"{legacy[1] / 1024:>10.1f} {new[1] / 1024:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
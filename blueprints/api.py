@@ -1,12 +1,17 @@
 
-from flask import Blueprint, request, jsonify, current_app, send_file
+from flask import Blueprint, request, jsonify, current_app, send_file, stream_with_context
+from werkzeug.datastructures import ContentRange
 from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 from services.storage import StorageService
-from services.thumbs import ThumbnailService
+from services.thumb_queue import ThumbnailQueue
+from services.uploads import UploadSessionService
+from services.bulk import BulkService
+from services.export import ExportService
 import os
 import logging
 from pathlib import Path
+from urllib.parse import quote
 from services.storage import StorageService # Import StorageService
 
 logger = logging.getLogger(__name__)
@@ -36,23 +41,167 @@ def upload_file():
         # Save file
         original_filename = file.filename
         result = StorageService.save_file(file, folder, original_filename)
-        current_app.logger.info(f"File saved, result: {result}")
+        current_app.logger.debug(f"File saved, result: {result}")
         
-        # Generate thumbnail
+        return jsonify(_schedule_thumbnail(result)), 200
+
+    except RequestEntityTooLarge:
+        current_app.logger.error("Upload error: File too large")
+        return jsonify({'error': 'File too large'}), 413
+    except Exception as e:
+        current_app.logger.error(f"Upload error: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+def _schedule_thumbnail(result):
+    """Queue thumbnail generation (runs inline when THUMBNAIL_WORKERS is 0)"""
+    try:
+        result['thumb_status'] = ThumbnailQueue.submit(result['path'])
+    except Exception as e:
+        logger.warning(f"Failed to schedule thumbnail: {e}")
+        result['thumb_status'] = 'failed'
+    return result
+
+@api_bp.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """Several files (multipart field ``files``) into one folder in one request.
+
+    Responds 200 when every file was stored, 207 on partial success and 400
+    when none was; ``results`` has one entry per file in request order.
+    """
+    try:
+        # The body holds the whole batch; each file is still limited to MAX_SIZE_MB
+        request.max_content_length = current_app.config['BATCH_UPLOAD_MAX_MB'] * 1024 * 1024
+        files = request.files.getlist('files')
+        if not files:
+            return jsonify({'error': 'No files provided'}), 400
+
+        folder = request.form.get('folder', '').strip()
+        if not folder:
+            return jsonify({'error': 'Folder path not provided'}), 400
+
+        max_size = current_app.config['MAX_CONTENT_LENGTH']
+        results = [None] * len(files)
+        accepted = []
+        for i, file in enumerate(files):
+            file.stream.seek(0, os.SEEK_END)
+            size = file.stream.tell()
+            file.stream.seek(0)
+            if not StorageService.is_allowed_file(file.mimetype):
+                results[i] = {'error': 'File type not allowed', 'original_name': file.filename}
+            elif max_size and size > max_size:
+                results[i] = {'error': 'File too large', 'original_name': file.filename}
+            else:
+                accepted.append(i)
+
+        saved = StorageService.save_batch([files[i] for i in accepted], folder) if accepted else []
+        for i, result in zip(accepted, saved):
+            results[i] = result
+
+        stored = [result['path'] for result in results if 'error' not in result]
         try:
-            # Ensure the correct path is passed for thumbnail generation
-            full_file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], result['path'])
-            ThumbnailService.process_uploaded_image(full_file_path)
+            statuses = ThumbnailQueue.submit_many(stored)
         except Exception as e:
-            logger.warning(f"Failed to create thumbnail: {e}")
+            logger.warning(f"Failed to schedule thumbnails: {e}")
+            statuses = {path: 'failed' for path in stored}
+        for result in results:
+            if 'error' not in result:
+                result['thumb_status'] = statuses[result['path']]
+
+        failed = len(results) - len(stored)
+        current_app.logger.info(f"Batch upload: {len(stored)} stored, {failed} failed")
+        status = 200 if not failed else (207 if stored else 400)
+        return jsonify({'results': results, 'stored': len(stored), 'failed': failed}), status
+
+    except RequestEntityTooLarge:
+        current_app.logger.error("Batch upload error: Request too large")
+        return jsonify({'error': 'Request too large'}), 413
+    except ValueError as e:
+        current_app.logger.error(f"Batch upload error: {str(e)}")
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        current_app.logger.error(f"Batch upload error: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
 
+@api_bp.route('/uploads', methods=['POST'])
+def create_upload_session():
+    """Start a chunked upload: {filename, folder, size, mimetype, sha256?}"""
+    try:
+        data = request.get_json(silent=True) or {}
+        folder = (data.get('folder') or '').strip()
+        if not folder:
+            return jsonify({'error': 'Folder path not provided'}), 400
+        session = UploadSessionService.create(
+            data.get('filename'),
+            '' if folder == '.' else folder.strip('/'),
+            data.get('size'),
+            data.get('mimetype'),
+            data.get('sha256')
+        )
+        return jsonify(session), 201
+
+    except ValueError as e:
+        current_app.logger.error(f"Create upload session error: {str(e)}")
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        current_app.logger.error(f"Create upload session error: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+@api_bp.route('/uploads/<session_id>', methods=['GET'])
+def get_upload_session(session_id):
+    """Session state; ``received`` lists the acknowledged chunks for resuming"""
+    try:
+        return jsonify(UploadSessionService.get(session_id)), 200
+    except FileNotFoundError:
+        return jsonify({'error': 'Upload session not found'}), 404
+    except Exception as e:
+        current_app.logger.error(f"Get upload session error: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+@api_bp.route('/uploads/<session_id>/chunks/<int:number>', methods=['PUT'])
+def put_upload_chunk(session_id, number):
+    """Raw chunk body, optionally verified against the X-Chunk-SHA256 header"""
+    try:
+        result = UploadSessionService.write_chunk(
+            session_id, number, request.stream, request.headers.get('X-Chunk-SHA256'))
         return jsonify(result), 200
 
     except RequestEntityTooLarge:
-        current_app.logger.error("Upload error: File too large")
-        return jsonify({'error': 'File too large'}), 413
+        current_app.logger.error("Upload chunk error: Chunk too large")
+        return jsonify({'error': 'Chunk too large'}), 413
+    except FileNotFoundError:
+        return jsonify({'error': 'Upload session not found'}), 404
+    except ValueError as e:
+        current_app.logger.error(f"Upload chunk error: {str(e)}")
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        current_app.logger.error(f"Upload error: {str(e)}", exc_info=True)
+        current_app.logger.error(f"Upload chunk error: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+@api_bp.route('/uploads/<session_id>/commit', methods=['POST'])
+def commit_upload_session(session_id):
+    """Assemble the upload; responds like /api/upload"""
+    try:
+        result = UploadSessionService.commit(session_id)
+        return jsonify(_schedule_thumbnail(result)), 200
+
+    except FileNotFoundError:
+        return jsonify({'error': 'Upload session not found'}), 404
+    except ValueError as e:
+        current_app.logger.error(f"Commit upload error: {str(e)}")
+        return jsonify({'error': str(e)}), 409
+    except Exception as e:
+        current_app.logger.error(f"Commit upload error: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+@api_bp.route('/uploads/<session_id>', methods=['DELETE'])
+def abort_upload_session(session_id):
+    try:
+        UploadSessionService.abort(session_id)
+        return jsonify({'message': 'Upload session aborted'}), 200
+    except FileNotFoundError:
+        return jsonify({'error': 'Upload session not found'}), 404
+    except Exception as e:
+        current_app.logger.error(f"Abort upload session error: {str(e)}", exc_info=True)
         return jsonify({'error': str(e)}), 500
 
 @api_bp.route('/file/rename', methods=['POST'])
@@ -100,27 +249,68 @@ def delete_file():
         current_app.logger.error(f"Delete file error: {str(e)}", exc_info=True)
         return jsonify({'error': str(e)}), 500
 
+@api_bp.route('/bulk', methods=['POST'])
+def bulk_operations():
+    """Delete, move and rename many files/folders in one request.
+
+    Body: ``{"operations": [{"op": "delete", "path": ...},
+    {"op": "move", "path": ..., "to": <folder>}, {"op": "rename", "path": ..., "name": ...}]}``.
+    Responds 200 when every operation succeeded, 207 on partial success and
+    400 when none did; ``results`` has one entry per operation in request order.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        results = BulkService.apply(data.get('operations'))
+        succeeded = sum(result['status'] == 'ok' for result in results)
+        failed = len(results) - succeeded
+        status = 200 if not failed else (207 if succeeded else 400)
+        return jsonify({'results': results, 'succeeded': succeeded, 'failed': failed}), status
+
+    except ValueError as e:
+        current_app.logger.error(f"Bulk operations error: {str(e)}")
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        current_app.logger.error(f"Bulk operations error: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
 @api_bp.route('/list', methods=['GET'])
 def list_files():
     try:
         path = request.args.get('path', '').strip()
-        current_app.logger.info(f"API /list called with path: '{path}'")
+        current_app.logger.debug(f"API /list called with path: '{path}'")
         
         # Security check
         if '..' in path or path.startswith('/'):
             current_app.logger.warning(f"Invalid path attempted: '{path}'")
             return jsonify({'error': 'Invalid path'}), 400
 
-        # Use StorageService to list files
-        files_data = StorageService.list_files(path)
-        
-        current_app.logger.info(f"Files returned by list_files: {files_data}")
-        
-        # Sort: directories first, then files
-        files_data.sort(key=lambda x: (x['type'] == 'file', x['name'].lower()))
-        
-        return jsonify(files_data), 200
+        # Without limit/cursor the whole folder is returned as a plain array (legacy format)
+        if 'limit' not in request.args and 'cursor' not in request.args:
+            files_data = StorageService.list_files(path)
+            return jsonify(files_data), 200
+
+        try:
+            limit = int(request.args.get('limit', current_app.config['LIST_PAGE_SIZE']))
+        except ValueError:
+            return jsonify({'error': 'Invalid limit'}), 400
+        limit = max(1, min(limit, current_app.config['LIST_PAGE_MAX']))
+
+        page = StorageService.list_page(
+            path,
+            limit=limit,
+            cursor=request.args.get('cursor') or None,
+            sort=request.args.get('sort', 'name'),
+            order=request.args.get('order', 'asc'),
+            prefix=request.args.get('prefix') or None,
+            mimetype=request.args.get('type') or None,
+            taken_from=request.args.get('taken_from') or None,
+            taken_to=request.args.get('taken_to') or None
+        )
+        return jsonify(page), 200
 
+    except ValueError as e:
+        current_app.logger.error(f"List files error: {str(e)}")
+        return jsonify({'error': str(e)}), 400
     except PermissionError as e:
         current_app.logger.error(f"List files error: Permission denied for path '{path}': {str(e)}", exc_info=True)
         return jsonify({'error': 'Permission denied'}), 403
@@ -128,6 +318,131 @@ def list_files():
         current_app.logger.error(f"List files error: {str(e)}", exc_info=True)
         return jsonify({'error': str(e)}), 500
 
+@api_bp.route('/tree', methods=['GET'])
+def folder_tree():
+    """Folder hierarchy below ``path`` to ``depth`` levels (default 1). Every node
+    carries ``file_count``/``total_bytes`` of its whole subtree and ``has_children``.
+    Answers ``304`` while the tree is unchanged (``If-None-Match``).
+    """
+    try:
+        path = request.args.get('path', '').strip()
+        try:
+            depth = int(request.args.get('depth', 1))
+        except ValueError:
+            return jsonify({'error': 'Invalid depth'}), 400
+
+        version, tree = StorageService.folder_tree(path, depth)
+        response = jsonify({'version': version, 'tree': tree})
+        response.set_etag(f"tree-{version}")
+        # Always revalidate; unchanged trees cost a 304 without a body
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    except ValueError as e:
+        current_app.logger.error(f"Folder tree error: {str(e)}")
+        return jsonify({'error': str(e)}), 400
+    except FileNotFoundError as e:
+        current_app.logger.error(f"Folder tree error: {str(e)}")
+        return jsonify({'error': str(e)}), 404
+    except Exception as e:
+        current_app.logger.error(f"Folder tree error: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+@api_bp.route('/search', methods=['GET'])
+def search_files():
+    """Search the whole tree: ``q`` (words, prefix match on names and folder),
+    ``folder`` (subtree), ``type`` (comma-separated mimetypes), ``from``/``to``
+    (upload date, inclusive), ``taken_from``/``taken_to`` (capture date, else
+    upload date; inclusive), ``min_size``/``max_size`` (bytes), ``sort``,
+    ``order``, ``limit``, ``cursor``. Returns ``{items, next_cursor}``.
+    """
+    try:
+        try:
+            limit = int(request.args.get('limit', current_app.config['LIST_PAGE_SIZE']))
+            min_size = int(request.args['min_size']) if request.args.get('min_size') else None
+            max_size = int(request.args['max_size']) if request.args.get('max_size') else None
+        except ValueError:
+            return jsonify({'error': 'limit, min_size and max_size must be integers'}), 400
+        limit = max(1, min(limit, current_app.config['LIST_PAGE_MAX']))
+        types = [t.strip() for t in request.args.get('type', '').split(',') if t.strip()]
+
+        page = StorageService.search(
+            query=request.args.get('q', '').strip() or None,
+            folder=request.args.get('folder', '').strip() or None,
+            mimetypes=types or None,
+            date_from=request.args.get('from') or None,
+            date_to=request.args.get('to') or None,
+            taken_from=request.args.get('taken_from') or None,
+            taken_to=request.args.get('taken_to') or None,
+            min_size=min_size,
+            max_size=max_size,
+            sort=request.args.get('sort', 'upload_date'),
+            order=request.args.get('order', 'desc'),
+            limit=limit,
+            cursor=request.args.get('cursor') or None
+        )
+        return jsonify(page), 200
+
+    except ValueError as e:
+        current_app.logger.error(f"Search error: {str(e)}")
+        return jsonify({'error': str(e)}), 400
+    except RuntimeError as e:
+        current_app.logger.error(f"Search error: {str(e)}")
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        current_app.logger.error(f"Search error: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+@api_bp.route('/export', methods=['GET', 'POST'])
+def export_zip():
+    """Stream a ZIP of folders and/or files: ``path`` (repeatable) or a JSON body
+    ``{"paths": [...]}``; folders include their subtree unless ``recursive=false``.
+    Entries are stored uncompressed and named after the sidecar ``display_name``.
+    The archive is generated while it is sent (no temp file); the size is known
+    up front, so ``Range``/``If-Range`` requests resume an interrupted download.
+    """
+    try:
+        data = (request.get_json(silent=True) or {}) if request.method == 'POST' else {}
+        paths = data.get('paths') or request.args.getlist('path')
+        if not paths or not isinstance(paths, list) or not all(isinstance(p, str) for p in paths):
+            return jsonify({'error': 'path or paths required'}), 400
+        recursive = str(data.get('recursive', request.args.get('recursive', 'true'))).lower() != 'false'
+
+        archive = ExportService.build(paths, recursive)
+        etag = archive.etag
+        start, stop, status = 0, archive.size, 200
+        if request.range and len(request.range.ranges) == 1 and (
+                not (request.if_range.etag or request.if_range.date) or request.if_range.etag == etag):
+            requested = request.range.range_for_length(archive.size)
+            if requested is None:
+                response = current_app.response_class(status=416)
+                response.content_range = ContentRange('bytes', None, None, archive.size)
+                return response
+            (start, stop), status = requested, 206
+
+        response = current_app.response_class(stream_with_context(archive.stream(start, stop)), status=status,
+                                               mimetype='application/zip', direct_passthrough=True)
+        response.content_length = stop - start
+        response.accept_ranges = 'bytes'
+        response.set_etag(etag)
+        response.last_modified = archive.last_modified
+        if status == 206:
+            response.content_range = ContentRange('bytes', start, stop, archive.size)
+        ascii_name = archive.filename.encode('ascii', 'ignore').decode().replace('"', '') or 'export.zip'
+        response.headers['Content-Disposition'] = (
+            f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(archive.filename)}")
+        return response
+
+    except FileNotFoundError as e:
+        current_app.logger.error(f"Export error: {str(e)}")
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        current_app.logger.error(f"Export error: {str(e)}")
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        current_app.logger.error(f"Export error: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
 @api_bp.route('/folder', methods=['POST'])
 def create_folder():
     try:
@@ -0,0 +1,35 @@
+from flask import Blueprint, current_app, request, abort
+from services.metrics import Metrics
+from services.thumb_queue import ThumbnailQueue
+from services.replication import ReplicationQueue
+import hmac
+
+metrics_bp = Blueprint('metrics', __name__)
+
+@metrics_bp.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint (text format 0.0.4), summed over all app processes."""
+    config = current_app.config
+    if not config['METRICS_ENABLED']:
+        abort(404)
+    token = config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        abort(401)
+
+    try:
+        counters, histograms = Metrics.collect(config)
+        gauges = {}
+        # Queue depth, read from the index at scrape time
+        for name, queue, enabled in (('thumbnail_jobs', ThumbnailQueue, True),
+                                     ('replication_jobs', ReplicationQueue, config['S3_REPLICATION'])):
+            if not enabled:
+                continue
+            stats = queue.stats()
+            for status in ('queued', 'running', 'failed'):
+                gauges[(name, (('status', status),))] = stats.get(status, 0)
+    except Exception as e:
+        current_app.logger.error(f"Metrics error: {e}", exc_info=True)
+        abort(500)
+
+    return current_app.response_class(Metrics.render(counters, histograms, gauges),
+                                      mimetype='text/plain; version=0.0.4')
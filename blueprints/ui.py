@@ -1,8 +1,25 @@
-from flask import Blueprint, render_template, request, current_app, abort, send_from_directory
+from flask import Blueprint, render_template, request, current_app, abort, send_file, redirect
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import is_resource_modified
+from werkzeug.security import safe_join
+from services.index import file_version
+from services.renditions import RenditionService
+from services.backends import storage_backend
+from services.metrics import Metrics
+from urllib.parse import quote
+from datetime import datetime, timezone
+import mimetypes
 import os
+import stat
 
 ui_bp = Blueprint('ui', __name__)
 
+# IMAGE_DELIVERY mode -> header that hands the file over to the front-end server
+OFFLOAD_HEADERS = {
+    'x-accel': 'X-Accel-Redirect',
+    'x-sendfile': 'X-Sendfile',
+}
+
 @ui_bp.route('/')
 def index():
     """Main application page"""
@@ -10,23 +27,165 @@ def index():
 
 @ui_bp.route('/images/<path:filename>')
 def serve_image(filename):
-    """Serve uploaded images"""
+    """Serve uploaded images; ``?w=<width>&fmt=<webp|avif|jpeg>`` serves a resized rendition.
+
+    Responses carry a strong ETag and Last-Modified derived from the original's
+    stat data, so revalidation ends in a 304 without reading the file; Range
+    requests are answered with 206. URLs carrying the current ``?v=`` token
+    (see ``file_version``) are cached as immutable.
+
+    With an object-store backend originals and thumbnails are not proxied:
+    the response is a redirect to a presigned URL, so the bytes never pass
+    through the app. Renditions are still rendered and served from here.
+    """
     try:
-        current_app.logger.info(f"Serving image: {filename}")
-        # Security check to prevent directory traversal
-        if '..' in filename or filename.startswith('/'):
+        current_app.logger.debug(f"Serving image: {filename}")
+        if _is_internal(filename):
+            abort(404)
+        upload_folder = current_app.config['UPLOAD_FOLDER']
+        # safe_join rejects '..' and absolute paths (directory traversal)
+        file_path = safe_join(upload_folder, filename)
+        if file_path is None:
             current_app.logger.warning(f"Attempted directory traversal: {filename}")
             abort(403)
 
-        upload_folder = current_app.config['UPLOAD_FOLDER']
-        file_path = os.path.join(upload_folder, filename)
-        current_app.logger.info(f"Resolved file_path for serving: {file_path}")
+        backend = storage_backend()
+        renditions = 'w' in request.args or 'fmt' in request.args
+        if not backend.is_local and not renditions:
+            return _presigned_redirect(backend, filename)
 
-        # Check if file exists and is within upload folder
-        if not os.path.exists(file_path) or not os.path.commonpath([upload_folder, file_path]) == upload_folder:
+        try:
+            with Metrics.timer('stat'):
+                st = os.stat(file_path) if backend.is_local else backend.stat(filename)
+        except (FileNotFoundError, NotADirectoryError):
+            abort(404)
+        if not stat.S_ISREG(st.st_mode):
             abort(404)
 
-        return send_from_directory(upload_folder, filename)
+        version = file_version(st.st_mtime, st.st_size)
+        etag = f"{st.st_mtime_ns:x}-{st.st_size:x}"
+        if renditions:
+            try:
+                width, fmt = RenditionService.resolve(request.args.get('w'), request.args.get('fmt'))
+            except ValueError as e:
+                abort(400, description=str(e))
+            etag = f"{etag}-w{width}-{fmt}"
+            # A fresh cached copy needs no rendition at all, not even a cache lookup
+            if not _is_modified(etag, st.st_mtime):
+                return _not_modified(etag, request.args.get('v') == version)
+            path = RenditionService.get(filename, width, fmt, st.st_mtime)
+            mimetype = RenditionService.mimetype(fmt)
+        else:
+            path, mimetype = file_path, None
+
+        versioned = _is_versioned(version)
+        response = None
+        if current_app.config['IMAGE_DELIVERY'] in OFFLOAD_HEADERS:
+            if not _is_modified(etag, st.st_mtime):
+                return _not_modified(etag, versioned)
+            response = _offload(path, mimetype, etag, st.st_mtime)
+        if response is None:
+            # Opens the file and evaluates the conditional/Range headers; the body streams later
+            with Metrics.timer('send'):
+                response = send_file(path, mimetype=mimetype, etag=etag, last_modified=st.st_mtime,
+                                     conditional=True)
+        _apply_cache_policy(response, versioned)
+        return response
+    except HTTPException:
+        raise
     except Exception as e:
         current_app.logger.error(f"Error serving image {filename}: {e}")
         abort(404)
+
+
+def _is_internal(filename):
+    """Whether ``filename`` points at app state kept in UPLOAD_FOLDER (index,
+    journals, blobs, upload sessions, metrics, ...): any dot-entry except
+    ``.thumbs`` and the sprite sheets in it."""
+    parts = filename.split('/')
+    for i, part in enumerate(parts):
+        if not part.startswith('.') or part == '.thumbs':
+            continue
+        if i and parts[i - 1] == '.thumbs' and part.startswith('.sprite-'):
+            continue
+        return True
+    return False
+
+
+def _presigned_redirect(backend, filename):
+    """302 to the object. Cached privately for half the URL lifetime, so a cached
+    redirect never points at an expired URL; a missing object is the bucket's 404."""
+    response = redirect(backend.url(filename), code=302)
+    response.cache_control.private = True
+    response.cache_control.max_age = current_app.config['STORAGE_URL_EXPIRES'] // 2
+    return response
+
+
+def _is_versioned(version):
+    """Whether the request URL pins the current content of the requested file.
+
+    Thumbnails carry their own token (``thumb_version`` in listings), so one
+    rewritten in place (``flask thumbs backfill --force``) is not pinned by an
+    old URL.
+    """
+    requested = request.args.get('v')
+    return bool(requested) and requested == version
+
+
+def _apply_cache_policy(response, versioned):
+    if versioned:
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['IMAGE_CACHE_IMMUTABLE_MAX_AGE']
+        response.cache_control.immutable = True
+        response.cache_control.no_cache = None
+    else:
+        # Unversioned URLs: cache briefly (default 0) and revalidate with the ETag
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['IMAGE_CACHE_MAX_AGE']
+        response.cache_control.no_cache = None
+
+
+def _offload(path, mimetype, etag, last_modified):
+    """Empty response telling nginx (X-Accel-Redirect) or Apache (X-Sendfile)
+    to send ``path`` itself; the worker is free again immediately.
+
+    Returns None when nginx has no location for ``path``; the app sends it then.
+    """
+    delivery = current_app.config['IMAGE_DELIVERY']
+    location = os.path.abspath(path) if delivery == 'x-sendfile' else _accel_location(path)
+    if location is None:
+        return None
+    response = current_app.response_class()
+    response.mimetype = mimetype or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers[OFFLOAD_HEADERS[delivery]] = location
+    return response
+
+
+def _accel_location(path):
+    """Map a file below UPLOAD_FOLDER (or the rendition cache) onto the internal nginx location;
+    None if it lies below neither (rendition cache outside UPLOAD_FOLDER without its own prefix)."""
+    locations = [(RenditionService.cache_dir(), current_app.config['IMAGE_ACCEL_RENDITION_PREFIX']),
+                 (current_app.config['UPLOAD_FOLDER'], current_app.config['IMAGE_ACCEL_PREFIX'])]
+    path = os.path.abspath(path)
+    for root, prefix in locations:
+        root = os.path.abspath(root)
+        if prefix and os.path.commonpath([root, path]) == root:
+            relative = os.path.relpath(path, root).replace(os.sep, '/')
+            return prefix.rstrip('/') + '/' + quote(relative)
+    current_app.logger.debug(f"No X-Accel-Redirect location for {path}, sending it from the app")
+    return None
+
+
+def _is_modified(etag, mtime):
+    """Evaluate If-None-Match and, without it, If-Modified-Since, like send_file does."""
+    return is_resource_modified(request.environ, etag=etag,
+                                last_modified=datetime.fromtimestamp(mtime, timezone.utc))
+
+
+def _not_modified(etag, versioned):
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    _apply_cache_policy(response, versioned)
+    return response
@@ -0,0 +1,174 @@
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from services.index import IndexService
+from services.thumb_queue import ThumbnailQueue, ThumbnailWorker
+from services.renditions import RenditionService
+from services.uploads import UploadSessionService
+from services.blobs import BlobStore
+from services.watcher import FolderWatcher
+from services.external_storage import ExternalStorageService
+from services.replication import ReplicationQueue, ReplicationWorker
+from services.backfill import ThumbnailBackfill
+
+index_cli = AppGroup('index', help='Manage the SQLite metadata index.')
+thumbs_cli = AppGroup('thumbs', help='Thumbnail generation.')
+renditions_cli = AppGroup('renditions', help='On-demand image renditions.')
+uploads_cli = AppGroup('uploads', help='Chunked upload sessions.')
+blobs_cli = AppGroup('blobs', help='Deduplicating blob store (DEDUP_STORAGE).')
+watch_cli = AppGroup('watch', help='Sync with files changed outside the app.')
+replicate_cli = AppGroup('replicate', help='S3 replication (S3_REPLICATION).')
+
+
+@index_cli.command('rebuild')
+def rebuild_index():
+    """Rebuild the metadata index from the files and sidecars in storage."""
+    result = IndexService.rebuild()
+    click.echo(f"Indexed {result['files']} files in {result['folders']} folders")
+
+
+@thumbs_cli.command('worker')
+@click.option('--once', is_flag=True, help='Exit once the queue is empty.')
+def thumbs_worker(once):
+    """Process queued thumbnail jobs in the foreground."""
+    ThumbnailWorker.run(current_app._get_current_object(), once=once)
+
+
+@thumbs_cli.command('status')
+def thumbs_status():
+    """Show the number of thumbnail jobs per state."""
+    stats = ThumbnailQueue.stats()
+    for status in ('queued', 'running', 'failed'):
+        click.echo(f"{status}: {stats.get(status, 0)}")
+
+
+@thumbs_cli.command('backfill')
+@click.argument('folder', default='')
+@click.option('--force', is_flag=True, help='Regenerate all thumbnails, not only missing or outdated ones '
+                                            '(after changing THUMBNAIL_SIZE or THUMBNAIL_FORMAT).')
+@click.option('--workers', type=click.IntRange(min=1), help='Rendering processes (default: one per CPU).')
+@click.option('--max-inflight', type=click.IntRange(min=1), help='Originals open at a time (default: 2 per worker).')
+@click.option('--rate', type=click.FloatRange(min=0), default=0, help='At most this many files per second (0: no limit).')
+@click.option('--nice', 'niceness', type=click.IntRange(0, 19), default=10, show_default=True,
+              help='Niceness of the rendering processes.')
+def thumbs_backfill(folder, force, workers, max_inflight, rate, niceness):
+    """Render missing or outdated thumbnails below FOLDER (default: everything).
+
+    An interrupted run can simply be started again; a --force run then resumes
+    where it stopped.
+    """
+    _require_local_storage('Backfilling thumbnails')
+
+    def report(totals):
+        seconds = max(totals['seconds'], 1e-6)
+        percent = totals['done'] * 100 // totals['total'] if totals['total'] else 100
+        click.echo(f"{totals['done']}/{totals['total']} ({percent}%), {totals['done'] / seconds:.1f} files/s, "
+                   f"{totals['bytes'] / 1024 / 1024 / seconds:.1f} MB/s, {totals['failed']} failed", err=True)
+
+    totals = ThumbnailBackfill.run(folder, force=force, workers=workers, max_inflight=max_inflight, rate=rate,
+                                   niceness=niceness, progress=report)
+    click.echo(f"Rendered {totals['rendered']} thumbnails in {totals['seconds']:.1f}s, "
+               f"{totals['failed']} failed, {totals['fresh']} up to date")
+    if totals['failed']:
+        raise click.ClickException('Some thumbnails failed; run the command again to retry them')
+
+
+@renditions_cli.command('status')
+def renditions_status():
+    """Show the size of the rendition cache."""
+    stats = RenditionService.stats()
+    quota = current_app.config['RENDITION_CACHE_MAX_MB']
+    click.echo(f"{stats['count']} renditions, {stats['bytes'] / 1024 / 1024:.1f} of {quota} MB")
+
+
+@uploads_cli.command('cleanup')
+def uploads_cleanup():
+    """Remove upload sessions idle for longer than UPLOAD_SESSION_TTL."""
+    removed = UploadSessionService.cleanup_expired()
+    click.echo(f"Removed {removed} expired upload sessions")
+
+
+@blobs_cli.command('status')
+def blobs_status():
+    """Show the size of the blob store and the space saved by deduplication."""
+    stats = BlobStore.stats()
+    click.echo(f"{stats['blobs']} blobs, {stats['bytes'] / 1024 / 1024:.1f} MB stored, "
+               f"{stats['saved_bytes'] / 1024 / 1024:.1f} MB saved, {stats['unreferenced']} unreferenced")
+
+
+@blobs_cli.command('gc')
+@click.option('--dry-run', is_flag=True, help='Only report what would be removed.')
+def blobs_gc(dry_run):
+    """Remove blobs that no folder entry links to any more."""
+    removed, freed = BlobStore.gc(dry_run=dry_run)
+    verb = 'Would remove' if dry_run else 'Removed'
+    click.echo(f"{verb} {removed} blobs ({freed / 1024 / 1024:.1f} MB)")
+
+
+def _require_local_storage(action='Watching'):
+    if current_app.config['STORAGE_BACKEND'] != 'local':
+        raise click.ClickException(f'{action} needs a local upload folder (STORAGE_BACKEND=local)')
+
+
+@watch_cli.command('run')
+def watch_run():
+    """Watch the upload folder in the foreground."""
+    _require_local_storage()
+    FolderWatcher.run(current_app._get_current_object())
+
+
+@watch_cli.command('reconcile')
+def watch_reconcile():
+    """Sync the whole tree once and exit (cron, CGI)."""
+    _require_local_storage()
+    if not FolderWatcher.run(current_app._get_current_object(), once=True):
+        click.echo('Another process is watching the upload folder; nothing to do')
+
+
+@replicate_cli.command('worker')
+@click.option('--once', is_flag=True, help='Exit once no job is due.')
+def replicate_worker(once):
+    """Send queued changes to S3 in the foreground."""
+    ReplicationWorker.run(current_app._get_current_object(), once=once)
+
+
+@replicate_cli.command('sync')
+@click.argument('folder', default='')
+@click.option('--dry-run', is_flag=True, help='Only report what would be transferred or deleted.')
+def replicate_sync(folder, dry_run):
+    """Bring the bucket in line with FOLDER (default: everything), skipping unchanged objects."""
+    if not ExternalStorageService.is_enabled():
+        raise click.ClickException('S3_REPLICATION is not enabled')
+    folder = folder.strip('/')
+    if dry_run:
+        transfers, orphans, unchanged = ExternalStorageService.plan_sync(folder)
+        click.echo(f"Would transfer {len(transfers)} and delete {len(orphans)} objects, {unchanged} unchanged")
+        return
+    ReplicationQueue.enqueue([('tree', folder, None)], start_worker=False)
+    ReplicationWorker.run(current_app._get_current_object(), once=True)
+    stats = ReplicationQueue.stats()
+    click.echo(f"Sync done; {stats.get('queued', 0)} jobs waiting for a retry, {stats.get('failed', 0)} failed")
+
+
+@replicate_cli.command('status')
+def replicate_status():
+    """Show the number of replication jobs per state."""
+    stats = ReplicationQueue.stats()
+    for status in ('queued', 'running', 'failed'):
+        click.echo(f"{status}: {stats.get(status, 0)}")
+
+
+@replicate_cli.command('retry')
+def replicate_retry():
+    """Queue failed replication jobs again."""
+    click.echo(f"Requeued {ReplicationQueue.retry_failed()} jobs")
+
+
+def register_commands(app):
+    app.cli.add_command(index_cli)
+    app.cli.add_command(thumbs_cli)
+    app.cli.add_command(renditions_cli)
+    app.cli.add_command(uploads_cli)
+    app.cli.add_command(blobs_cli)
+    app.cli.add_command(watch_cli)
+    app.cli.add_command(replicate_cli)
@@ -29,6 +29,141 @@ class Config:
     MAX_CONTENT_LENGTH = MAX_SIZE_MB * 1024 * 1024
     THUMBNAIL_SIZE = (150, 150)
     
+    # Thumbnail encoding: JPEG, WEBP or PNG; lossy formats are fitted into
+    # THUMBNAIL_MAX_BYTES by lowering the quality down to THUMBNAIL_QUALITY_MIN
+    THUMBNAIL_FORMAT = os.getenv('THUMBNAIL_FORMAT', 'JPEG').upper()
+    THUMBNAIL_MAX_BYTES = int(os.getenv('THUMBNAIL_MAX_BYTES', str(30 * 1024)))
+    THUMBNAIL_QUALITY_MAX = int(os.getenv('THUMBNAIL_QUALITY_MAX', '85'))
+    THUMBNAIL_QUALITY_MIN = int(os.getenv('THUMBNAIL_QUALITY_MIN', '60'))
+    
+    # Background thumbnail generation (0 workers = generate inline during the upload).
+    # CGI processes exit with the request, taking a pool along: generate inline there
+    # and drain leftover jobs with `flask thumbs worker --once` from cron.
+    THUMBNAIL_WORKERS = int(os.getenv('THUMBNAIL_WORKERS', '0' if os.getenv('CGI_MODE') or 'cgi-bin' in os.getcwd()
+                                      else '2'))
+    THUMBNAIL_WORKER_IN_APP = os.getenv('THUMBNAIL_WORKER_IN_APP', 'true').lower() == 'true'
+    THUMBNAIL_QUEUE_POLL = float(os.getenv('THUMBNAIL_QUEUE_POLL', '1.0'))
+    THUMBNAIL_JOB_LEASE = int(os.getenv('THUMBNAIL_JOB_LEASE', '300'))
+    THUMBNAIL_MAX_ATTEMPTS = int(os.getenv('THUMBNAIL_MAX_ATTEMPTS', '3'))
+
+    # ZIP export (/api/export): most files per archive; the entry list is held in memory
+    EXPORT_MAX_FILES = int(os.getenv('EXPORT_MAX_FILES', '20000'))
+
+    # Per-folder sprite sheet of the thumbnails, served with paged listings so a
+    # folder view loads one image instead of one per file (needs METADATA_INDEX)
+    THUMBNAIL_SPRITES = os.getenv('THUMBNAIL_SPRITES', 'false').lower() == 'true'
+    THUMBNAIL_SPRITE_MAX_FILES = int(os.getenv('THUMBNAIL_SPRITE_MAX_FILES', '500'))
+    
+    # File names for new uploads: 'original' keeps the (sanitized) upload name and
+    # appends -1, -2, ... on collisions; 'hash' names files after their SHA-256
+    UPLOAD_NAMING = os.getenv('UPLOAD_NAMING', 'original').lower()
+
+    # Store each original once by SHA-256 under .blobs/ and hard-link it into the
+    # folders; `flask blobs gc` removes blobs that are no longer linked anywhere
+    DEDUP_STORAGE = os.getenv('DEDUP_STORAGE', 'false').lower() == 'true'
+    BLOB_GC_GRACE = int(os.getenv('BLOB_GC_GRACE', '3600'))
+
+    # Multi-file uploads (/api/upload/batch): limit for the whole request body and
+    # threads writing files/sidecars in parallel
+    BATCH_UPLOAD_MAX_MB = int(os.getenv('BATCH_UPLOAD_MAX_MB', '200'))
+    BATCH_UPLOAD_WORKERS = int(os.getenv('BATCH_UPLOAD_WORKERS', '4'))
+
+    # Bulk delete/move/rename (/api/bulk): operations per request
+    BULK_MAX_OPERATIONS = int(os.getenv('BULK_MAX_OPERATIONS', '1000'))
+    
+    # Chunked, resumable uploads (/api/uploads). Each chunk request must stay
+    # below MAX_CONTENT_LENGTH; the assembled file may be up to UPLOAD_SESSION_MAX_MB.
+    UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', str(4 * 1024 * 1024)))
+    UPLOAD_SESSION_MAX_MB = int(os.getenv('UPLOAD_SESSION_MAX_MB', '200'))
+    UPLOAD_SESSION_TTL = int(os.getenv('UPLOAD_SESSION_TTL', str(24 * 3600)))
+    
+    # On-demand renditions (/images/<path>?w=800&fmt=webp); widths snap up to the
+    # next configured value. The cache defaults to UPLOAD_FOLDER/.renditions.
+    RENDITION_WIDTHS = [int(w) for w in os.getenv('RENDITION_WIDTHS', '320,640,800,1280,1920').split(',')]
+    RENDITION_FORMATS = os.getenv('RENDITION_FORMATS', 'webp,avif,jpeg').split(',')
+    RENDITION_DEFAULT_FORMAT = os.getenv('RENDITION_DEFAULT_FORMAT', 'webp')
+    RENDITION_QUALITY = int(os.getenv('RENDITION_QUALITY', '80'))
+    RENDITION_CACHE_DIR = os.getenv('RENDITION_CACHE_DIR')
+    RENDITION_CACHE_MAX_MB = int(os.getenv('RENDITION_CACHE_MAX_MB', '1024'))
+    
+    # Browser caching for /images: URLs with the current ?v= token are immutable,
+    # other responses are cached for IMAGE_CACHE_MAX_AGE seconds and then revalidated
+    IMAGE_CACHE_MAX_AGE = int(os.getenv('IMAGE_CACHE_MAX_AGE', '0'))
+    IMAGE_CACHE_IMMUTABLE_MAX_AGE = int(os.getenv('IMAGE_CACHE_IMMUTABLE_MAX_AGE', str(365 * 24 * 3600)))
+    
+    # Image delivery: 'direct' streams files from the app, 'x-accel' (nginx) or
+    # 'x-sendfile' (Apache mod_xsendfile) hand them to the front-end server.
+    # IMAGE_ACCEL_PREFIX is the internal nginx location aliased to UPLOAD_FOLDER;
+    # the rendition prefix is only needed when RENDITION_CACHE_DIR lies outside of it.
+    IMAGE_DELIVERY = os.getenv('IMAGE_DELIVERY', 'direct').lower()
+    IMAGE_ACCEL_PREFIX = os.getenv('IMAGE_ACCEL_PREFIX', '/_protected_images/')
+    IMAGE_ACCEL_RENDITION_PREFIX = os.getenv('IMAGE_ACCEL_RENDITION_PREFIX')
+    
+    # SQLite metadata index (defaults to UPLOAD_FOLDER/.index.sqlite3).
+    # With METADATA_INDEX=false listings are served from a directory scan instead.
+    METADATA_INDEX = os.getenv('METADATA_INDEX', 'true').lower() == 'true'
+    INDEX_PATH = os.getenv('INDEX_PATH')
+
+    # Keep index, sidecars and thumbnails in sync with files changed outside the
+    # app (SFTP, rsync). Uses inotify where available and rescans folders whose
+    # mtime changed every FS_WATCHER_RECONCILE_INTERVAL seconds. Events are
+    # collected until nothing happened for FS_WATCHER_DEBOUNCE seconds (at most
+    # FS_WATCHER_MAX_DELAY). CGI has no long-running process: use `flask watch reconcile`.
+    FS_WATCHER = os.getenv('FS_WATCHER', 'false' if os.getenv('CGI_MODE') or 'cgi-bin' in os.getcwd()
+                           else 'true').lower() == 'true'
+    FS_WATCHER_DEBOUNCE = float(os.getenv('FS_WATCHER_DEBOUNCE', '2.0'))
+    FS_WATCHER_MAX_DELAY = float(os.getenv('FS_WATCHER_MAX_DELAY', '10.0'))
+    FS_WATCHER_RECONCILE_INTERVAL = int(os.getenv('FS_WATCHER_RECONCILE_INTERVAL', '60'))
+    FS_WATCHER_BATCH = int(os.getenv('FS_WATCHER_BATCH', '500'))
+    
+    # /api/list pagination (used when the client sends limit or cursor)
+    LIST_PAGE_SIZE = int(os.getenv('LIST_PAGE_SIZE', '100'))
+    LIST_PAGE_MAX = int(os.getenv('LIST_PAGE_MAX', '500'))
+    
+    # S3 replication of originals and sidecars (needs `pip install boto3`). Every
+    # change is written to an outbox in the index and sent in the background by
+    # S3_REPLICATION_WORKERS threads sharing one pooled client. AWS_ENDPOINT_URL
+    # selects MinIO or another S3-compatible service; credentials come from the
+    # usual AWS sources (AWS_ACCESS_KEY_ID/AWS_SECRET_ACCESS_KEY, instance role).
+    S3_REPLICATION = os.getenv('S3_REPLICATION', 'false').lower() == 'true'
+    AWS_BUCKET_NAME = os.getenv('AWS_BUCKET_NAME')
+    AWS_ENDPOINT_URL = os.getenv('AWS_ENDPOINT_URL')
+    AWS_REGION = os.getenv('AWS_REGION', os.getenv('AWS_DEFAULT_REGION'))
+    S3_PREFIX = os.getenv('S3_PREFIX', '')
+    S3_REPLICATION_WORKERS = int(os.getenv('S3_REPLICATION_WORKERS', '4'))
+    S3_REPLICATION_IN_APP = os.getenv('S3_REPLICATION_IN_APP', 'true').lower() == 'true'
+    S3_REPLICATION_POLL = float(os.getenv('S3_REPLICATION_POLL', '1.0'))
+    S3_MULTIPART_THRESHOLD_MB = int(os.getenv('S3_MULTIPART_THRESHOLD_MB', '16'))
+    S3_MULTIPART_CHUNK_MB = int(os.getenv('S3_MULTIPART_CHUNK_MB', '16'))
+    S3_TRANSFER_CONCURRENCY = int(os.getenv('S3_TRANSFER_CONCURRENCY', '4'))
+    S3_MAX_ATTEMPTS = int(os.getenv('S3_MAX_ATTEMPTS', '8'))
+    S3_RETRY_DELAY = float(os.getenv('S3_RETRY_DELAY', '5'))
+    S3_JOB_LEASE = int(os.getenv('S3_JOB_LEASE', '900'))
+    
+    # Where originals, sidecars and thumbnails live: 'local' (UPLOAD_FOLDER) or 's3'
+    # (STORAGE_S3_BUCKET, same endpoint/credentials as above). With s3, listings come
+    # from the metadata index only and /images/ redirects to presigned URLs valid for
+    # STORAGE_URL_EXPIRES seconds. Index, journals, rendition cache and upload staging
+    # stay in UPLOAD_FOLDER on each node.
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'local').lower()
+    STORAGE_S3_BUCKET = os.getenv('STORAGE_S3_BUCKET', os.getenv('AWS_BUCKET_NAME'))
+    STORAGE_S3_PREFIX = os.getenv('STORAGE_S3_PREFIX', '')
+    STORAGE_URL_EXPIRES = int(os.getenv('STORAGE_URL_EXPIRES', '3600'))
+    
+    # Logging: DEBUG also logs every listing, upload result and thumbnail (hot paths)
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+    # Rotating log file; empty = console only (the test suite sets this)
+    LOG_FILE = os.getenv('LOG_FILE', 'logs/app.log')
+    
+    # Prometheus metrics on /metrics (request latency, stage timers, bytes, queue depth).
+    # Every process writes its totals to METRICS_DIR (default UPLOAD_FOLDER/.metrics,
+    # which /images/ does not serve) at most every METRICS_FLUSH_INTERVAL seconds.
+    # With METRICS_TOKEN set, scrapers must send "Authorization: Bearer <token>".
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+    METRICS_DIR = os.getenv('METRICS_DIR', '')
+    METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '1.0'))
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+    
     # Server configuration
     PREFERRED_URL_SCHEME = os.getenv('PREFERRED_URL_SCHEME', 'https')
     SERVER_NAME = os.getenv('SERVER_NAME')
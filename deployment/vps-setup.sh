@@ -724,6 +724,11 @@ server {
         add_header Cache-Control "public, immutable";
     }
 
+    # Internal state of the app (index, journals, blobs, ...) is never served
+    location ~ ^/images/(.*/)?\\.(?!thumbs/|sprite-) {
+        return 404;
+    }
+
     # Image files
     location /images/ {
         alias $APP_DIR/images/;
@@ -736,6 +741,15 @@ server {
         add_header Access-Control-Allow-Headers "Origin, X-Requested-With, Content-Type, Accept";
     }
 
+    # Internal location for IMAGE_DELIVERY=x-accel (see image-delivery.md)
+    location /_protected_images/ {
+        internal;
+        alias $APP_DIR/images/;
+        sendfile on;
+        tcp_nopush on;
+        add_header Access-Control-Allow-Origin "*";
+    }
+
     # Application
     location / {
         proxy_pass http://127.0.0.1:5000;
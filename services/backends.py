@@ -0,0 +1,454 @@
+import os
+import json
+import stat
+import shutil
+import tempfile
+import mimetypes
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from flask import current_app
+from services.index import IndexService
+from services.thumbs import ThumbnailService
+from services.external_storage import ExternalStorageService, DELETE_BATCH
+import logging
+
+try:
+    from botocore.exceptions import ClientError
+except ImportError:  # Optional dependency, only needed with STORAGE_BACKEND=s3
+    ClientError = None
+
+logger = logging.getLogger(__name__)
+
+# Stat result of an object-store entry, shaped like the os.stat_result fields the app reads
+ObjectStat = namedtuple('ObjectStat', 'st_size st_mtime st_mtime_ns st_mode')
+
+# Sidecars read in parallel while rebuilding the index from a bucket
+SIDECAR_READERS = 16
+
+
+def storage_backend():
+    """The app's StorageBackend, created on first use (see STORAGE_BACKEND)."""
+    backend = current_app.extensions.get('storage_backend')
+    if backend is None:
+        if current_app.config['STORAGE_BACKEND'] == 's3':
+            backend = S3Backend()
+        else:
+            backend = LocalBackend(current_app.config['UPLOAD_FOLDER'])
+        current_app.extensions['storage_backend'] = backend
+    return backend
+
+
+class StorageBackend:
+    """Where originals, sidecars and thumbnails live.
+
+    Paths are relative and use '/' ('a/b.jpg', 'a/b.json', 'a/.thumbs/b.jpg').
+    Listings never come from here but from the metadata index; ``listdir``
+    and ``walk`` serve bulk planning and ``flask index rebuild``. Code that
+    needs a real file (Pillow, hashing) goes through ``fetch`` and ``writer``,
+    which are free for the local backend and download/upload for object stores.
+    File methods don't need an app context (thumbnail and upload threads).
+    """
+
+    is_local = False
+
+    @staticmethod
+    def init_app(app):
+        """Reject combinations the object-store backend cannot support."""
+        if app.config['STORAGE_BACKEND'] == 'local':
+            return
+        if app.config['STORAGE_BACKEND'] != 's3':
+            raise RuntimeError(f"Unknown STORAGE_BACKEND: {app.config['STORAGE_BACKEND']}")
+        ExternalStorageService.check_available()
+        if not app.config['STORAGE_S3_BUCKET']:
+            raise RuntimeError("STORAGE_BACKEND=s3 requires STORAGE_S3_BUCKET")
+        # Folders and listings exist only in the index
+        if not app.config['METADATA_INDEX']:
+            raise RuntimeError("STORAGE_BACKEND=s3 requires METADATA_INDEX=true")
+        # Hard-linked blobs need a local tree; replicating the bucket into itself makes no sense
+        for option in ('DEDUP_STORAGE', 'S3_REPLICATION'):
+            if app.config[option]:
+                raise RuntimeError(f"{option} is not supported with STORAGE_BACKEND=s3")
+
+    def local_path(self, path):
+        """Filesystem path of ``path``, or None if it has none."""
+        return None
+
+    def makedirs(self, folder):
+        raise NotImplementedError
+
+    def isdir(self, folder):
+        raise NotImplementedError
+
+    def exists(self, path):
+        """Whether a file or folder exists at ``path``."""
+        raise NotImplementedError
+
+    def stat(self, path):
+        """``os.stat_result``-like (st_size, st_mtime, st_mtime_ns, st_mode); FileNotFoundError if missing."""
+        raise NotImplementedError
+
+    def listdir(self, folder):
+        """``({name: is_dir}, {names in .thumbs/})`` of one folder; FileNotFoundError if missing."""
+        raise NotImplementedError
+
+    def walk(self):
+        """Yield ``(folder, subfolder names, index records)`` for every folder, like scanner.walk_tree."""
+        raise NotImplementedError
+
+    def open(self, path):
+        """Readable binary stream of ``path``."""
+        raise NotImplementedError
+
+    @contextmanager
+    def fetch(self, path):
+        """Context manager yielding a local file with the content of ``path``."""
+        raise NotImplementedError
+
+    @contextmanager
+    def writer(self, path):
+        """Context manager yielding a local path to write; it replaces ``path`` atomically on success."""
+        raise NotImplementedError
+
+    def claim(self, path):
+        """Create an empty placeholder at ``path`` unless something exists there; returns whether it did."""
+        raise NotImplementedError
+
+    def put_file(self, path, local_file):
+        """Move ``local_file`` to ``path`` (the local file is consumed)."""
+        raise NotImplementedError
+
+    def temp_file(self, path):
+        """New empty local scratch file (same extension as ``path``) that can be handed to ``put_file``."""
+        raise NotImplementedError
+
+    def put_bytes(self, path, data):
+        with self.writer(path) as tmp_path:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+
+    def rename(self, old, new):
+        """Rename a file or folder; FileNotFoundError if ``old`` is missing."""
+        raise NotImplementedError
+
+    def remove(self, path):
+        """Remove a file; nothing happens if it is already gone."""
+        raise NotImplementedError
+
+    def rmtree(self, folder):
+        raise NotImplementedError
+
+    def url(self, path):
+        """Direct (presigned) download URL, or None if files are served by the app."""
+        return None
+
+
+class LocalBackend(StorageBackend):
+    """Files below UPLOAD_FOLDER (the default)."""
+
+    is_local = True
+
+    def __init__(self, root):
+        self.root = root
+
+    def local_path(self, path):
+        return os.path.join(self.root, path) if path else self.root
+
+    def makedirs(self, folder):
+        os.makedirs(os.path.join(self.local_path(folder), '.thumbs'), exist_ok=True)
+
+    def isdir(self, folder):
+        return os.path.isdir(self.local_path(folder))
+
+    def exists(self, path):
+        return os.path.lexists(self.local_path(path))
+
+    def stat(self, path):
+        try:
+            return os.stat(self.local_path(path))
+        except NotADirectoryError:
+            raise FileNotFoundError(path)
+
+    def listdir(self, folder):
+        full = self.local_path(folder)
+        with os.scandir(full) as it:
+            entries = {entry.name: entry.is_dir() for entry in it}
+        thumbs = set()
+        if entries.get('.thumbs'):
+            thumbs = set(os.listdir(os.path.join(full, '.thumbs')))
+        return entries, thumbs
+
+    def walk(self):
+        from services.scanner import walk_tree
+        return walk_tree(self.root)
+
+    def open(self, path):
+        return open(self.local_path(path), 'rb')
+
+    @contextmanager
+    def fetch(self, path):
+        yield self.local_path(path)
+
+    @contextmanager
+    def writer(self, path):
+        target = self.local_path(path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.tmp-')
+        # mkstemp creates 0600; the web server (X-Accel-Redirect) must be able to read it
+        os.fchmod(fd, 0o644)
+        os.close(fd)
+        try:
+            yield tmp_path
+            os.replace(tmp_path, target)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def claim(self, path):
+        try:
+            os.close(os.open(self.local_path(path), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+            return True
+        except FileExistsError:
+            return False
+
+    def temp_file(self, path):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.local_path(path)), prefix='.tmp-',
+                                        suffix=os.path.splitext(path)[1])
+        os.fchmod(fd, 0o644)
+        os.close(fd)
+        return tmp_path
+
+    def put_file(self, path, local_file):
+        os.replace(local_file, self.local_path(path))
+
+    def put_bytes(self, path, data):
+        with open(self.local_path(path), 'wb') as f:
+            f.write(data)
+
+    def rename(self, old, new):
+        os.rename(self.local_path(old), self.local_path(new))
+
+    def remove(self, path):
+        try:
+            os.remove(self.local_path(path))
+        except FileNotFoundError:
+            pass
+
+    def rmtree(self, folder):
+        shutil.rmtree(self.local_path(folder))
+
+
+class S3Backend(StorageBackend):
+    """Objects in STORAGE_S3_BUCKET under STORAGE_S3_PREFIX (S3, MinIO, ...).
+
+    Folders exist only in the index. Names are claimed with a conditional
+    ``PutObject`` (``If-None-Match: *``), the object-store counterpart of
+    ``O_EXCL``. Renames are server-side copies. The client, pool and
+    TransferConfig are shared with the replication worker.
+    """
+
+    def __init__(self):
+        config = current_app.config
+        self.bucket = config['STORAGE_S3_BUCKET']
+        self.prefix = config['STORAGE_S3_PREFIX']
+        self.expires = config['STORAGE_URL_EXPIRES']
+        self.scratch = os.path.join(config['UPLOAD_FOLDER'], '.tmp')
+        self.client = ExternalStorageService.client()
+        self.transfer = ExternalStorageService.transfer_config()
+        os.makedirs(self.scratch, exist_ok=True)
+
+    def key(self, path):
+        return self.prefix + path
+
+    def makedirs(self, folder):
+        IndexService.add_folder(folder)
+
+    def isdir(self, folder):
+        return IndexService.folder_exists(folder)
+
+    def exists(self, path):
+        try:
+            self.stat(path)
+            return True
+        except FileNotFoundError:
+            return IndexService.folder_exists(path)
+
+    def stat(self, path):
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.key(path))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                raise FileNotFoundError(path)
+            raise
+        mtime = head['LastModified'].timestamp()
+        return ObjectStat(head['ContentLength'], mtime, int(mtime * 1e9), stat.S_IFREG | 0o644)
+
+    def listdir(self, folder):
+        if not IndexService.folder_exists(folder):
+            raise FileNotFoundError(folder)
+        files, subfolders = IndexService.folder_entries(folder)
+        entries = {name: True for name in subfolders}
+        thumbs = set()
+        for name, row in files.items():
+            entries[name] = False
+            entries[os.path.splitext(name)[0] + '.json'] = False
+            if row['thumb_status'] == 'ready':
+                thumbs.add(ThumbnailService.thumbnail_name(name))
+        return entries, thumbs
+
+    def walk(self):
+        """One LIST of the bucket; sidecars are read in parallel (index rebuild only)."""
+        from services.scanner import file_record
+        folders = {'': ({}, set(), set())}  # folder -> (originals, sidecars, thumbs)
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get('Contents', []):
+                path = obj['Key'][len(self.prefix):]
+                folder, _, name = path.rpartition('/')
+                if folder == '.thumbs' or folder.endswith('/.thumbs'):
+                    folders.setdefault(folder[:-len('.thumbs')].rstrip('/'), ({}, set(), set()))[2].add(name)
+                    continue
+                if not name or name.startswith('.') or any(p.startswith('.') for p in folder.split('/') if p):
+                    continue
+                entry = folders.setdefault(folder, ({}, set(), set()))
+                if name.endswith('.json'):
+                    entry[1].add(name)
+                else:
+                    mtime = obj['LastModified'].timestamp()
+                    entry[0][name] = ObjectStat(obj['Size'], mtime, int(mtime * 1e9), stat.S_IFREG | 0o644)
+        # Folders without objects of their own (only subfolders)
+        for folder in list(folders):
+            while folder:
+                folder = folder.rpartition('/')[0]
+                folders.setdefault(folder, ({}, set(), set()))
+
+        def read_sidecar(path):
+            try:
+                return json.loads(self.client.get_object(Bucket=self.bucket, Key=self.key(path))['Body'].read())
+            except (ClientError, ValueError):
+                logger.warning(f"Could not read sidecar {path}")
+                return {}
+
+        with ThreadPoolExecutor(max_workers=SIDECAR_READERS) as pool:
+            for folder in sorted(folders):
+                originals, sidecars, thumbs = folders[folder]
+                subfolders = [f.rpartition('/')[2] for f in folders if f and f.rpartition('/')[0] == folder]
+                names = list(originals)
+                sidecar_paths = ['/'.join(filter(None, [folder, os.path.splitext(name)[0] + '.json']))
+                                 if os.path.splitext(name)[0] + '.json' in sidecars else None for name in names]
+                metadata = pool.map(lambda path: read_sidecar(path) if path else {}, sidecar_paths)
+                records = [file_record(folder, name, originals[name], meta, thumbs)
+                           for name, meta in zip(names, metadata)]
+                yield folder, subfolders, records
+
+    def open(self, path):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.key(path))['Body']
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise FileNotFoundError(path)
+            raise
+
+    def temp_file(self, path):
+        fd, tmp_path = tempfile.mkstemp(dir=self.scratch, suffix=os.path.splitext(path)[1])
+        os.close(fd)
+        return tmp_path
+
+    def download(self, path):
+        """Copy ``path`` into a scratch file and return its name; the caller removes it."""
+        tmp_path = self.temp_file(path)
+        try:
+            self.client.download_file(self.bucket, self.key(path), tmp_path, Config=self.transfer)
+        except ClientError as e:
+            os.remove(tmp_path)
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise FileNotFoundError(path)
+            raise
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return tmp_path
+
+    @contextmanager
+    def fetch(self, path):
+        tmp_path = self.download(path)
+        try:
+            yield tmp_path
+        finally:
+            os.remove(tmp_path)
+
+    @contextmanager
+    def writer(self, path):
+        tmp_path = self.temp_file(path)
+        try:
+            yield tmp_path
+            self.put_file(path, tmp_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def claim(self, path):
+        try:
+            self.client.put_object(Bucket=self.bucket, Key=self.key(path), Body=b'', IfNoneMatch='*')
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict', '412'):
+                return False
+            raise
+
+    def put_file(self, path, local_file):
+        extra = {}
+        mimetype = mimetypes.guess_type(path)[0]
+        if mimetype:
+            extra['ContentType'] = mimetype
+        self.client.upload_file(local_file, self.bucket, self.key(path), ExtraArgs=extra, Config=self.transfer)
+        os.remove(local_file)
+
+    def put_bytes(self, path, data):
+        extra = {}
+        mimetype = mimetypes.guess_type(path)[0]
+        if mimetype:
+            extra['ContentType'] = mimetype
+        self.client.put_object(Bucket=self.bucket, Key=self.key(path), Body=data, **extra)
+
+    def rename(self, old, new):
+        if IndexService.folder_exists(old):
+            self._rename_tree(old, new)
+            return
+        try:
+            self.client.copy({'Bucket': self.bucket, 'Key': self.key(old)}, self.bucket, self.key(new),
+                             Config=self.transfer)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise FileNotFoundError(old)
+            raise
+        self.remove(old)
+
+    def _rename_tree(self, old, new):
+        keys = self._list_keys(old)
+        for key in keys:
+            self.client.copy({'Bucket': self.bucket, 'Key': key}, self.bucket,
+                             self.key(new) + key[len(self.key(old)):], Config=self.transfer)
+        self._delete_keys(keys)
+
+    def remove(self, path):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(path))
+
+    def rmtree(self, folder):
+        self._delete_keys(self._list_keys(folder))
+
+    def _list_keys(self, folder):
+        paginator = self.client.get_paginator('list_objects_v2')
+        return [obj['Key'] for page in paginator.paginate(Bucket=self.bucket, Prefix=self.key(folder) + '/')
+                for obj in page.get('Contents', [])]
+
+    def _delete_keys(self, keys):
+        for start in range(0, len(keys), DELETE_BATCH):
+            self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': key} for key in keys[start:start + DELETE_BATCH]], 'Quiet': True})
+
+    def url(self, path):
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': self.key(path)}, ExpiresIn=self.expires)
+
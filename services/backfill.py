@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import mimetypes
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from flask import current_app
+from services.index import IndexService
+from services.thumbs import ThumbnailService
+from services.thumb_queue import ThumbnailQueue, _render_in_pool
+from services.metrics import Metrics
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two progress reports
+PROGRESS_INTERVAL = 1.0
+
+
+def _lower_priority(niceness):
+    """Pool initializer: yield CPU (and, with the CFQ/BFQ schedulers, disk) to the app."""
+    if niceness:
+        os.nice(niceness)
+
+
+class ThumbnailBackfill:
+    """Regenerate the thumbnails of a whole tree, e.g. after a migration or a
+    change of THUMBNAIL_SIZE/THUMBNAIL_FORMAT (``flask thumbs backfill``).
+
+    Originals whose thumbnail is missing or older than the original are
+    rendered on a process pool, bypassing the queue. With ``force`` every
+    thumbnail written before the run started counts as stale; the start time is
+    kept in a state file next to the index until a run finishes without
+    failures, so an interrupted forced run resumes where it stopped instead of
+    starting over. At most ``max_inflight`` originals are open at a time and
+    ``rate`` caps the files per second, to keep the I/O bearable on a live box.
+    """
+
+    @staticmethod
+    def state_path():
+        return os.path.join(os.path.dirname(IndexService.db_path()), '.thumb-backfill.json')
+
+    @staticmethod
+    def scan(folder='', since=None):
+        """List ``(path, size)`` of the originals below ``folder`` that need a thumbnail.
+
+        A thumbnail is stale when its mtime is older than the original's, or
+        than ``since`` if given. Returns ``(stale, fresh_count)``.
+        """
+        root = current_app.config['UPLOAD_FOLDER']
+        allowed = set(current_app.config['ALLOWED_TYPES'])
+        extension = ThumbnailService.thumbnail_extension()
+        stale, fresh = [], 0
+        pending = [folder]
+        while pending:
+            current = pending.pop()
+            full_path = os.path.join(root, current) if current else root
+            files, subfolders, thumbs = [], [], {}
+            try:
+                with os.scandir(full_path) as entries:
+                    for entry in entries:
+                        name = entry.name
+                        if name == '.thumbs':
+                            thumbs = ThumbnailBackfill._thumb_mtimes(entry.path)
+                        elif name.startswith('.') or name.endswith('.json'):
+                            continue
+                        elif entry.is_dir():
+                            subfolders.append(name)
+                        elif entry.is_file() and mimetypes.guess_type(name)[0] in allowed:
+                            files.append(entry)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in sorted(files, key=lambda e: e.name):
+                try:
+                    stats = entry.stat()
+                except FileNotFoundError:
+                    continue  # Removed while scanning
+                thumb_mtime = thumbs.get(os.path.splitext(entry.name)[0] + extension)
+                if thumb_mtime is not None and thumb_mtime >= max(stats.st_mtime, since or 0):
+                    fresh += 1
+                else:
+                    stale.append(('/'.join(filter(None, [current, entry.name])), stats.st_size))
+            pending.extend('/'.join(filter(None, [current, name])) for name in sorted(subfolders, reverse=True))
+        return stale, fresh
+
+    @staticmethod
+    def _thumb_mtimes(thumbs_dir):
+        mtimes = {}
+        try:
+            with os.scandir(thumbs_dir) as entries:
+                for entry in entries:
+                    try:
+                        mtimes[entry.name] = entry.stat().st_mtime
+                    except FileNotFoundError:
+                        continue
+        except OSError as e:
+            logger.warning(f"Could not read thumbnail directory {thumbs_dir}: {e}")
+        return mtimes
+
+    @staticmethod
+    def run(folder='', force=False, workers=None, max_inflight=None, rate=0, niceness=10, progress=None):
+        """Render every stale thumbnail below ``folder``.
+
+        ``progress`` is called with the running totals at most every
+        PROGRESS_INTERVAL seconds and once at the end. Returns the totals:
+        ``total``, ``fresh``, ``done``, ``rendered``, ``failed``, ``bytes`` (originals read)
+        and ``seconds``.
+        """
+        config = current_app.config
+        workers = workers or os.cpu_count() or 1
+        max_inflight = max_inflight or workers * 2
+        folder = folder.strip('/')
+        since = ThumbnailBackfill._start(folder) if force else None
+
+        stale, fresh = ThumbnailBackfill.scan(folder, since)
+        totals = {'total': len(stale), 'fresh': fresh, 'done': 0, 'rendered': 0, 'failed': 0,
+                  'bytes': 0, 'seconds': 0.0}
+        logger.info(f"Thumbnail backfill of '{folder or '/'}': {len(stale)} stale, {fresh} up to date")
+        started = time.monotonic()
+        if stale:
+            ThumbnailBackfill._render(stale, totals, workers, max_inflight, rate, niceness, progress, started)
+        totals['seconds'] = time.monotonic() - started
+        if progress is not None:
+            progress(totals)
+        Metrics.maybe_flush(config, force=True)
+
+        if force and not totals['failed']:
+            try:
+                os.remove(ThumbnailBackfill.state_path())
+            except FileNotFoundError:
+                pass
+        logger.info(f"Thumbnail backfill finished: {totals['rendered']} rendered, "
+                    f"{totals['failed']} failed in {totals['seconds']:.1f}s")
+        return totals
+
+    @staticmethod
+    def _start(folder):
+        """Start time of the forced run over ``folder``: the unfinished one's, or now.
+
+        Taken from the state file's mtime, so it compares with thumbnail mtimes
+        on the same clock.
+        """
+        state_path = ThumbnailBackfill.state_path()
+        config = current_app.config
+        state = {'folder': folder, 'size': list(config['THUMBNAIL_SIZE']), 'format': config['THUMBNAIL_FORMAT']}
+        try:
+            with open(state_path) as f:
+                if json.load(f) == state:
+                    since = os.stat(state_path).st_mtime
+                    logger.info(f"Resuming the thumbnail backfill started at {time.ctime(since)}")
+                    return since
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable backfill state {state_path}: {e}")
+        os.makedirs(os.path.dirname(state_path), exist_ok=True)
+        with open(state_path, 'w') as f:
+            json.dump(state, f)
+        return os.stat(state_path).st_mtime
+
+    @staticmethod
+    def _render(stale, totals, workers, max_inflight, rate, niceness, progress, started):
+        config = current_app.config
+        root = config['UPLOAD_FOLDER']
+        size = config['THUMBNAIL_SIZE']
+        encoding = ThumbnailService.encoding_options()
+        pool = ProcessPoolExecutor(max_workers=min(workers, len(stale)), initializer=_lower_priority,
+                                   initargs=(niceness,), mp_context=multiprocessing.get_context('spawn'))
+        inflight = {}
+        jobs = iter(stale)
+        submitted = 0
+        last_report = started
+        try:
+            while True:
+                for path, original_size in jobs:
+                    if rate:
+                        # Spread the submissions evenly over time
+                        delay = started + submitted / rate - time.monotonic()
+                        if delay > 0:
+                            time.sleep(delay)
+                    thumb_path = ThumbnailQueue.thumb_relative_path(path)
+                    future = pool.submit(_render_in_pool, os.path.join(root, path),
+                                         os.path.join(root, thumb_path), size, encoding)
+                    inflight[future] = (path, original_size)
+                    submitted += 1
+                    if len(inflight) >= max_inflight:
+                        break
+                if not inflight:
+                    break
+
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, original_size = inflight.pop(future)
+                    totals['done'] += 1
+                    totals['bytes'] += original_size
+                    error = future.exception()
+                    if error is None:
+                        placeholder, metrics = future.result()
+                        ThumbnailQueue.complete(path, placeholder)
+                        Metrics.merge(metrics)
+                        totals['rendered'] += 1
+                    elif isinstance(error, FileNotFoundError):
+                        continue  # Deleted since the scan
+                    else:
+                        totals['failed'] += 1
+                        IndexService.set_thumb_status(path, 'failed')
+                        logger.error(f"Thumbnail backfill failed for {path}: {error}")
+
+                now = time.monotonic()
+                if progress is not None and now - last_report >= PROGRESS_INTERVAL:
+                    totals['seconds'] = now - started
+                    progress(totals)
+                    last_report = now
+                Metrics.maybe_flush(config)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
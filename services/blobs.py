@@ -0,0 +1,247 @@
+import os
+import time
+import uuid
+import hashlib
+import tempfile
+from flask import current_app
+from services.index import IndexService, file_version
+from services.thumbs import ThumbnailService
+import logging
+
+logger = logging.getLogger(__name__)
+
+READ_BLOCK = 1024 * 1024
+
+
+class BlobStore:
+    """Content-addressed store for originals (DEDUP_STORAGE=true).
+
+    Every original is stored once under UPLOAD_FOLDER/.blobs/objects/ by its
+    SHA-256; folder entries are hard links to the blob, so serving, listing,
+    renaming and deleting work on them like on plain files. The link count is
+    the reference count: deleting an entry (or a whole folder with rmtree) only
+    drops a link, and ``gc`` removes blobs nobody links to any more.
+    Thumbnails are shared per hash in .blobs/thumbs/.
+    """
+
+    @staticmethod
+    def enabled():
+        return current_app.config['DEDUP_STORAGE']
+
+    @staticmethod
+    def root():
+        return os.path.join(current_app.config['UPLOAD_FOLDER'], '.blobs')
+
+    @staticmethod
+    def blob_path(sha256):
+        return os.path.join(BlobStore.root(), 'objects', sha256[:2], sha256)
+
+    @staticmethod
+    def thumb_path(sha256):
+        return os.path.join(BlobStore.root(), 'thumbs', sha256[:2],
+                            sha256 + ThumbnailService.thumbnail_extension())
+
+    # ------------------------------------------------------------------
+    # Ingest
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def ingest_stream(stream):
+        """Copy an upload stream into the store, hashing it on the way. Returns the SHA-256."""
+        tmp_dir = os.path.join(BlobStore.root(), 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            os.fchmod(fd, 0o644)
+            digest = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as out:
+                for block in iter(lambda: stream.read(READ_BLOCK), b''):
+                    digest.update(block)
+                    out.write(block)
+            return BlobStore._adopt(tmp_path, digest.hexdigest())
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    @staticmethod
+    def ingest_file(path, sha256=None):
+        """Move a file that is already on disk (same filesystem) into the store.
+
+        Pass ``sha256`` when it is already known and verified; otherwise the
+        file is hashed once.
+        """
+        if not sha256:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(READ_BLOCK), b''):
+                    digest.update(block)
+            sha256 = digest.hexdigest()
+        os.chmod(path, 0o644)
+        return BlobStore._adopt(path, sha256.lower())
+
+    @staticmethod
+    def _adopt(tmp_path, sha256):
+        target = BlobStore.blob_path(sha256)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(tmp_path, target)
+            logger.debug(f"New blob {sha256}")
+        except FileExistsError:
+            # Already stored. chmod only bumps the ctime, which keeps gc away from
+            # a blob that was unreferenced until now (mtime, and the ETag, stay)
+            os.chmod(target, 0o644)
+            logger.info(f"Deduplicated upload: blob {sha256} already stored")
+        os.remove(tmp_path)
+        return sha256
+
+    @staticmethod
+    def link(sha256, path):
+        """Point ``path`` at a blob; replaces a placeholder left by NamingService.reserve."""
+        tmp_path = os.path.join(os.path.dirname(path), f".tmp-{uuid.uuid4().hex}")
+        os.link(BlobStore.blob_path(sha256), tmp_path)
+        try:
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    # ------------------------------------------------------------------
+    # Shared thumbnails
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def hashes_for(paths):
+        """``{path: sha256}`` for indexed originals that live in the store."""
+        if not IndexService.enabled() or not paths:
+            return {}
+        conn = IndexService.connect()
+        hashes = {}
+        for start in range(0, len(paths), 500):
+            batch = paths[start:start + 500]
+            hashes.update((row['path'], row['sha256']) for row in conn.execute(
+                f"SELECT path, sha256 FROM files WHERE sha256 IS NOT NULL "
+                f"AND path IN ({', '.join('?' for _ in batch)})", batch))
+        return hashes
+
+    @staticmethod
+    def link_thumbnails(paths):
+        """Reuse the shared thumbnail where one exists; returns the paths that got one."""
+        upload_folder = current_app.config['UPLOAD_FOLDER']
+        linked = []
+        for path, sha256 in BlobStore.hashes_for(paths).items():
+            shared = BlobStore.thumb_path(sha256)
+            if not os.path.exists(shared):
+                continue
+            thumb = ThumbnailService.thumbnail_path_for(os.path.join(upload_folder, path))
+            tmp_path = os.path.join(os.path.dirname(thumb), f".tmp-{uuid.uuid4().hex}")
+            try:
+                os.makedirs(os.path.dirname(thumb), exist_ok=True)
+                os.link(shared, tmp_path)
+                os.replace(tmp_path, thumb)
+            except OSError as e:
+                logger.warning(f"Could not reuse shared thumbnail for {path}: {e}")
+                continue
+            placeholder = BlobStore.placeholder_for(sha256)
+            st = os.stat(thumb)
+            version = file_version(st.st_mtime, st.st_size)
+            # storage imports this module
+            from services.storage import StorageService
+            StorageService.update_sidecar(path, dict(placeholder or {}, thumb_version=version))
+            IndexService.set_thumb(path, ThumbnailService.thumbnail_path_for(path).replace('\\', '/'),
+                                   placeholder=placeholder, version=version)
+            linked.append(path)
+        return linked
+
+    @staticmethod
+    def placeholder_for(sha256):
+        """Placeholder of another copy of the same content, as ThumbnailService.placeholder returns it."""
+        row = IndexService.connect().execute(
+            'SELECT placeholder, color FROM files WHERE sha256 = ? AND placeholder IS NOT NULL LIMIT 1',
+            (sha256,)).fetchone()
+        return {'placeholder': row['placeholder'], 'color': row['color']} if row else None
+
+    @staticmethod
+    def share_thumbnails(paths):
+        """Publish freshly generated thumbnails so later copies of the same content reuse them."""
+        upload_folder = current_app.config['UPLOAD_FOLDER']
+        for path, sha256 in BlobStore.hashes_for(paths).items():
+            shared = BlobStore.thumb_path(sha256)
+            thumb = ThumbnailService.thumbnail_path_for(os.path.join(upload_folder, path))
+            tmp_path = f"{shared}.tmp-{uuid.uuid4().hex}"
+            try:
+                if os.path.samefile(thumb, shared):
+                    continue
+            except FileNotFoundError:
+                pass
+            try:
+                os.makedirs(os.path.dirname(shared), exist_ok=True)
+                # Replaces an older thumbnail of the same content (thumbs backfill)
+                os.link(thumb, tmp_path)
+                os.replace(tmp_path, shared)
+            except OSError as e:
+                logger.warning(f"Could not share thumbnail of {path}: {e}")
+                try:
+                    os.remove(tmp_path)
+                except FileNotFoundError:
+                    pass
+
+    # ------------------------------------------------------------------
+    # Maintenance
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def stats():
+        """Blob count, stored bytes, bytes saved by deduplication and unreferenced blobs."""
+        stats = {'blobs': 0, 'bytes': 0, 'saved_bytes': 0, 'unreferenced': 0}
+        for _, st in BlobStore._walk('objects'):
+            stats['blobs'] += 1
+            stats['bytes'] += st.st_size
+            references = st.st_nlink - 1
+            if references == 0:
+                stats['unreferenced'] += 1
+            stats['saved_bytes'] += st.st_size * max(0, references - 1)
+        return stats
+
+    @staticmethod
+    def gc(dry_run=False):
+        """Remove blobs (and shared thumbnails) no folder entry links to any more.
+
+        Blobs touched within BLOB_GC_GRACE seconds are kept: they may belong to
+        an upload that is being linked right now. Returns ``(count, bytes)``.
+        """
+        cutoff = time.time() - current_app.config['BLOB_GC_GRACE']
+        removed, freed = 0, 0
+        for path, st in BlobStore._walk('objects'):
+            if st.st_nlink > 1 or st.st_ctime > cutoff:
+                continue
+            if not dry_run:
+                os.remove(path)
+            removed += 1
+            freed += st.st_size
+        live = {os.path.basename(path) for path, _ in BlobStore._walk('objects')}
+        for path, _ in BlobStore._walk('thumbs'):
+            # A shared thumbnail outlives its blob only until the next gc
+            if os.path.splitext(os.path.basename(path))[0] not in live and not dry_run:
+                os.remove(path)
+        logger.info(f"Blob gc: {removed} blobs ({freed} bytes) {'would be ' if dry_run else ''}removed")
+        return removed, freed
+
+    @staticmethod
+    def _walk(kind):
+        base = os.path.join(BlobStore.root(), kind)
+        try:
+            shards = list(os.scandir(base))
+        except FileNotFoundError:
+            return
+        for shard in shards:
+            if not shard.is_dir():
+                continue
+            with os.scandir(shard.path) as entries:
+                for entry in entries:
+                    try:
+                        yield entry.path, entry.stat()
+                    except FileNotFoundError:
+                        continue
@@ -0,0 +1,347 @@
+import os
+import json
+import uuid
+import fcntl
+import tempfile
+from pathlib import Path
+from werkzeug.utils import secure_filename
+from flask import current_app
+from services.index import IndexService
+from services.thumb_queue import ThumbnailQueue
+from services.replication import ReplicationQueue
+from services.thumbs import ThumbnailService
+from services.renditions import RenditionService
+from services.backends import storage_backend
+import logging
+
+logger = logging.getLogger(__name__)
+
+OPERATIONS = ('delete', 'move', 'rename')
+
+
+class BulkService:
+    """Delete, move and rename many files and folders in one call.
+
+    Every source and target directory is listed once, so the existence checks
+    for originals, thumbnails and sidecars cost no syscalls of their own, and
+    only the renames/removals that are actually needed are planned. The plan is
+    written to a journal in UPLOAD_FOLDER/.journal/ and fsynced before the
+    first file is touched. Every step is idempotent, so after a crash the
+    journal is simply replayed (``recover``) and the original, its thumbnail,
+    its sidecar and the index end up consistent.
+    """
+
+    @staticmethod
+    def journal_dir():
+        return os.path.join(current_app.config['UPLOAD_FOLDER'], '.journal')
+
+    @staticmethod
+    def apply(operations):
+        """Run ``operations`` (``{'op', 'path', 'to'|'name'}``); returns one result per operation, in order."""
+        if not isinstance(operations, list) or not operations:
+            raise ValueError("Operations required")
+        limit = current_app.config['BULK_MAX_OPERATIONS']
+        if len(operations) > limit:
+            raise ValueError(f"At most {limit} operations per request")
+
+        results, items = BulkService._plan(operations)
+        if items:
+            fd = BulkService._write_journal(items)
+            try:
+                failures = BulkService._execute(items)
+                os.remove(os.path.join(BulkService.journal_dir(), f"{items[0]['journal']}.json"))
+            finally:
+                os.close(fd)
+            for item in items:
+                result = results[item['index']]
+                if item['index'] in failures:
+                    result.update(status='error', error=failures[item['index']])
+                else:
+                    result['status'] = 'ok'
+        logger.info(f"Bulk operations: {sum(r['status'] == 'ok' for r in results)} of {len(results)} succeeded")
+        return results
+
+    @staticmethod
+    def recover():
+        """Roll forward journals left behind by an interrupted ``apply``. Returns the number replayed."""
+        directory = BulkService.journal_dir()
+        try:
+            names = [name for name in os.listdir(directory) if name.endswith('.json')]
+        except FileNotFoundError:
+            return 0
+        replayed = 0
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                try:
+                    # Held by a running apply (or another worker's recovery)
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                if os.fstat(fd).st_nlink == 0:
+                    continue
+                with os.fdopen(os.dup(fd)) as f:
+                    items = json.load(f)
+                failures = BulkService._execute(items)
+                for index, error in failures.items():
+                    logger.warning(f"Journal {name}: operation {index} could not be replayed: {error}")
+                os.remove(path)
+                replayed += 1
+                logger.info(f"Rolled forward journal {name} ({len(items)} operations)")
+            except Exception as e:
+                logger.error(f"Error replaying journal {name}: {str(e)}")
+            finally:
+                os.close(fd)
+        return replayed
+
+    @staticmethod
+    def init_app(app):
+        with app.app_context():
+            try:
+                BulkService.recover()
+            except Exception as e:
+                logger.warning(f"Journal recovery failed: {e}")
+
+    # ------------------------------------------------------------------
+    # Planning
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _plan(operations):
+        backend = storage_backend()
+        journal = uuid.uuid4().hex
+        listings = {}
+        touched = set()
+        results, items = [], []
+
+        def listing(folder):
+            """Names in a folder (name -> is_dir) and in its .thumbs/, one listing each."""
+            if folder not in listings:
+                listings[folder] = backend.listdir(folder)
+            return listings[folder]
+
+        for index, operation in enumerate(operations):
+            operation = operation if isinstance(operation, dict) else {}
+            path = str(operation.get('path') or '').strip().strip('/')
+            result = {'index': index, 'op': operation.get('op'), 'path': path}
+            results.append(result)
+            try:
+                item = BulkService._plan_one(operation, path, listing, touched)
+            except (ValueError, FileNotFoundError, FileExistsError, NotADirectoryError) as e:
+                result.update(status='error', error=str(e))
+                continue
+            item.update(index=index, journal=journal)
+            if item['index_change'].get('new'):
+                result['new_path'] = item['index_change']['new']
+            items.append(item)
+        return results, items
+
+    @staticmethod
+    def _plan_one(operation, path, listing, touched):
+        op = operation.get('op')
+        if op not in OPERATIONS:
+            raise ValueError(f"Unknown operation: {op}")
+        if not path or '..' in path.split('/'):
+            raise ValueError("Invalid path")
+        if BulkService._overlaps(path, touched):
+            raise ValueError("Path is already affected by another operation in this request")
+
+        folder, name = path.rpartition('/')[::2]
+        entries, thumbs = listing(folder)
+        if name not in entries or name.startswith('.'):
+            raise FileNotFoundError(f"Not found: {path}")
+        is_dir = entries[name]
+
+        if op == 'delete':
+            target_folder, new_name = None, None
+        elif op == 'rename':
+            target_folder = folder
+            new_name = secure_filename(str(operation.get('name') or ''))
+            if not new_name:
+                raise ValueError("Invalid new name")
+        else:
+            target_folder = str(operation.get('to') or '').strip().strip('/')
+            if '..' in target_folder.split('/'):
+                raise ValueError("Invalid target folder")
+            if is_dir and (target_folder == path or target_folder.startswith(path + '/')):
+                raise ValueError("Cannot move a folder into itself")
+            if BulkService._overlaps(target_folder, touched, ancestors_only=True):
+                raise ValueError("Target folder is affected by another operation in this request")
+            new_name = name
+
+        taken = target_thumbs = None
+        if target_folder is not None:
+            parent, _, leaf = target_folder.rpartition('/')
+            if target_folder and not listing(parent)[0].get(leaf):
+                raise NotADirectoryError(f"Target folder not found: {target_folder}")
+            if op == 'move' and target_folder == folder:
+                raise ValueError("Already in the target folder")
+            taken, target_thumbs = listing(target_folder)
+
+        if is_dir:
+            item = BulkService._plan_folder(op, folder, name, target_folder, new_name, taken)
+        else:
+            item = BulkService._plan_file(op, folder, name, thumbs, entries, target_folder, new_name,
+                                          taken, target_thumbs)
+        touched.add(path)
+        if item['index_change'].get('new'):
+            touched.add(item['index_change']['new'])
+        return item
+
+    @staticmethod
+    def _plan_file(op, folder, name, thumbs, entries, target_folder, new_name, taken, target_thumbs):
+        path = _join(folder, name)
+        thumb_name = ThumbnailService.thumbnail_name(name)
+        sidecar = Path(name).stem + '.json'
+        has_thumb = thumb_name in thumbs
+        has_sidecar = sidecar in entries and sidecar != name
+
+        if op == 'delete':
+            steps = [['remove', path]]
+            if has_thumb:
+                steps.append(['remove', _join(folder, '.thumbs', thumb_name)])
+            if has_sidecar:
+                steps.append(['remove', _join(folder, sidecar)])
+            return {'steps': steps, 'index_change': {'op': 'remove_file', 'path': path}}
+
+        # Reserve a name whose thumbnail and sidecar are free in the target as well
+        stem, ext = os.path.splitext(new_name)
+        candidate, counter = new_name, 0
+        while (candidate in taken or Path(candidate).stem + '.json' in taken
+               or ThumbnailService.thumbnail_name(candidate) in target_thumbs):
+            counter += 1
+            candidate = f"{stem}-{counter}{ext}"
+        new_sidecar = Path(candidate).stem + '.json'
+        new_thumb_name = ThumbnailService.thumbnail_name(candidate)
+        taken[candidate] = False
+        taken[new_sidecar] = False
+        target_thumbs.add(new_thumb_name)
+
+        new_path = _join(target_folder, candidate)
+        steps = [['rename', path, new_path]]
+        new_thumb = None
+        if has_thumb:
+            new_thumb = _join(target_folder, '.thumbs', new_thumb_name)
+            steps.append(['rename', _join(folder, '.thumbs', thumb_name), new_thumb])
+        if has_sidecar:
+            steps.append(['rename', _join(folder, sidecar), _join(target_folder, new_sidecar)])
+        return {'steps': steps,
+                'index_change': {'op': 'move_file', 'old': path, 'new': new_path, 'thumb': new_thumb}}
+
+    @staticmethod
+    def _plan_folder(op, folder, name, target_folder, new_name, taken):
+        path = _join(folder, name)
+        if op == 'delete':
+            return {'steps': [['rmtree', path]], 'index_change': {'op': 'remove_folder', 'path': path}}
+        if new_name.startswith('.') or new_name in taken:
+            raise FileExistsError(f"Folder '{new_name}' already exists in the target")
+        taken[new_name] = True
+        new_path = _join(target_folder, new_name)
+        return {'steps': [['rename', path, new_path]],
+                'index_change': {'op': 'move_folder', 'old': path, 'new': new_path}}
+
+    @staticmethod
+    def _overlaps(path, touched, ancestors_only=False):
+        """Whether ``path``, one of its ancestors or (unless ``ancestors_only``) a descendant was touched."""
+        parts = path.split('/') if path else []
+        if any('/'.join(parts[:i]) in touched for i in range(1, len(parts) + 1)):
+            return True
+        return not ancestors_only and any(other.startswith(path + '/') for other in touched)
+
+    # ------------------------------------------------------------------
+    # Journal and execution
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _write_journal(items):
+        """Durably write the plan; returns the open, locked journal descriptor."""
+        directory = BulkService.journal_dir()
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            # The lock follows the inode through the rename, so recovery never races the live run
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, json.dumps(items).encode('utf-8'))
+            os.fsync(fd)
+            os.replace(tmp_path, os.path.join(directory, f"{items[0]['journal']}.json"))
+            dir_fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except Exception:
+            os.close(fd)
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        return fd
+
+    @staticmethod
+    def _execute(items):
+        """Apply the planned steps, then all index changes in one go. Returns ``{index: error}``."""
+        backend = storage_backend()
+        failures = {}
+        changes = []
+        for item in items:
+            # The first step handles the original; once it is done the index must follow,
+            # even if a thumbnail or sidecar step fails afterwards
+            original_done = False
+            for position, step in enumerate(item['steps']):
+                try:
+                    BulkService._run_step(backend, step)
+                except OSError as e:
+                    logger.error(f"Bulk step {step} failed: {str(e)}")
+                    failures[item['index']] = str(e)
+                    if position == 0:
+                        break
+                    continue
+                original_done = original_done or position == 0
+            if original_done:
+                changes.append(item['index_change'])
+
+        IndexService.apply_changes(changes)
+        ThumbnailQueue.apply_changes(changes)
+        ReplicationQueue.apply_changes(changes)
+        RenditionService.discard_many([change.get('old') or change['path'] for change in changes
+                                       if change['op'] != 'move_folder'])
+        for change in changes:
+            if change['op'] in ('move_folder', 'remove_folder'):
+                RenditionService.discard_folder(change.get('old') or change['path'])
+        return failures
+
+    @staticmethod
+    def _run_step(backend, step):
+        action, *paths = step
+        source = paths[0]
+        if action == 'rmtree':
+            try:
+                backend.rmtree(source)
+            except FileNotFoundError:
+                pass
+            return
+        if action == 'rename':
+            target = paths[1]
+            if backend.exists(target):
+                if backend.exists(source):
+                    # Never replace something that appeared at the target since planning
+                    raise FileExistsError(f"Target already exists: {paths[1]}")
+                logger.debug(f"Bulk step {step} already applied")
+                return
+        try:
+            if action == 'remove':
+                backend.remove(source)
+            else:
+                backend.rename(source, target)
+        except FileNotFoundError:
+            # Already done by an earlier (interrupted) run of the same journal
+            logger.debug(f"Bulk step {step} already applied")
+
+
+def _join(*parts):
+    return '/'.join(part for part in parts if part)
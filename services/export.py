@@ -0,0 +1,300 @@
+import os
+import time
+import zlib
+import struct
+import hashlib
+from pathlib import Path, PurePosixPath
+from flask import current_app
+from services.index import IndexService
+from services.backends import storage_backend
+from services import scanner
+import logging
+
+logger = logging.getLogger(__name__)
+
+READ_BLOCK = 1024 * 1024
+
+# Values that no longer fit the classic 32/16-bit ZIP fields
+ZIP32_LIMIT = 0xFFFFFFFF
+ZIP32_ENTRIES = 0xFFFF
+
+# Bit 3: CRC and sizes follow the data (data descriptor); bit 11: UTF-8 names
+FLAGS = 0x0808
+# Made by Unix, spec version 4.5; regular file, rw-r--r--
+VERSION_MADE_BY = (3 << 8) | 45
+EXTERNAL_ATTRIBUTES = 0o100644 << 16
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+DESCRIPTOR_32 = struct.Struct('<IIII')
+DESCRIPTOR_64 = struct.Struct('<IIQQ')
+END_64 = struct.Struct('<IQHHIIQQQQ')
+END_64_LOCATOR = struct.Struct('<IIQI')
+END = struct.Struct('<IHHHHIIH')
+
+
+class ExportEntry:
+    """One original in an archive, with its place in the byte stream."""
+
+    __slots__ = ('path', 'name', 'size', 'mtime', 'crc32', 'offset', 'zip64')
+
+    def __init__(self, path, name, size, mtime, crc32):
+        self.path = path
+        self.name = name.encode('utf-8')
+        self.size = size
+        self.mtime = mtime
+        self.crc32 = crc32
+        self.offset = 0
+        # Sizes that do not fit 32 bits go into a ZIP64 extra field (and 64-bit descriptor)
+        self.zip64 = size >= ZIP32_LIMIT
+
+    @property
+    def header_size(self):
+        return LOCAL_HEADER.size + len(self.name) + (20 if self.zip64 else 0)
+
+    @property
+    def descriptor_size(self):
+        return DESCRIPTOR_64.size if self.zip64 else DESCRIPTOR_32.size
+
+
+class ZipStream:
+    """A ZIP archive (stored entries, data descriptors, ZIP64 where needed) that is
+    never materialized: its layout follows from names and sizes alone, so the
+    total size is known up front and any byte range can be produced on its own.
+
+    CRC-32s are the only thing that needs the data. They are computed while the
+    data streams by (and remembered in the index), so a complete download reads
+    every original once; a resumed one reads the skipped part of an original
+    only if its CRC is not known yet.
+    """
+
+    def __init__(self, entries, filename='export.zip'):
+        self.entries = entries
+        self.filename = filename
+        offset = 0
+        for entry in entries:
+            entry.offset = offset
+            offset += entry.header_size + entry.size + entry.descriptor_size
+        self.central_offset = offset
+        self.central_size = sum(CENTRAL_HEADER.size + len(entry.name) + len(self._central_extra(entry))
+                                for entry in entries)
+        self.zip64_end = (len(entries) >= ZIP32_ENTRIES or self.central_offset >= ZIP32_LIMIT
+                          or self.central_size >= ZIP32_LIMIT)
+        self.size = (self.central_offset + self.central_size
+                     + (END_64.size + END_64_LOCATOR.size if self.zip64_end else 0) + END.size)
+
+    @property
+    def etag(self):
+        """Strong validator: changes whenever a name, size or modification time does."""
+        digest = hashlib.sha1()
+        for entry in self.entries:
+            digest.update(b'%s\0%s\0%d\0%r\n' % (entry.path.encode(), entry.name, entry.size, entry.mtime))
+        return digest.hexdigest()[:24]
+
+    @property
+    def last_modified(self):
+        return max((entry.mtime for entry in self.entries), default=time.time())
+
+    def stream(self, start=0, stop=None):
+        """Yield the bytes ``start`` up to ``stop`` (exclusive) in blocks of at most READ_BLOCK."""
+        try:
+            yield from self._stream(start, self.size if stop is None else stop)
+        except Exception as e:
+            logger.error(f"ZIP export aborted: {e}")
+            raise
+
+    def _stream(self, start, stop):
+        position = 0
+        for entry in self.entries:
+            segments = ((self._local_header, entry.header_size), (None, entry.size),
+                        (self._descriptor, entry.descriptor_size))
+            for render, length in segments:
+                if position < stop and position + length > start:
+                    low, high = max(start - position, 0), min(stop - position, length)
+                    if render is None:
+                        yield from self._data(entry, low, high)
+                    else:
+                        yield render(entry)[low:high]
+                position += length
+            if position >= stop:
+                return
+        tail_start = max(start - position, 0)
+        if tail_start < stop - position:
+            for entry in self.entries:
+                if entry.crc32 is None:
+                    self._checksum(entry)
+            tail = self._tail()[tail_start:stop - position]
+            for offset in range(0, len(tail), READ_BLOCK):
+                yield tail[offset:offset + READ_BLOCK]
+
+    def _data(self, entry, low, high):
+        """Yield ``entry``'s data from ``low`` to ``high``, computing its CRC on the way if needed."""
+        backend = storage_backend()
+        known = entry.crc32 is not None
+        crc = 0
+        read = 0
+        with backend.open(entry.path) as f:
+            if known and low and backend.is_local:
+                f.seek(low)
+                read = low
+            while read < (high if known else entry.size):
+                block = f.read(min(READ_BLOCK, entry.size - read))
+                if not block:
+                    raise IOError(f"{entry.path} is shorter than when the export started")
+                if not known:
+                    crc = zlib.crc32(block, crc)
+                if read + len(block) > low and read < high:
+                    yield block[max(low - read, 0):high - read]
+                read += len(block)
+        if not known:
+            entry.crc32 = crc
+            IndexService.set_crc32(entry.path, entry.mtime, entry.size, crc)
+
+    def _checksum(self, entry):
+        for _ in self._data(entry, 0, 0):
+            pass
+
+    def _local_header(self, entry):
+        time_field, date_field = _dos_datetime(entry.mtime)
+        extra = struct.pack('<HHQQ', 0x0001, 16, entry.size, entry.size) if entry.zip64 else b''
+        size = ZIP32_LIMIT if entry.zip64 else entry.size
+        return LOCAL_HEADER.pack(0x04034b50, 45 if entry.zip64 else 20, FLAGS, 0, time_field, date_field,
+                                 0, size, size, len(entry.name), len(extra)) + entry.name + extra
+
+    def _descriptor(self, entry):
+        if entry.crc32 is None:
+            # Resuming behind this entry's data
+            self._checksum(entry)
+        if entry.zip64:
+            return DESCRIPTOR_64.pack(0x08074b50, entry.crc32, entry.size, entry.size)
+        return DESCRIPTOR_32.pack(0x08074b50, entry.crc32, entry.size, entry.size)
+
+    @staticmethod
+    def _central_extra(entry):
+        fields = []
+        if entry.zip64:
+            fields += [entry.size, entry.size]
+        if entry.offset >= ZIP32_LIMIT:
+            fields.append(entry.offset)
+        if not fields:
+            return b''
+        return struct.pack(f'<HH{len(fields)}Q', 0x0001, 8 * len(fields), *fields)
+
+    def _tail(self):
+        """Central directory and end records."""
+        parts = []
+        for entry in self.entries:
+            time_field, date_field = _dos_datetime(entry.mtime)
+            extra = self._central_extra(entry)
+            size = ZIP32_LIMIT if entry.zip64 else entry.size
+            parts.append(CENTRAL_HEADER.pack(
+                0x02014b50, VERSION_MADE_BY, 45 if extra else 20, FLAGS, 0, time_field, date_field,
+                entry.crc32, size, size, len(entry.name), len(extra), 0, 0, 0, EXTERNAL_ATTRIBUTES,
+                min(entry.offset, ZIP32_LIMIT)) + entry.name + extra)
+        count = len(self.entries)
+        if self.zip64_end:
+            end_64_offset = self.central_offset + self.central_size
+            parts.append(END_64.pack(0x06064b50, END_64.size - 12, VERSION_MADE_BY, 45, 0, 0,
+                                     count, count, self.central_size, self.central_offset))
+            parts.append(END_64_LOCATOR.pack(0x07064b50, 0, end_64_offset, 1))
+        parts.append(END.pack(0x06054b50, 0, 0, min(count, ZIP32_ENTRIES), min(count, ZIP32_ENTRIES),
+                              min(self.central_size, ZIP32_LIMIT), min(self.central_offset, ZIP32_LIMIT), 0))
+        return b''.join(parts)
+
+
+class ExportService:
+    @staticmethod
+    def build(paths, recursive=True):
+        """ZipStream of folders and/or files (storage paths).
+
+        A folder contributes its files (with ``recursive``, its whole subtree)
+        below a directory named like the folder; the root folder and single
+        files go to the top level. Archive names are the sidecar ``display_name``
+        with the stored file's extension, made unique per directory.
+        Raises FileNotFoundError for unknown paths and ValueError for invalid
+        ones or more than EXPORT_MAX_FILES files. Nothing is read yet: the
+        originals are streamed by ``ZipStream.stream``.
+        """
+        max_files = current_app.config['EXPORT_MAX_FILES']
+        entries = []
+        taken = set()
+        filename = 'export.zip'
+        for path in paths:
+            path = (path or '').strip('/')
+            if '..' in path.split('/'):
+                raise ValueError(f"Invalid path: {path}")
+            rows, base = ExportService._rows(path, recursive)
+            for row in rows:
+                relative_folder = row['folder'][len(base):].strip('/') if base is not None else ''
+                if base is not None and path:
+                    relative_folder = '/'.join(filter(None, [PurePosixPath(path).name, relative_folder]))
+                name = ExportService._unique(relative_folder, ExportService._archive_name(row), taken)
+                entries.append(ExportEntry(row['path'], name, row['size'], row['mtime'], row['crc32']))
+                if len(entries) > max_files:
+                    raise ValueError(f"Too many files for one export (limit {max_files})")
+            if len(paths) == 1 and path:
+                # Named after the exported folder (or file)
+                filename = (PurePosixPath(path).name if base is not None else PurePosixPath(path).stem) + '.zip'
+        return ZipStream(entries, filename)
+
+    @staticmethod
+    def _rows(path, recursive):
+        """``(rows, folder)`` for a folder, ``(rows, None)`` for a single file."""
+        if IndexService.enabled():
+            if IndexService.folder_exists(path):
+                return IndexService.export_rows(path, recursive), path
+            row = IndexService.file_row(path) if path else None
+            if row is None:
+                raise FileNotFoundError(f"Not found: {path}")
+            return [row], None
+
+        # Without the index: read the directories (local storage only)
+        root = current_app.config['UPLOAD_FOLDER']
+        full_path = os.path.join(root, path) if path else root
+        if os.path.isdir(full_path):
+            rows = []
+            if recursive:
+                for folder, _, records in scanner.walk_tree(full_path):
+                    rows += [dict(record, path='/'.join(filter(None, [path, record['path']])),
+                                  folder='/'.join(filter(None, [path, folder])), crc32=None)
+                             for record in records]
+            else:
+                rows = [dict(record, crc32=None) for record in scanner.scan_directory(full_path, path)[1]]
+            rows.sort(key=lambda row: (row['folder'], row['name']))
+            return rows, path
+        if not os.path.isfile(full_path):
+            raise FileNotFoundError(f"Not found: {path}")
+        folder, name = os.path.split(path)
+        sidecar = os.path.join(os.path.dirname(full_path), Path(name).stem + '.json')
+        metadata = IndexService.read_sidecar(sidecar) if os.path.exists(sidecar) else {}
+        record = scanner.file_record(folder, name, os.stat(full_path), metadata, set())
+        return [dict(record, crc32=None)], None
+
+    @staticmethod
+    def _archive_name(row):
+        stem = row['display_name'] or Path(row['original_name'] or row['name']).stem
+        # Names from sidecars are user input: no path separators or control characters
+        stem = ''.join(c for c in stem.replace('/', '_').replace('\\', '_') if c >= ' ').strip(' .')
+        return (stem or Path(row['name']).stem) + (Path(row['name']).suffix or Path(row['original_name'] or '').suffix)
+
+    @staticmethod
+    def _unique(folder, name, taken):
+        """``folder/name``, with ' (2)', ' (3)', ... before the extension if already used
+        (case-insensitively, for case-insensitive file systems)."""
+        stem, suffix = os.path.splitext(name)
+        candidate, counter = name, 1
+        while '/'.join(filter(None, [folder, candidate])).lower() in taken:
+            counter += 1
+            candidate = f"{stem} ({counter}){suffix}"
+        full_name = '/'.join(filter(None, [folder, candidate]))
+        taken.add(full_name.lower())
+        return full_name
+
+
+def _dos_datetime(mtime):
+    """``(time, date)`` fields of a ZIP header, in local time like zip(1) writes them."""
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
@@ -1,36 +1,249 @@
-
 import os
-import boto3
+import hashlib
+import mimetypes
+import threading
+from datetime import timezone
 from flask import current_app
 import logging
 
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+except ImportError:  # Optional dependency, only needed with S3_REPLICATION or STORAGE_BACKEND=s3
+    boto3 = None
+
 logger = logging.getLogger(__name__)
 
+# Objects per DeleteObjects request (S3 maximum)
+DELETE_BATCH = 1000
+
+
 class ExternalStorageService:
-    """Optional external storage for critical data persistence"""
-    
+    """Optional external storage for critical data persistence.
+
+    Originals and their sidecars are mirrored to an S3 bucket (or MinIO / any
+    S3-compatible service via AWS_ENDPOINT_URL) under S3_PREFIX + their path
+    below UPLOAD_FOLDER. Thumbnails and renditions are not replicated; they can
+    be regenerated. One client per process is shared by all threads, so TCP and
+    TLS connections are pooled; files above S3_MULTIPART_THRESHOLD_MB are sent
+    as parallel multipart uploads. Changes are queued in ReplicationQueue
+    (services/replication.py) and sent by its background worker.
+    """
+
+    _lock = threading.Lock()
+    _client = None
+    _client_key = None
+
     @staticmethod
     def is_enabled():
-        return all([
-            os.getenv('AWS_ACCESS_KEY_ID'),
-            os.getenv('AWS_SECRET_ACCESS_KEY'),
-            os.getenv('AWS_BUCKET_NAME')
-        ])
-    
+        return bool(current_app.config['S3_REPLICATION'] and current_app.config['AWS_BUCKET_NAME'])
+
+    @staticmethod
+    def check_available():
+        if boto3 is None:
+            raise RuntimeError("S3 support requires boto3 (pip install boto3)")
+
+    @staticmethod
+    def client():
+        """Process-wide S3 client; boto3 clients are thread-safe, sessions are not."""
+        ExternalStorageService.check_available()
+        config = current_app.config
+        key = (os.getpid(), config['AWS_ENDPOINT_URL'], config['AWS_REGION'])
+        if ExternalStorageService._client is not None and ExternalStorageService._client_key == key:
+            return ExternalStorageService._client
+        with ExternalStorageService._lock:
+            if ExternalStorageService._client is None or ExternalStorageService._client_key != key:
+                # Enough pooled connections for every worker thread's multipart parts
+                pool_size = config['S3_REPLICATION_WORKERS'] * config['S3_TRANSFER_CONCURRENCY'] + 2
+                session = boto3.session.Session()
+                ExternalStorageService._client = session.client(
+                    's3',
+                    endpoint_url=config['AWS_ENDPOINT_URL'] or None,
+                    region_name=config['AWS_REGION'] or None,
+                    config=BotoConfig(max_pool_connections=pool_size, tcp_keepalive=True,
+                                      retries={'max_attempts': 5, 'mode': 'adaptive'}))
+                ExternalStorageService._client_key = key
+        return ExternalStorageService._client
+
+    @staticmethod
+    def transfer_config():
+        config = current_app.config
+        return TransferConfig(multipart_threshold=config['S3_MULTIPART_THRESHOLD_MB'] * 1024 * 1024,
+                              multipart_chunksize=config['S3_MULTIPART_CHUNK_MB'] * 1024 * 1024,
+                              max_concurrency=config['S3_TRANSFER_CONCURRENCY'],
+                              use_threads=True)
+
+    @staticmethod
+    def key_for(relative_path):
+        return current_app.config['S3_PREFIX'] + relative_path
+
     @staticmethod
     def backup_to_s3(local_path, s3_key):
         """Backup file to S3 for extra persistence"""
         if not ExternalStorageService.is_enabled():
             return False
-            
+
         try:
-            s3_client = boto3.client('s3')
-            bucket = os.getenv('AWS_BUCKET_NAME')
-            
-            s3_client.upload_file(local_path, bucket, s3_key)
+            ExternalStorageService._upload(local_path, s3_key)
             logger.info(f"File backed up to S3: {s3_key}")
             return True
-            
+
         except Exception as e:
             logger.error(f"S3 backup failed: {str(e)}")
             return False
+
+    @staticmethod
+    def _upload(local_path, s3_key):
+        extra = {}
+        mimetype = mimetypes.guess_type(local_path)[0]
+        if mimetype:
+            extra['ContentType'] = mimetype
+        ExternalStorageService.client().upload_file(
+            local_path, current_app.config['AWS_BUCKET_NAME'], s3_key,
+            ExtraArgs=extra, Config=ExternalStorageService.transfer_config())
+
+    # ------------------------------------------------------------------
+    # Replication (called by ReplicationWorker)
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def replicate_file(path, source=None):
+        """Make the object for ``path`` match the local file: upload, server-side copy or delete.
+
+        ``source`` is the path the file had before a rename; if its object still
+        holds the same content it is copied inside the bucket instead of being
+        uploaded again. Returns the action taken.
+        """
+        full_path = os.path.join(current_app.config['UPLOAD_FOLDER'], path)
+        key = ExternalStorageService.key_for(path)
+        try:
+            size = os.stat(full_path).st_size
+        except FileNotFoundError:
+            size = None
+
+        if size is None or not os.path.isfile(full_path):
+            from services.replication import ReplicationQueue
+            if ReplicationQueue.is_protected(path):
+                # A queued rename still copies from this object; it is deleted after that
+                return 'kept'
+            ExternalStorageService.client().delete_object(Bucket=current_app.config['AWS_BUCKET_NAME'], Key=key)
+            return 'deleted'
+
+        if source and ExternalStorageService._copy_if_identical(source, key, full_path, size):
+            return 'copied'
+        ExternalStorageService._upload(full_path, key)
+        return 'uploaded'
+
+    @staticmethod
+    def _copy_if_identical(source, key, full_path, size):
+        client = ExternalStorageService.client()
+        bucket = current_app.config['AWS_BUCKET_NAME']
+        source_key = ExternalStorageService.key_for(source)
+        try:
+            head = client.head_object(Bucket=bucket, Key=source_key)
+        except ClientError:
+            return False
+        if head['ContentLength'] != size or head['ETag'].strip('"') != ExternalStorageService.local_etag(full_path, size):
+            return False
+        try:
+            client.copy({'Bucket': bucket, 'Key': source_key}, bucket, key,
+                        Config=ExternalStorageService.transfer_config())
+        except ClientError:
+            # Deleted in the meantime
+            return False
+        return True
+
+    @staticmethod
+    def local_etag(full_path, size):
+        """The ETag S3 reports for this file when uploaded with our TransferConfig.
+
+        MD5 of the content for single-part uploads; for multipart uploads the
+        MD5 of the concatenated part digests plus ``-<parts>``.
+        """
+        chunk = current_app.config['S3_MULTIPART_CHUNK_MB'] * 1024 * 1024
+        multipart = size >= current_app.config['S3_MULTIPART_THRESHOLD_MB'] * 1024 * 1024
+        whole = hashlib.md5(usedforsecurity=False)
+        parts = []
+        with open(full_path, 'rb') as f:
+            for block in iter(lambda: f.read(chunk), b''):
+                if multipart:
+                    parts.append(hashlib.md5(block, usedforsecurity=False).digest())
+                else:
+                    whole.update(block)
+        if not multipart:
+            return whole.hexdigest()
+        return f"{hashlib.md5(b''.join(parts), usedforsecurity=False).hexdigest()}-{len(parts)}"
+
+    @staticmethod
+    def list_objects(folder):
+        """``{path: (size, etag, last_modified timestamp)}`` of every object below ``folder`` ('' = all)."""
+        prefix = current_app.config['S3_PREFIX']
+        paginator = ExternalStorageService.client().get_paginator('list_objects_v2')
+        objects = {}
+        for page in paginator.paginate(Bucket=current_app.config['AWS_BUCKET_NAME'],
+                                       Prefix=prefix + (folder + '/' if folder else '')):
+            for obj in page.get('Contents', []):
+                modified = obj['LastModified'].replace(tzinfo=obj['LastModified'].tzinfo or timezone.utc)
+                objects[obj['Key'][len(prefix):]] = (obj['Size'], obj['ETag'].strip('"'), modified.timestamp())
+        return objects
+
+    @staticmethod
+    def local_files(folder):
+        """``{path: os.stat_result}`` of the originals and sidecars below ``folder`` ('' = all)."""
+        root = current_app.config['UPLOAD_FOLDER']
+        base = os.path.join(root, folder) if folder else root
+        files = {}
+        pending = [base]
+        while pending:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue  # .thumbs, .blobs, .index.sqlite3, ...
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.is_file():
+                        files[os.path.relpath(entry.path, root).replace(os.sep, '/')] = entry.stat()
+        return files
+
+    @staticmethod
+    def plan_sync(folder, source=None):
+        """Compare a local subtree with the bucket.
+
+        Returns ``(transfers, orphans, unchanged)``: ``(path, source path)``
+        pairs to replicate, object paths without a local file, and the number
+        of objects already up to date. Objects are compared by size first; the
+        (expensive) local ETag is only computed when the file changed after
+        the object was written.
+        """
+        root = current_app.config['UPLOAD_FOLDER']
+        try:
+            local = ExternalStorageService.local_files(folder)
+        except FileNotFoundError:
+            local = {}
+        remote = ExternalStorageService.list_objects(folder)
+
+        transfers, unchanged = [], 0
+        for path, stats in local.items():
+            obj = remote.get(path)
+            if obj is not None and obj[0] == stats.st_size and (
+                    obj[2] >= stats.st_mtime
+                    or obj[1] == ExternalStorageService.local_etag(os.path.join(root, path), stats.st_size)):
+                unchanged += 1
+                continue
+            transfers.append((path, source + path[len(folder):] if source else None))
+        orphans = [path for path in remote if path not in local]
+        return transfers, orphans, unchanged
+
+    @staticmethod
+    def delete_objects(paths):
+        client = ExternalStorageService.client()
+        bucket = current_app.config['AWS_BUCKET_NAME']
+        for start in range(0, len(paths), DELETE_BATCH):
+            batch = paths[start:start + DELETE_BATCH]
+            response = client.delete_objects(Bucket=bucket, Delete={
+                'Objects': [{'Key': ExternalStorageService.key_for(path)} for path in batch], 'Quiet': True})
+            errors = response.get('Errors', [])
+            if errors:
+                raise RuntimeError(f"S3 delete failed for {len(errors)} objects: {errors[0].get('Message')}")
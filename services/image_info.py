@@ -0,0 +1,97 @@
+from datetime import datetime
+from PIL import Image, ExifTags
+import logging
+
+logger = logging.getLogger(__name__)
+
+# EXIF orientation -> transpose that makes the image upright (as ImageOps.exif_transpose)
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+# Orientations whose stored image is turned by 90 degrees (width and height swap)
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)
+
+# Sidecar keys written by extract()
+SIDECAR_KEYS = ('width', 'height', 'orientation', 'taken_at', 'camera')
+
+
+class ImageInfoService:
+    """Facts about an image read from its header: no pixel data is decoded.
+
+    ``Image.open`` only parses the header, and the EXIF block sits in it, so
+    this costs one small read per file (done right after the upload is
+    written, while the data is still in the page cache).
+    """
+
+    @staticmethod
+    def extract(path):
+        """Dict with ``width``/``height`` (upright, i.e. as displayed), ``orientation``,
+        ``taken_at`` (ISO capture time, camera local time) and ``camera``; keys
+        that are unknown are left out. Never raises: a file Pillow cannot read
+        yields ``{}``.
+        """
+        try:
+            with Image.open(path) as img:
+                exif = img.getexif()
+                orientation = ImageInfoService.orientation(img, exif)
+                width, height = ImageInfoService.upright_size(img, orientation)
+                info = {'width': width, 'height': height}
+                if orientation != 1:
+                    info['orientation'] = orientation
+                taken_at = ImageInfoService._taken_at(exif)
+                if taken_at:
+                    info['taken_at'] = taken_at
+                camera = ImageInfoService._camera(exif)
+                if camera:
+                    info['camera'] = camera
+                return info
+        except Exception as e:
+            logger.warning(f"Could not read image metadata of {path}: {e}")
+            return {}
+
+    @staticmethod
+    def orientation(img, exif=None):
+        """EXIF orientation (1-8) of an opened image; 1 if it has none."""
+        try:
+            exif = img.getexif() if exif is None else exif
+            orientation = int(exif.get(ExifTags.Base.Orientation, 1))
+        except (TypeError, ValueError, SyntaxError):
+            return 1
+        return orientation if orientation in ORIENTATION_TRANSPOSE else 1
+
+    @staticmethod
+    def upright_size(img, orientation=None):
+        """``(width, height)`` of the image as displayed, after applying its orientation."""
+        orientation = ImageInfoService.orientation(img) if orientation is None else orientation
+        width, height = img.size
+        return (height, width) if orientation in ROTATED_ORIENTATIONS else (width, height)
+
+    @staticmethod
+    def _taken_at(exif):
+        """DateTimeOriginal (else DateTimeDigitized) as ISO 8601, like upload_date."""
+        sub_ifd = exif.get_ifd(ExifTags.IFD.Exif)
+        for tag in (ExifTags.Base.DateTimeOriginal, ExifTags.Base.DateTimeDigitized):
+            value = sub_ifd.get(tag)
+            if not isinstance(value, str):
+                continue
+            try:
+                # Cameras write '2024:05:01 14:03:22' (sometimes NUL-padded or blank)
+                return datetime.strptime(value.strip('\x00 ')[:19], '%Y:%m:%d %H:%M:%S').isoformat()
+            except ValueError:
+                continue
+        return None
+
+    @staticmethod
+    def _camera(exif):
+        make = str(exif.get(ExifTags.Base.Make) or '').strip('\x00 ')
+        model = str(exif.get(ExifTags.Base.Model) or '').strip('\x00 ')
+        # Most models repeat the make ('Canon' + 'Canon EOS R5')
+        if make and model.lower().startswith(make.split()[0].lower()):
+            return model
+        return ' '.join(filter(None, [make, model])) or None
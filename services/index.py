@@ -0,0 +1,970 @@
+import os
+import json
+import base64
+import re
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+from flask import current_app
+from services.metrics import Metrics
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Each entry upgrades the schema by one version (tracked in PRAGMA user_version).
+MIGRATIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        folder TEXT NOT NULL,
+        name TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        thumb TEXT,
+        display_name TEXT,
+        original_name TEXT,
+        upload_date TEXT,
+        mimetype TEXT
+    );
+    CREATE INDEX IF NOT EXISTS files_folder_name ON files(folder, name);
+    CREATE TABLE IF NOT EXISTS folders (
+        path TEXT PRIMARY KEY,
+        parent TEXT NOT NULL,
+        name TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS folders_parent_name ON folders(parent, name);
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    """,
+    # Keyset pagination: one index per sort key so a page never scans the folder
+    """
+    CREATE INDEX IF NOT EXISTS files_folder_name_nocase ON files(folder, name COLLATE NOCASE, name);
+    CREATE INDEX IF NOT EXISTS files_folder_mtime ON files(folder, mtime, name);
+    CREATE INDEX IF NOT EXISTS files_folder_size ON files(folder, size, name);
+    CREATE INDEX IF NOT EXISTS files_folder_upload_date ON files(folder, upload_date, name);
+    CREATE INDEX IF NOT EXISTS folders_parent_name_nocase ON folders(parent, name COLLATE NOCASE, name);
+    """,
+    # Background thumbnail generation: per-file status plus the persistent job queue
+    """
+    ALTER TABLE files ADD COLUMN thumb_status TEXT;
+    UPDATE files SET thumb_status = 'ready' WHERE thumb IS NOT NULL;
+    CREATE TABLE IF NOT EXISTS thumb_jobs (
+        path TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        created_at REAL NOT NULL,
+        claimed_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS thumb_jobs_status ON thumb_jobs(status, created_at);
+    """,
+    # On-demand renditions: cache bookkeeping for LRU eviction
+    """
+    CREATE TABLE IF NOT EXISTS renditions (
+        key TEXT PRIMARY KEY,
+        original TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        last_access REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS renditions_original ON renditions(original);
+    CREATE INDEX IF NOT EXISTS renditions_last_access ON renditions(last_access);
+    """,
+    # Chunked uploads: sessions and acknowledged chunks
+    """
+    CREATE TABLE IF NOT EXISTS upload_sessions (
+        id TEXT PRIMARY KEY,
+        folder TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        mimetype TEXT,
+        size INTEGER NOT NULL,
+        chunk_size INTEGER NOT NULL,
+        sha256 TEXT,
+        status TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS upload_chunks (
+        session_id TEXT NOT NULL,
+        number INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        sha256 TEXT NOT NULL,
+        PRIMARY KEY (session_id, number)
+    );
+    """,
+    # Collision-free naming: highest suffix handed out per folder and requested name
+    """
+    CREATE TABLE IF NOT EXISTS name_counters (
+        folder TEXT NOT NULL,
+        name TEXT NOT NULL,
+        counter INTEGER NOT NULL,
+        PRIMARY KEY (folder, name)
+    );
+    """,
+    # Deduplicating blob store: content hash of each original
+    """
+    ALTER TABLE files ADD COLUMN sha256 TEXT;
+    CREATE INDEX IF NOT EXISTS files_sha256 ON files(sha256);
+    """,
+    # Search: FTS5 over the names and folder (kept in sync by triggers) plus
+    # tree-wide indexes for the sort keys and filters
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(
+        name, original_name, display_name, folder,
+        content='files', content_rowid='rowid',
+        tokenize='unicode61 remove_diacritics 2'
+    );
+    CREATE TRIGGER IF NOT EXISTS files_fts_insert AFTER INSERT ON files BEGIN
+        INSERT INTO files_fts (rowid, name, original_name, display_name, folder)
+        VALUES (new.rowid, new.name, new.original_name, new.display_name, new.folder);
+    END;
+    CREATE TRIGGER IF NOT EXISTS files_fts_delete AFTER DELETE ON files BEGIN
+        INSERT INTO files_fts (files_fts, rowid, name, original_name, display_name, folder)
+        VALUES ('delete', old.rowid, old.name, old.original_name, old.display_name, old.folder);
+    END;
+    CREATE TRIGGER IF NOT EXISTS files_fts_update AFTER UPDATE OF name, original_name, display_name, folder ON files BEGIN
+        INSERT INTO files_fts (files_fts, rowid, name, original_name, display_name, folder)
+        VALUES ('delete', old.rowid, old.name, old.original_name, old.display_name, old.folder);
+        INSERT INTO files_fts (rowid, name, original_name, display_name, folder)
+        VALUES (new.rowid, new.name, new.original_name, new.display_name, new.folder);
+    END;
+    INSERT INTO files_fts (files_fts) VALUES ('rebuild');
+    CREATE INDEX IF NOT EXISTS files_name_nocase ON files(name COLLATE NOCASE, path);
+    CREATE INDEX IF NOT EXISTS files_upload_date ON files(upload_date, path);
+    CREATE INDEX IF NOT EXISTS files_size ON files(size, path);
+    CREATE INDEX IF NOT EXISTS files_mtime ON files(mtime, path);
+    CREATE INDEX IF NOT EXISTS files_mimetype_upload_date ON files(mimetype, upload_date, path);
+    """,
+    # Folder tree: file count and bytes directly in each folder (rows only for
+    # folders that hold files), kept up to date by triggers, plus a version that
+    # every change to files or folders bumps (the /api/tree ETag)
+    """
+    CREATE TABLE IF NOT EXISTS folder_stats (
+        path TEXT PRIMARY KEY,
+        file_count INTEGER NOT NULL,
+        total_bytes INTEGER NOT NULL
+    );
+    INSERT OR REPLACE INTO folder_stats (path, file_count, total_bytes)
+    SELECT folder, count(*), sum(size) FROM files GROUP BY folder;
+    INSERT OR REPLACE INTO meta (key, value) VALUES ('tree_version', abs(random() % 1000000000));
+    CREATE TRIGGER IF NOT EXISTS files_stats_insert AFTER INSERT ON files BEGIN
+        INSERT INTO folder_stats (path, file_count, total_bytes) VALUES (new.folder, 1, new.size)
+        ON CONFLICT (path) DO UPDATE SET file_count = file_count + 1, total_bytes = total_bytes + excluded.total_bytes;
+        UPDATE meta SET value = value + 1 WHERE key = 'tree_version';
+    END;
+    CREATE TRIGGER IF NOT EXISTS files_stats_delete AFTER DELETE ON files BEGIN
+        UPDATE folder_stats SET file_count = file_count - 1, total_bytes = total_bytes - old.size WHERE path = old.folder;
+        DELETE FROM folder_stats WHERE path = old.folder AND file_count <= 0;
+        UPDATE meta SET value = value + 1 WHERE key = 'tree_version';
+    END;
+    CREATE TRIGGER IF NOT EXISTS files_stats_update AFTER UPDATE OF folder, size ON files BEGIN
+        UPDATE folder_stats SET file_count = file_count - 1, total_bytes = total_bytes - old.size WHERE path = old.folder;
+        DELETE FROM folder_stats WHERE path = old.folder AND file_count <= 0;
+        INSERT INTO folder_stats (path, file_count, total_bytes) VALUES (new.folder, 1, new.size)
+        ON CONFLICT (path) DO UPDATE SET file_count = file_count + 1, total_bytes = total_bytes + excluded.total_bytes;
+        UPDATE meta SET value = value + 1 WHERE key = 'tree_version';
+    END;
+    CREATE TRIGGER IF NOT EXISTS folders_tree_insert AFTER INSERT ON folders BEGIN
+        UPDATE meta SET value = value + 1 WHERE key = 'tree_version';
+    END;
+    CREATE TRIGGER IF NOT EXISTS folders_tree_delete AFTER DELETE ON folders BEGIN
+        UPDATE meta SET value = value + 1 WHERE key = 'tree_version';
+    END;
+    CREATE TRIGGER IF NOT EXISTS folders_tree_update AFTER UPDATE ON folders BEGIN
+        UPDATE meta SET value = value + 1 WHERE key = 'tree_version';
+    END;
+    """,
+    # S3 replication outbox: paths (or subtrees) whose objects may be out of date
+    """
+    CREATE TABLE IF NOT EXISTS replication_jobs (
+        kind TEXT NOT NULL,
+        path TEXT NOT NULL,
+        source TEXT,
+        version INTEGER NOT NULL DEFAULT 1,
+        status TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        created_at REAL NOT NULL,
+        available_at REAL NOT NULL,
+        claimed_at REAL,
+        PRIMARY KEY (kind, path)
+    );
+    CREATE INDEX IF NOT EXISTS replication_jobs_due ON replication_jobs(status, available_at);
+    CREATE INDEX IF NOT EXISTS replication_jobs_source ON replication_jobs(kind, source) WHERE source IS NOT NULL;
+    """,
+    # Image header metadata (from the sidecar) and the capture date sort key, which
+    # falls back to the upload date for images without one
+    """
+    ALTER TABLE files ADD COLUMN width INTEGER;
+    ALTER TABLE files ADD COLUMN height INTEGER;
+    ALTER TABLE files ADD COLUMN taken_at TEXT;
+    ALTER TABLE files ADD COLUMN camera TEXT;
+    CREATE INDEX IF NOT EXISTS files_folder_taken_at ON files(folder, coalesce(taken_at, upload_date), name);
+    CREATE INDEX IF NOT EXISTS files_taken_at ON files(coalesce(taken_at, upload_date), path);
+    """,
+    # Inline placeholders (tiny image as data URI, dominant color) made with the thumbnail
+    """
+    ALTER TABLE files ADD COLUMN placeholder TEXT;
+    ALTER TABLE files ADD COLUMN color TEXT;
+    """,
+    # Per-folder thumbnail sprite sheets (see SpriteService). Every change to a
+    # folder's files bumps ``changes``; the sheet is current while ``built`` matches.
+    """
+    CREATE TABLE IF NOT EXISTS sprites (
+        folder TEXT PRIMARY KEY,
+        file TEXT,
+        version TEXT,
+        width INTEGER,
+        height INTEGER,
+        cell_width INTEGER,
+        cell_height INTEGER,
+        cells TEXT NOT NULL DEFAULT '{}',
+        changes INTEGER NOT NULL DEFAULT 0,
+        built INTEGER NOT NULL DEFAULT -1
+    );
+    CREATE TRIGGER IF NOT EXISTS files_sprites_insert AFTER INSERT ON files BEGIN
+        UPDATE sprites SET changes = changes + 1 WHERE folder = new.folder;
+    END;
+    CREATE TRIGGER IF NOT EXISTS files_sprites_delete AFTER DELETE ON files BEGIN
+        UPDATE sprites SET changes = changes + 1 WHERE folder = old.folder;
+    END;
+    CREATE TRIGGER IF NOT EXISTS files_sprites_update
+    AFTER UPDATE OF name, folder, thumb, thumb_status, mtime, size ON files BEGIN
+        UPDATE sprites SET changes = changes + 1 WHERE folder IN (old.folder, new.folder);
+    END;
+    """,
+    # CRC-32 of the original, computed by the ZIP export and kept until the row is rewritten
+    """
+    ALTER TABLE files ADD COLUMN crc32 INTEGER;
+    """,
+    # Version token of the thumbnail itself (its own mtime/size), for ?v= on thumbnail URLs
+    """
+    ALTER TABLE files ADD COLUMN thumb_version TEXT;
+    """,
+]
+
+# Sort key -> SQL expression of the primary key column. Ties are broken by the
+# (unique per folder) binary name so the order is total and cursors are stable.
+SORT_KEYS = {
+    'name': 'name COLLATE NOCASE',
+    'mtime': 'mtime',
+    'size': 'size',
+    'upload_date': 'upload_date',
+    'taken_at': 'coalesce(taken_at, upload_date)',
+}
+
+# Whole-tree indexes (migration 8) that serve SORT_KEYS in search without a sort step
+SEARCH_SORT_INDEXES = {
+    'name': 'files_name_nocase',
+    'mtime': 'files_mtime',
+    'size': 'files_size',
+    'upload_date': 'files_upload_date',
+    'taken_at': 'files_taken_at',
+}
+
+# Up to this many text/folder matches, search fetches and sorts the rows
+SEARCH_SORT_THRESHOLD = 2000
+
+FILE_COLUMNS = ('path', 'folder', 'name', 'size', 'mtime', 'thumb', 'thumb_status',
+                'display_name', 'original_name', 'upload_date', 'mimetype', 'sha256',
+                'width', 'height', 'taken_at', 'camera', 'placeholder', 'color', 'thumb_version')
+
+
+def sort_value(row, sort):
+    """Value of SORT_KEYS[sort] for an index row or record (the position a cursor stores)."""
+    if sort == 'taken_at':
+        return row['taken_at'] or row['upload_date']
+    return row[sort]
+
+
+def _subtree_bounds(prefix):
+    """Key range covering every path strictly below ``prefix`` ('/' sorts just before '0')."""
+    return prefix + '/', prefix + '0'
+
+
+def _parent_of(path):
+    return path.rsplit('/', 1)[0] if '/' in path else ''
+
+
+def file_version(mtime, size):
+    """Short token that changes whenever an original is replaced; appended as
+    ``?v=`` to image URLs so they can be cached as immutable."""
+    return f"{int(mtime * 1000):x}{size:x}"
+
+
+def fts_query(text):
+    """Turn free text into an FTS5 query: every word must match as a prefix."""
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', text or ''))
+
+
+def rollup_tree(direct):
+    """Subtree totals from per-folder counts.
+
+    ``direct`` maps every folder path ('' is the root) to ``(file_count, bytes)``
+    of the files directly in it. Returns ``(totals, children)``: subtree
+    ``[file_count, bytes]`` per folder and the sorted child paths per folder.
+    """
+    totals = {path: list(counts) for path, counts in direct.items()}
+    totals.setdefault('', [0, 0])
+    children = {}
+    # Deepest first, so a folder's total is complete before it is added to its parent
+    for path in sorted(totals, key=lambda p: p.count('/'), reverse=True):
+        if not path:
+            continue
+        parent = _parent_of(path)
+        parent_totals = totals.setdefault(parent, [0, 0])
+        parent_totals[0] += totals[path][0]
+        parent_totals[1] += totals[path][1]
+        children.setdefault(parent, []).append(path)
+    for paths in children.values():
+        paths.sort(key=lambda p: (p.rsplit('/', 1)[-1].lower(), p))
+    return totals, children
+
+
+def tree_node(totals, children, path, depth):
+    """One /api/tree node with ``depth`` levels of children below it."""
+    file_count, total_bytes = totals.get(path, (0, 0))
+    node = {
+        'name': path.rsplit('/', 1)[-1],
+        'path': path,
+        'file_count': file_count,
+        'total_bytes': total_bytes,
+        'has_children': path in children,
+    }
+    if depth > 0 and path in children:
+        node['children'] = [tree_node(totals, children, child, depth - 1) for child in children[path]]
+    return node
+
+
+def encode_cursor(state):
+    raw = json.dumps(state, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        state = json.loads(raw)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(state, dict):
+        raise ValueError("Invalid cursor")
+    return state
+
+
+class IndexService:
+    """SQLite (WAL) index of files and folders below UPLOAD_FOLDER.
+
+    The sidecar JSON files stay the source of truth; the index mirrors them so
+    listings don't have to stat and open every entry on each request.
+    """
+
+    _local = threading.local()
+    _build_lock = threading.Lock()
+    _tree_cache = {}  # db path -> (tree_version, totals, children)
+
+    @staticmethod
+    def enabled():
+        return current_app.config.get('METADATA_INDEX', True)
+
+    @staticmethod
+    def db_path():
+        return current_app.config.get('INDEX_PATH') or os.path.join(
+            current_app.config['UPLOAD_FOLDER'], '.index.sqlite3')
+
+    @staticmethod
+    def connect(ensure_built=True):
+        """Return this thread's connection, creating and migrating the database on first use."""
+        db_path = IndexService.db_path()
+        connections = getattr(IndexService._local, 'connections', None)
+        # Connections must not be shared across a fork (gunicorn workers)
+        if connections is None or IndexService._local.pid != os.getpid():
+            connections = IndexService._local.connections = {}
+            IndexService._local.pid = os.getpid()
+
+        conn = connections.get(db_path)
+        if conn is None:
+            conn = IndexService._open(db_path)
+            connections[db_path] = conn
+            if ensure_built:
+                try:
+                    IndexService._ensure_built(conn)
+                except Exception:
+                    del connections[db_path]
+                    raise
+        return conn
+
+    @staticmethod
+    def _open(db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        try:
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            # INSERT OR REPLACE must fire the delete trigger that keeps files_fts in sync
+            conn.execute('PRAGMA recursive_triggers=ON')
+            IndexService._migrate(conn)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    @staticmethod
+    def _migrate(conn):
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= len(MIGRATIONS):
+            return
+        with IndexService._transaction(conn):
+            # Re-read under the write lock: another process may have migrated meanwhile
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for target, script in enumerate(MIGRATIONS[version:], start=version + 1):
+                statement = ''
+                for part in script.split(';'):
+                    statement += part + ';'
+                    # Trigger bodies contain ';' themselves: run only complete statements
+                    if sqlite3.complete_statement(statement):
+                        if statement.strip(' \n;'):
+                            conn.execute(statement)
+                        statement = ''
+                conn.execute(f'PRAGMA user_version = {target}')
+                logger.info(f"Index schema migrated to version {target}")
+
+    @staticmethod
+    def _ensure_built(conn):
+        """Populate an empty index from the existing tree the first time it is opened."""
+        if not IndexService.enabled():
+            return
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'built_at'").fetchone():
+            return
+        with IndexService._build_lock:
+            if not conn.execute("SELECT 1 FROM meta WHERE key = 'built_at'").fetchone():
+                IndexService.rebuild()
+
+    @staticmethod
+    def _transaction(conn):
+        return _Transaction(conn)
+
+    # ------------------------------------------------------------------
+    # Write paths (called from StorageService)
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def upsert_file(record):
+        """Insert or replace one file row. ``record`` uses the FILE_COLUMNS keys."""
+        IndexService.upsert_files([record])
+
+    @staticmethod
+    def upsert_files(records):
+        """Insert or replace several file rows in one transaction."""
+        if not IndexService.enabled() or not records:
+            return
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            for folder in {record['folder'] for record in records}:
+                IndexService._ensure_folder(conn, folder)
+            for record in records:
+                IndexService._write_file(conn, record)
+
+    @staticmethod
+    def remove_file(path):
+        if not IndexService.enabled():
+            return
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            conn.execute('DELETE FROM files WHERE path = ?', (path,))
+
+    @staticmethod
+    def rename_file(old_path, new_path, thumb=None):
+        if not IndexService.enabled():
+            return
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            conn.execute('UPDATE files SET path = ?, name = ?, thumb = ? WHERE path = ?',
+                         (new_path, new_path.rsplit('/', 1)[-1], thumb, old_path))
+
+    @staticmethod
+    def set_thumb(path, thumb, status='ready', placeholder=None, version=None):
+        """``placeholder`` is ThumbnailService.placeholder's dict; without one the stored one is kept.
+        ``version`` is the thumbnail's own file_version."""
+        if not IndexService.enabled():
+            return
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            if placeholder:
+                conn.execute('UPDATE files SET thumb = ?, thumb_status = ?, thumb_version = ?, placeholder = ?, '
+                             'color = ? WHERE path = ?',
+                             (thumb, status, version, placeholder['placeholder'], placeholder['color'], path))
+            else:
+                conn.execute('UPDATE files SET thumb = ?, thumb_status = ?, thumb_version = ? WHERE path = ?',
+                             (thumb, status, version, path))
+
+    @staticmethod
+    def set_thumb_status(path, status):
+        if not IndexService.enabled():
+            return
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            conn.execute('UPDATE files SET thumb_status = ? WHERE path = ?', (status, path))
+
+    @staticmethod
+    def add_folder(path):
+        if not IndexService.enabled():
+            return
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            IndexService._ensure_folder(conn, path)
+
+    @staticmethod
+    def remove_folder(path):
+        """Remove a folder with everything below it."""
+        if not IndexService.enabled():
+            return
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            IndexService._delete_subtree(conn, path)
+
+    @staticmethod
+    def rename_folder(old_path, new_path):
+        """Re-key a folder and its whole subtree."""
+        if not IndexService.enabled():
+            return
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            IndexService._move_subtree(conn, old_path, new_path)
+
+    @staticmethod
+    def apply_changes(changes):
+        """Apply a bulk operation's changes in one transaction.
+
+        ``changes`` holds dicts with ``op`` ``remove_file``/``remove_folder``/
+        ``add_folder`` (``path``), ``upsert_file`` (``record``) or ``move_file``
+        (``old``, ``new``, ``thumb``)/``move_folder`` (``old``, ``new``).
+        Re-applying the same changes is a no-op.
+        """
+        if not IndexService.enabled() or not changes:
+            return
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            for change in changes:
+                op = change['op']
+                if op == 'remove_file':
+                    conn.execute('DELETE FROM files WHERE path = ?', (change['path'],))
+                elif op == 'move_file':
+                    folder, _, name = change['new'].rpartition('/')
+                    IndexService._ensure_folder(conn, folder)
+                    conn.execute('UPDATE OR REPLACE files SET path = ?, folder = ?, name = ?, thumb = ? WHERE path = ?',
+                                 (change['new'], folder, name, change['thumb'], change['old']))
+                elif op == 'remove_folder':
+                    IndexService._delete_subtree(conn, change['path'])
+                elif op == 'move_folder':
+                    IndexService._move_subtree(conn, change['old'], change['new'])
+                elif op == 'add_folder':
+                    IndexService._ensure_folder(conn, change['path'])
+                elif op == 'upsert_file':
+                    IndexService._ensure_folder(conn, change['record']['folder'])
+                    IndexService._write_file(conn, change['record'])
+
+    @staticmethod
+    def _delete_subtree(conn, path):
+        low, high = _subtree_bounds(path)
+        conn.execute('DELETE FROM files WHERE folder = ? OR (folder > ? AND folder < ?)', (path, low, high))
+        conn.execute('DELETE FROM folders WHERE path = ? OR (path > ? AND path < ?)', (path, low, high))
+        conn.execute('DELETE FROM sprites WHERE folder = ? OR (folder > ? AND folder < ?)', (path, low, high))
+
+    @staticmethod
+    def _move_subtree(conn, old_path, new_path):
+        low, high = _subtree_bounds(old_path)
+        cut = len(old_path) + 1
+        IndexService._ensure_folder(conn, _parent_of(new_path))
+        conn.execute(
+            "UPDATE folders SET path = ? || substr(path, ?), "
+            "parent = CASE WHEN path = ? THEN ? ELSE ? || substr(parent, ?) END, "
+            "name = CASE WHEN path = ? THEN ? ELSE name END "
+            "WHERE path = ? OR (path > ? AND path < ?)",
+            (new_path, cut, old_path, _parent_of(new_path), new_path, cut,
+             old_path, new_path.rsplit('/', 1)[-1], old_path, low, high))
+        # Sprite sheets move with their folders (before the files, whose triggers mark them changed)
+        conn.execute(
+            "UPDATE sprites SET folder = ? || substr(folder, ?), "
+            "file = CASE WHEN file IS NULL THEN NULL ELSE ? || substr(file, ?) END "
+            "WHERE folder = ? OR (folder > ? AND folder < ?)",
+            (new_path, cut, new_path, cut, old_path, low, high))
+        conn.execute(
+            "UPDATE files SET path = ? || substr(path, ?), folder = ? || substr(folder, ?), "
+            "thumb = CASE WHEN thumb IS NULL THEN NULL ELSE ? || substr(thumb, ?) END "
+            "WHERE folder = ? OR (folder > ? AND folder < ?)",
+            (new_path, cut, new_path, cut, new_path, cut, old_path, low, high))
+
+    @staticmethod
+    def _ensure_folder(conn, path):
+        """Insert ``path`` and any missing ancestors into the folders table."""
+        while path:
+            cursor = conn.execute('INSERT OR IGNORE INTO folders (path, parent, name) VALUES (?, ?, ?)',
+                                  (path, _parent_of(path), path.rsplit('/', 1)[-1]))
+            if cursor.rowcount == 0:
+                break
+            path = _parent_of(path)
+
+    @staticmethod
+    def _write_file(conn, record):
+        conn.execute(
+            f"INSERT OR REPLACE INTO files ({', '.join(FILE_COLUMNS)}) "
+            f"VALUES ({', '.join('?' for _ in FILE_COLUMNS)})",
+            tuple(record.get(column) for column in FILE_COLUMNS))
+
+    # ------------------------------------------------------------------
+    # Read paths
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def folder_entries(folder):
+        """``({name: row}, {subfolder names})`` of one indexed folder; rows carry size, mtime, thumb_status."""
+        conn = IndexService.connect()
+        files = {row['name']: row for row in conn.execute(
+            'SELECT name, size, mtime, thumb_status FROM files WHERE folder = ?', (folder,))}
+        subfolders = {row['name'] for row in conn.execute('SELECT name FROM folders WHERE parent = ?', (folder,))}
+        return files, subfolders
+
+    @staticmethod
+    def export_rows(folder, recursive=True):
+        """Files directly in ``folder`` (or its whole subtree), ordered by folder and name,
+        with the columns the ZIP export needs."""
+        conn = IndexService.connect()
+        columns = 'path, folder, name, size, mtime, display_name, original_name, crc32'
+        if not recursive:
+            return conn.execute(f'SELECT {columns} FROM files WHERE folder = ? ORDER BY name', (folder,)).fetchall()
+        if not folder:
+            return conn.execute(f'SELECT {columns} FROM files ORDER BY folder, name').fetchall()
+        low, high = _subtree_bounds(folder)
+        return conn.execute(
+            f'SELECT {columns} FROM files WHERE folder = ? OR (folder > ? AND folder < ?) ORDER BY folder, name',
+            (folder, low, high)).fetchall()
+
+    @staticmethod
+    def file_row(path):
+        conn = IndexService.connect()
+        return conn.execute('SELECT * FROM files WHERE path = ?', (path,)).fetchone()
+
+    @staticmethod
+    def set_crc32(path, mtime, size, crc32):
+        """Remember the CRC-32 of an original, unless it changed since it was read."""
+        if not IndexService.enabled():
+            return
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            conn.execute('UPDATE files SET crc32 = ? WHERE path = ? AND mtime = ? AND size = ?',
+                         (crc32, path, mtime, size))
+
+    @staticmethod
+    def folder_exists(path):
+        if not path:
+            return True
+        conn = IndexService.connect()
+        return conn.execute('SELECT 1 FROM folders WHERE path = ?', (path,)).fetchone() is not None
+
+    @staticmethod
+    def list_folder(path):
+        """Return the directory and file entries of one folder in the list_files format."""
+        conn = IndexService.connect()
+        items = [IndexService._folder_item(row) for row in IndexService._query_folders(conn, path)]
+        items.extend(IndexService.row_to_item(row) for row in IndexService._query_files(conn, path))
+        return items
+
+    @staticmethod
+    def list_page(path, limit, cursor=None, sort='name', order='asc', prefix=None, mimetype=None,
+                  taken_from=None, taken_to=None):
+        """Return one page of a folder listing: directories first, then files.
+
+        Uses keyset pagination on (sort key, name), so the cost of a page only
+        depends on ``limit``. ``taken_from``/``taken_to`` (``taken_to``
+        exclusive) filter on the capture date, or the upload date where there
+        is none. Returns ``{'items': [...], 'next_cursor': str|None}``.
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Invalid sort key: {sort}")
+        if order not in ('asc', 'desc'):
+            raise ValueError(f"Invalid order: {order}")
+
+        state = decode_cursor(cursor) if cursor else {'phase': 'd'}
+        if state.get('sort', sort) != sort or state.get('order', order) != order:
+            raise ValueError("Cursor does not match sort order")
+
+        conn = IndexService.connect()
+        items = []
+        remaining = limit
+        after = state.get('after')
+
+        # Directories are only ordered by name and are skipped when filtering by mimetype or date
+        if state.get('phase') == 'd' and not (mimetype or taken_from or taken_to):
+            rows = IndexService._query_folders(conn, path, prefix=prefix, after=after, limit=remaining + 1)
+            if len(rows) > remaining:
+                rows = rows[:remaining]
+                items = [IndexService._folder_item(row) for row in rows]
+                return {'items': items, 'next_cursor': encode_cursor(
+                    {'phase': 'd', 'sort': sort, 'order': order, 'after': [rows[-1]['name']]})}
+            items = [IndexService._folder_item(row) for row in rows]
+            remaining -= len(rows)
+            after = None
+        elif state.get('phase') not in ('d', 'f'):
+            raise ValueError("Invalid cursor")
+
+        rows = IndexService._query_files(conn, path, sort=sort, order=order, prefix=prefix, mimetype=mimetype,
+                                         taken_from=taken_from, taken_to=taken_to, after=after,
+                                         limit=remaining + 1)
+        next_cursor = None
+        if len(rows) > remaining:
+            rows = rows[:remaining]
+            last = rows[-1] if rows else None
+            next_cursor = encode_cursor({
+                'phase': 'f', 'sort': sort, 'order': order,
+                'after': [sort_value(last, sort), last['name']] if last else None
+            })
+        items.extend(IndexService.row_to_item(row) for row in rows)
+        return {'items': items, 'next_cursor': next_cursor}
+
+    @staticmethod
+    def search(query=None, folder=None, mimetypes=None, date_from=None, date_to=None,
+               min_size=None, max_size=None, sort='upload_date', order='desc', limit=50, cursor=None,
+               taken_from=None, taken_to=None):
+        """Search files in the whole tree (or below ``folder``).
+
+        ``query`` is matched word by word as a prefix against the file name,
+        original name, display name and folder (FTS5); the other arguments
+        are range/equality filters (``date_to``/``taken_to`` are exclusive;
+        ``taken_*`` is the capture date, else the upload date). Paginated with
+        keyset cursors on (sort key, path) like ``list_page``.
+        Returns ``{'items': [...], 'next_cursor': str|None}``.
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Invalid sort key: {sort}")
+        if order not in ('asc', 'desc'):
+            raise ValueError(f"Invalid order: {order}")
+        state = decode_cursor(cursor) if cursor else {'sort': sort, 'order': order}
+        if state.get('sort') != sort or state.get('order') != order:
+            raise ValueError("Cursor does not match sort order")
+
+        conn = IndexService.connect()
+        conditions, params = [], []
+        # For text and folder filters SQLite fetches every candidate and sorts.
+        # When both have many candidates, walking the sort index is cheaper: it
+        # stops after one page, and rowid and path are checked in the index.
+        candidates = []
+        if query:
+            match = fts_query(query)
+            if not match:
+                return {'items': [], 'next_cursor': None}
+            conditions.append('rowid IN (SELECT rowid FROM files_fts WHERE files_fts MATCH ?)')
+            params.append(match)
+            candidates.append(conn.execute(
+                'SELECT count(*) FROM (SELECT 1 FROM files_fts WHERE files_fts MATCH ? LIMIT ?)',
+                (match, SEARCH_SORT_THRESHOLD + 1)).fetchone()[0])
+        if folder:
+            # The subtree is a path range, so it needs no folder lookups
+            low, high = _subtree_bounds(folder)
+            conditions.append('path > ? AND path < ?')
+            params.extend([low, high])
+            candidates.append(conn.execute(
+                'SELECT count(*) FROM (SELECT 1 FROM files WHERE path > ? AND path < ? LIMIT ?)',
+                (low, high, SEARCH_SORT_THRESHOLD + 1)).fetchone()[0])
+        indexed_by = ''
+        if candidates and min(candidates) > SEARCH_SORT_THRESHOLD:
+            indexed_by = f'INDEXED BY {SEARCH_SORT_INDEXES[sort]} '
+        if mimetypes:
+            conditions.append(f"mimetype IN ({', '.join('?' for _ in mimetypes)})")
+            params.extend(mimetypes)
+        taken = SORT_KEYS['taken_at']
+        for clause, value in (('upload_date >= ?', date_from), ('upload_date < ?', date_to),
+                              (f'{taken} >= ?', taken_from), (f'{taken} < ?', taken_to),
+                              ('size >= ?', min_size), ('size <= ?', max_size)):
+            if value is not None:
+                conditions.append(clause)
+                params.append(value)
+
+        sort_expr = SORT_KEYS[sort]
+        after = state.get('after')
+        if after:
+            op = '>' if order == 'asc' else '<'
+            conditions.append(f'({sort_expr} {op} ? OR ({sort_expr} = ? AND path {op} ?))')
+            params.extend([after[0], after[0], after[1]])
+        direction = 'ASC' if order == 'asc' else 'DESC'
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ''
+        rows = conn.execute(
+            f"SELECT * FROM files {indexed_by}{where}ORDER BY {sort_expr} {direction}, path {direction} LIMIT ?",
+            params + [limit + 1]).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor({'sort': sort, 'order': order,
+                                         'after': [sort_value(rows[-1], sort), rows[-1]['path']]})
+        return {'items': [IndexService.row_to_item(row) for row in rows], 'next_cursor': next_cursor}
+
+    @staticmethod
+    def _prefix_clause(prefix, conditions, params):
+        if prefix:
+            # Range scan instead of LIKE so that '%' and '_' in names need no escaping
+            conditions.append('name >= ? AND name < ?')
+            params.extend([prefix, prefix + '\U0010ffff'])
+
+    @staticmethod
+    def _keyset_clause(sort_expr, order, after, conditions, params):
+        if after:
+            op = '>' if order == 'asc' else '<'
+            conditions.append(f'({sort_expr} {op} ? OR ({sort_expr} = ? AND name {op} ?))')
+            params.extend([after[0], after[0], after[1]])
+
+    @staticmethod
+    def _query_folders(conn, parent, prefix=None, after=None, limit=None):
+        conditions = ['parent = ?']
+        params = [parent]
+        IndexService._prefix_clause(prefix, conditions, params)
+        if after:
+            IndexService._keyset_clause(SORT_KEYS['name'], 'asc', [after[0], after[0]], conditions, params)
+        sql = (f"SELECT path, name FROM folders WHERE {' AND '.join(conditions)} "
+               f"ORDER BY {SORT_KEYS['name']}, name")
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return conn.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _query_files(conn, folder, sort='name', order='asc', prefix=None, mimetype=None,
+                     taken_from=None, taken_to=None, after=None, limit=None):
+        sort_expr = SORT_KEYS[sort]
+        conditions = ['folder = ?']
+        params = [folder]
+        IndexService._prefix_clause(prefix, conditions, params)
+        if mimetype:
+            conditions.append('mimetype = ?')
+            params.append(mimetype)
+        for clause, value in ((f"{SORT_KEYS['taken_at']} >= ?", taken_from),
+                              (f"{SORT_KEYS['taken_at']} < ?", taken_to)):
+            if value is not None:
+                conditions.append(clause)
+                params.append(value)
+        IndexService._keyset_clause(sort_expr, order, after, conditions, params)
+        direction = 'ASC' if order == 'asc' else 'DESC'
+        sql = (f"SELECT * FROM files WHERE {' AND '.join(conditions)} "
+               f"ORDER BY {sort_expr} {direction}, name {direction}")
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return conn.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _folder_item(row):
+        return {'name': row['name'], 'path': row['path'], 'type': 'directory'}
+
+    @staticmethod
+    def row_to_item(row):
+        return {
+            'name': row['name'],
+            'display_name': row['display_name'] or Path(row['name']).stem,
+            'path': row['path'],
+            'url': row['path'],
+            'size': row['size'],
+            'thumb': row['thumb'],
+            'thumb_status': row['thumb_status'],
+            'thumb_version': row['thumb_version'],
+            'mtime': row['mtime'],
+            'upload_date': row['upload_date'] or datetime.fromtimestamp(row['mtime']).isoformat(),
+            'taken_at': row['taken_at'],
+            'width': row['width'],
+            'height': row['height'],
+            'camera': row['camera'],
+            'placeholder': row['placeholder'],
+            'color': row['color'],
+            'version': file_version(row['mtime'], row['size']),
+            'type': 'file'
+        }
+
+    @staticmethod
+    def tree(path='', depth=1):
+        """Folder hierarchy below ``path`` with subtree file counts and bytes.
+
+        Per-folder counts are kept by triggers; the subtree sums are rolled up
+        from them (no file rows are read) once per tree version and cached.
+        Returns ``(version, node)``; raises FileNotFoundError for unknown folders.
+        """
+        conn = IndexService.connect()
+        # Read the version first: a change racing with the rollup then only costs a recompute
+        version = conn.execute("SELECT value FROM meta WHERE key = 'tree_version'").fetchone()[0]
+        db_path = IndexService.db_path()
+        cached = IndexService._tree_cache.get(db_path)
+        if cached is None or cached[0] != version:
+            direct = {row[0]: (0, 0) for row in conn.execute('SELECT path FROM folders')}
+            direct.update((row[0], (row[1], row[2])) for row in conn.execute(
+                'SELECT path, file_count, total_bytes FROM folder_stats'))
+            cached = (version,) + rollup_tree(direct)
+            IndexService._tree_cache[db_path] = cached
+        _, totals, children = cached
+        if path not in totals:
+            raise FileNotFoundError(f"Folder not found: {path}")
+        return str(version), tree_node(totals, children, path, depth)
+
+    # ------------------------------------------------------------------
+    # Rebuild / reconcile
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def read_sidecar(json_path):
+        """Load a sidecar JSON file, returning an empty dict if it is missing or broken."""
+        try:
+            with Metrics.timer('sidecar_read'), open(json_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (json.JSONDecodeError, OSError):
+            logger.warning(f"Error decoding JSON for {json_path}. Skipping metadata.")
+            return {}
+
+    @staticmethod
+    def rebuild():
+        """Rebuild the whole index from the files, thumbnails and sidecars in storage.
+
+        Returns a dict with the number of indexed folders and files.
+        """
+        from services.backends import storage_backend
+
+        conn = IndexService.connect(ensure_built=False)
+        folders = 0
+        files = 0
+        with IndexService._transaction(conn):
+            conn.execute('DELETE FROM files')
+            conn.execute('DELETE FROM folders')
+            for folder, _, records in storage_backend().walk():
+                if folder:
+                    IndexService._ensure_folder(conn, folder)
+                    folders += 1
+                for record in records:
+                    IndexService._write_file(conn, record)
+                    files += 1
+            # Files still waiting in the thumbnail queue keep their pending/failed state
+            conn.execute(
+                "UPDATE files SET thumb_status = (SELECT CASE j.status WHEN 'failed' THEN 'failed' ELSE 'pending' END "
+                "FROM thumb_jobs j WHERE j.path = files.path) "
+                "WHERE thumb IS NULL AND path IN (SELECT path FROM thumb_jobs)")
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('built_at', ?)",
+                         (datetime.now().isoformat(),))
+        logger.info(f"Index rebuilt: {folders} folders, {files} files")
+        return {'folders': folders, 'files': files}
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE / COMMIT around a block, rolling back on error."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute('COMMIT')
+        else:
+            self.conn.execute('ROLLBACK')
+        return False
@@ -0,0 +1,279 @@
+import os
+import json
+import time
+import fcntl
+import tempfile
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from flask import current_app, request, g
+import logging
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'image_storage_'
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name -> (type, help); names get PREFIX in the exposition
+METRICS = {
+    'http_request_duration_seconds': ('histogram', 'Request latency by endpoint, method and status.'),
+    'http_request_bytes_total': ('counter', 'Request body bytes received, by endpoint.'),
+    'http_response_bytes_total': ('counter', 'Response body bytes sent (known lengths only), by endpoint.'),
+    'stage_duration_seconds': ('histogram', 'Time spent in one processing stage.'),
+    'thumbnail_jobs': ('gauge', 'Thumbnail queue depth by state.'),
+    'replication_jobs': ('gauge', 'S3 replication queue depth by state.'),
+}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class Metrics:
+    """Process-local counters and histograms, exposed in Prometheus text format.
+
+    Recording is a dict update under a lock, so it is cheap enough for every
+    request. Each process (gunicorn worker, CGI request, ``flask thumbs
+    worker``) writes its totals to METRICS_DIR/<pid>.json at most every
+    METRICS_FLUSH_INTERVAL seconds; ``/metrics`` adds up all files, so a
+    scrape sees the whole instance whichever worker answers it. Totals of
+    exited processes are folded into ``retired.json``, keeping the counters
+    monotonic. Thumbnail pool processes hand their samples back to the
+    dispatcher with every result (``drain``/``merge``).
+    """
+
+    _lock = threading.Lock()
+    _counters = {}
+    _histograms = {}  # key -> [count per bucket..., +Inf count, sum]
+    _last_flush = 0.0
+    enabled = True
+
+    @staticmethod
+    def init_app(app):
+        Metrics.enabled = app.config['METRICS_ENABLED']
+        if not Metrics.enabled:
+            return
+        app.before_request(Metrics._start_request)
+        app.after_request(Metrics._finish_request)
+
+    # ------------------------------------------------------------------
+    # Recording
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def inc(name, value=1, **labels):
+        if not Metrics.enabled:
+            return
+        key = _key(name, labels)
+        with Metrics._lock:
+            Metrics._counters[key] = Metrics._counters.get(key, 0) + value
+
+    @staticmethod
+    def observe(name, seconds, **labels):
+        if not Metrics.enabled:
+            return
+        key = _key(name, labels)
+        with Metrics._lock:
+            histogram = Metrics._histograms.get(key)
+            if histogram is None:
+                histogram = Metrics._histograms[key] = [0] * (len(BUCKETS) + 2)
+            histogram[bisect_left(BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+
+    @staticmethod
+    @contextmanager
+    def timer(stage):
+        """Time the ``with`` block as ``stage`` (save, stat, sidecar_read, thumbnail_decode, ...)."""
+        if not Metrics.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            Metrics.observe('stage_duration_seconds', time.perf_counter() - start, stage=stage)
+
+    @staticmethod
+    def _start_request():
+        g.metrics_start = time.perf_counter()
+
+    @staticmethod
+    def _finish_request(response):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return response
+        endpoint = request.endpoint or 'unmatched'
+        Metrics.observe('http_request_duration_seconds', time.perf_counter() - start,
+                        endpoint=endpoint, method=request.method, status=str(response.status_code))
+        if request.content_length:
+            Metrics.inc('http_request_bytes_total', request.content_length, endpoint=endpoint)
+        if response.content_length:
+            Metrics.inc('http_response_bytes_total', response.content_length, endpoint=endpoint)
+        Metrics.maybe_flush(current_app.config)
+        return response
+
+    # ------------------------------------------------------------------
+    # Snapshots (across processes)
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def snapshot():
+        with Metrics._lock:
+            return _pack(Metrics._counters, Metrics._histograms)
+
+    @staticmethod
+    def drain():
+        """Snapshot of everything recorded so far, which is then reset (pool processes)."""
+        with Metrics._lock:
+            snapshot = _pack(Metrics._counters, Metrics._histograms)
+            Metrics._counters, Metrics._histograms = {}, {}
+        return snapshot
+
+    @staticmethod
+    def merge(snapshot):
+        """Add samples recorded elsewhere (a pool process) to this process's totals."""
+        if Metrics.enabled and snapshot:
+            with Metrics._lock:
+                _merge(snapshot, Metrics._counters, Metrics._histograms)
+
+    @staticmethod
+    def directory(config):
+        return config['METRICS_DIR'] or os.path.join(config['UPLOAD_FOLDER'], '.metrics')
+
+    @staticmethod
+    def maybe_flush(config, force=False):
+        """Write this process's totals for ``/metrics`` if METRICS_FLUSH_INTERVAL has passed."""
+        now = time.monotonic()
+        if not Metrics.enabled or (not force and now - Metrics._last_flush < config['METRICS_FLUSH_INTERVAL']):
+            return
+        Metrics._last_flush = now
+        try:
+            directory = Metrics.directory(config)
+            os.makedirs(directory, exist_ok=True)
+            Metrics._write_json(os.path.join(directory, f"{os.getpid()}.json"), Metrics.snapshot())
+        except OSError as e:
+            logger.warning(f"Could not write metrics snapshot: {e}")
+
+    @staticmethod
+    def _write_json(path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @staticmethod
+    def collect(config):
+        """Totals of all processes: live snapshot files, retired totals and this process."""
+        directory = Metrics.directory(config)
+        os.makedirs(directory, exist_ok=True)
+        counters, histograms = {}, {}
+        with open(os.path.join(directory, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            retired_path = os.path.join(directory, 'retired.json')
+            retired = Metrics._read_json(retired_path)
+            retired_changed = False
+            for name in os.listdir(directory):
+                stem, ext = os.path.splitext(name)
+                if ext != '.json' or not stem.isdigit() or int(stem) == os.getpid():
+                    continue
+                path = os.path.join(directory, name)
+                snapshot = Metrics._read_json(path)
+                if _alive(int(stem)):
+                    _merge(snapshot, counters, histograms)
+                else:
+                    # Exited: its final totals move into retired.json
+                    retired_counters, retired_histograms = {}, {}
+                    _merge(retired, retired_counters, retired_histograms)
+                    _merge(snapshot, retired_counters, retired_histograms)
+                    retired = _pack(retired_counters, retired_histograms)
+                    os.remove(path)
+                    retired_changed = True
+            if retired_changed:
+                Metrics._write_json(retired_path, retired)
+        _merge(retired, counters, histograms)
+        _merge(Metrics.snapshot(), counters, histograms)
+        return counters, histograms
+
+    @staticmethod
+    def _read_json(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    # ------------------------------------------------------------------
+    # Exposition
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def render(counters, histograms, gauges):
+        """Prometheus text format (version 0.0.4). ``gauges`` maps ``(name, labels)`` to a value."""
+        samples = {}
+        for (name, labels), value in sorted({**counters, **gauges}.items()):
+            samples.setdefault(name, []).append(f"{PREFIX}{name}{_labels(labels)} {_number(value)}")
+        for (name, labels), values in sorted(histograms.items()):
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(BUCKETS + (float('inf'),), values[:-1]):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{PREFIX}{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{PREFIX}{name}_sum{_labels(labels)} {_number(values[-1])}")
+            lines.append(f"{PREFIX}{name}_count{_labels(labels)} {cumulative}")
+
+        output = []
+        for name in sorted(samples):
+            kind, help_text = METRICS.get(name, ('untyped', name))
+            output.append(f"# HELP {PREFIX}{name} {help_text}")
+            output.append(f"# TYPE {PREFIX}{name} {kind}")
+            output.extend(samples[name])
+        return '\n'.join(output) + '\n'
+
+
+def _pack(counters, histograms):
+    return {'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+            'histograms': [[name, labels, list(values)] for (name, labels), values in histograms.items()]}
+
+
+def _merge(snapshot, counters, histograms):
+    """Add a snapshot (lists, as stored in JSON) to ``counters``/``histograms``."""
+    for name, labels, value in snapshot.get('counters', []):
+        key = (name, tuple(tuple(label) for label in labels))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, values in snapshot.get('histograms', []):
+        key = (name, tuple(tuple(label) for label in labels))
+        current = histograms.setdefault(key, [0] * len(values))
+        for position, value in enumerate(values):
+            current[position] += value
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
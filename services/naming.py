@@ -0,0 +1,148 @@
+import os
+import re
+import hashlib
+import tempfile
+from flask import current_app
+from services.index import IndexService
+from services.backends import storage_backend
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class NamingService:
+    """Collision-free file names in constant time, safe across processes.
+
+    A name is claimed by creating it with ``O_CREAT | O_EXCL``, so two workers
+    can never end up with the same file. The common case (the name is free)
+    costs exactly that one syscall. On a collision the next ``name-N`` suffix
+    comes from a per-folder counter in the index, incremented under the index
+    write lock and seeded once from the highest existing suffix, instead of
+    probing ``name-1``, ``name-2``, ... with ``exists``.
+
+    With ``UPLOAD_NAMING=hash`` new uploads are named after the SHA-256 of
+    their content instead; identical uploads into one folder share one file.
+
+    On an object store (STORAGE_BACKEND=s3) the claim is a conditional
+    ``PutObject`` and the bytes are written to a local scratch file first,
+    then uploaded under the claimed name; ``full_dir`` is not used there.
+    """
+
+    @staticmethod
+    def create(full_dir, folder_path, filename, write, sha256=None):
+        """Store a new file in ``full_dir``; ``write(path)`` puts the bytes in place. Returns the final name.
+
+        ``sha256`` is the content hash if the caller already has it.
+        """
+        backend = storage_backend()
+        if not backend.is_local:
+            return NamingService._create_remote(backend, folder_path, filename, write, sha256)
+        if current_app.config['UPLOAD_NAMING'] == 'hash':
+            return NamingService._create_hashed(full_dir, filename, write, sha256)
+        name = NamingService.reserve(full_dir, folder_path, filename)
+        path = os.path.join(full_dir, name)
+        try:
+            write(path)
+        except Exception:
+            os.remove(path)
+            raise
+        return name
+
+    @staticmethod
+    def reserve(full_dir, folder_path, filename):
+        """Claim a free name derived from ``filename`` by creating an empty placeholder file.
+
+        The caller replaces the placeholder (``open(..., 'wb')``/``os.replace``).
+        """
+        backend = storage_backend()
+        candidate = filename
+        stem, ext = os.path.splitext(filename)
+        while True:
+            if backend.is_local:
+                try:
+                    os.close(os.open(os.path.join(full_dir, candidate), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+                    return candidate
+                except FileExistsError:
+                    pass
+            elif backend.claim('/'.join(filter(None, [folder_path, candidate]))):
+                return candidate
+            # Also covers a counter that lags behind files created outside the app
+            counter = NamingService._next_suffix(full_dir, folder_path, filename)
+            candidate = f"{stem}-{counter}{ext}"
+
+    @staticmethod
+    def _next_suffix(full_dir, folder_path, filename):
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            row = conn.execute('SELECT counter FROM name_counters WHERE folder = ? AND name = ?',
+                               (folder_path, filename)).fetchone()
+            if row is None:
+                counter = NamingService._highest_suffix(conn, full_dir, folder_path, filename)
+            else:
+                counter = row['counter']
+            counter += 1
+            conn.execute('INSERT OR REPLACE INTO name_counters (folder, name, counter) VALUES (?, ?, ?)',
+                         (folder_path, filename, counter))
+        return counter
+
+    @staticmethod
+    def _highest_suffix(conn, full_dir, folder_path, filename):
+        """Largest N among existing ``stem-N.ext`` names; runs once per folder and name."""
+        stem, ext = os.path.splitext(filename)
+        pattern = re.compile(re.escape(stem) + r'-(\d+)' + re.escape(ext))
+        if IndexService.enabled():
+            # Range scan on files(folder, name): every name starting with 'stem-' ('.' follows '-')
+            names = [row['name'] for row in conn.execute(
+                'SELECT name FROM files WHERE folder = ? AND name > ? AND name < ?',
+                (folder_path, f"{stem}-", f"{stem}."))]
+        else:
+            names = os.listdir(full_dir)
+        return max((int(match.group(1)) for match in map(pattern.fullmatch, names) if match), default=0)
+
+    @staticmethod
+    def _create_remote(backend, folder_path, filename, write, sha256=None):
+        tmp_path = backend.temp_file(filename)
+        try:
+            write(tmp_path)
+            hashed = current_app.config['UPLOAD_NAMING'] == 'hash'
+            if hashed:
+                name = (sha256 or NamingService._hash_file(tmp_path))[:32] + os.path.splitext(filename)[1].lower()
+            else:
+                name = NamingService.reserve(None, folder_path, filename)
+            path = '/'.join(filter(None, [folder_path, name]))
+            try:
+                backend.put_file(path, tmp_path)
+            except Exception:
+                if not hashed:
+                    backend.remove(path)  # The placeholder
+                raise
+            return name
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @staticmethod
+    def _hash_file(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _create_hashed(full_dir, filename, write, sha256=None):
+        fd, tmp_path = tempfile.mkstemp(dir=full_dir, prefix='.tmp-')
+        os.fchmod(fd, 0o644)
+        os.close(fd)
+        try:
+            write(tmp_path)
+            name = (sha256 or NamingService._hash_file(tmp_path))[:32] + os.path.splitext(filename)[1].lower()
+            # Same name means same content, so replacing an existing file is harmless
+            os.replace(tmp_path, os.path.join(full_dir, name))
+            return name
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
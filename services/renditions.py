@@ -0,0 +1,238 @@
+import io
+import os
+import math
+import time
+import fcntl
+import threading
+from PIL import Image, features
+from flask import current_app
+from services.index import IndexService, _subtree_bounds
+from services.thumbs import ThumbnailService
+from services.image_info import ImageInfoService
+from services.metrics import Metrics
+from services.blobs import BlobStore
+from services.backends import storage_backend
+import logging
+
+logger = logging.getLogger(__name__)
+
+# fmt query value -> (Pillow format, extension, mimetype, Pillow feature that must be available)
+RENDITION_FORMATS = {
+    'webp': ('WEBP', '.webp', 'image/webp', 'webp'),
+    'avif': ('AVIF', '.avif', 'image/avif', 'avif'),
+    'jpeg': ('JPEG', '.jpg', 'image/jpeg', None),
+}
+
+# Last-access timestamps are only written when older than this, so cache hits
+# do not turn into one index write each
+ACCESS_RESOLUTION = 60
+
+# Size of the in-process lock table; variants whose keys share a slot render one after the other
+LOCK_SLOTS = 256
+
+
+class RenditionService:
+    """Resized/re-encoded variants of originals, rendered on first request.
+
+    Renditions live in RENDITION_CACHE_DIR/w<width>/<original path><ext> and are
+    tracked in the index (``renditions`` table) for LRU eviction under
+    RENDITION_CACHE_MAX_MB. Concurrent requests for the same variant wait for a
+    single render: a lock from a fixed table (by hash of the key) within the
+    process, a per-key file lock across processes.
+    """
+
+    _locks = [threading.Lock() for _ in range(LOCK_SLOTS)]
+
+    @staticmethod
+    def cache_dir():
+        return current_app.config['RENDITION_CACHE_DIR'] or os.path.join(
+            current_app.config['UPLOAD_FOLDER'], '.renditions')
+
+    @staticmethod
+    def resolve(width=None, fmt=None):
+        """Validate query parameters and map them onto the bounded variant set.
+
+        Widths snap up to the next configured width (or the largest one), so
+        arbitrary client values do not multiply the cache. Raises ValueError.
+        """
+        widths = sorted(current_app.config['RENDITION_WIDTHS'])
+        fmt = (fmt or current_app.config['RENDITION_DEFAULT_FORMAT']).lower()
+        if fmt not in current_app.config['RENDITION_FORMATS'] or fmt not in RENDITION_FORMATS:
+            raise ValueError(f"Unsupported format: {fmt}")
+        feature = RENDITION_FORMATS[fmt][3]
+        if feature and not features.check(feature):
+            raise ValueError(f"Format not available on this server: {fmt}")
+        if width is None:
+            return widths[-1], fmt
+        try:
+            width = int(width)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid width: {width}")
+        if width <= 0:
+            raise ValueError(f"Invalid width: {width}")
+        return next((w for w in widths if w >= width), widths[-1]), fmt
+
+    @staticmethod
+    def mimetype(fmt):
+        return RENDITION_FORMATS[fmt][2]
+
+    @staticmethod
+    def key_for(relative_path, width, fmt):
+        """Cache-relative path of a rendition."""
+        return f"w{width}/{relative_path}{RENDITION_FORMATS[fmt][1]}"
+
+    @staticmethod
+    def get(relative_path, width, fmt, original_mtime=None):
+        """Absolute path of an up-to-date rendition, rendering it if needed.
+
+        The cache stays on local disk with every storage backend; ``original_mtime``
+        saves a stat (a HEAD request on object stores) if the caller has one.
+        """
+        backend = storage_backend()
+        if original_mtime is None:
+            original_mtime = backend.stat(relative_path).st_mtime
+        key = RenditionService.key_for(relative_path, width, fmt)
+        if BlobStore.enabled():
+            # Identical content in several folders shares one rendition
+            sha256 = BlobStore.hashes_for([relative_path]).get(relative_path)
+            if sha256:
+                key = f"w{width}/.blobs/{sha256[:2]}/{sha256}{RENDITION_FORMATS[fmt][1]}"
+        target = os.path.join(RenditionService.cache_dir(), key)
+
+        if RenditionService._is_fresh(target, original_mtime):
+            RenditionService._touch(key)
+            return target
+
+        with RenditionService._key_lock(key):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    # Another thread or process may have rendered it while we waited
+                    if not RenditionService._is_fresh(target, original_mtime):
+                        with backend.fetch(relative_path) as original:
+                            size = RenditionService.render(original, target, width, fmt)
+                        RenditionService._record(key, relative_path, size)
+                        RenditionService.evict(keep=key)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return target
+
+    @staticmethod
+    def render(original_path, target_path, width, fmt):
+        """Render one rendition; returns its size in bytes. Never upscales."""
+        pillow_format = RENDITION_FORMATS[fmt][0]
+        start = time.perf_counter()
+        with Image.open(original_path) as img:
+            # Box height rounded up so the width is the binding constraint
+            upright_width, upright_height = ImageInfoService.upright_size(img)
+            height = max(1, math.ceil(upright_height * width / upright_width))
+            img = ThumbnailService.load_reduced(img, (width, height), keep_alpha=pillow_format != 'JPEG')
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA' if 'A' in img.mode else 'RGB')
+            buffer = io.BytesIO()
+            with Metrics.timer('image_encode'):
+                img.save(buffer, pillow_format, quality=current_app.config['RENDITION_QUALITY'])
+        data = buffer.getvalue()
+        ThumbnailService._write_atomic(target_path, data)
+        logger.info(f"Rendition rendered: {target_path} ({len(data)} bytes, "
+                    f"{(time.perf_counter() - start) * 1000:.0f} ms)")
+        return len(data)
+
+    @staticmethod
+    def evict(keep=None):
+        """Delete least recently used renditions until the cache fits its quota.
+
+        ``keep`` (the rendition about to be served) is never evicted.
+        """
+        quota = current_app.config['RENDITION_CACHE_MAX_MB'] * 1024 * 1024
+        conn = IndexService.connect()
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM renditions').fetchone()[0]
+        if total <= quota:
+            return
+        # Evict down to 90% so the next few renders do not evict again
+        excess = total - int(quota * 0.9)
+        victims = []
+        for row in conn.execute('SELECT key, size FROM renditions ORDER BY last_access'):
+            if excess <= 0:
+                break
+            if row['key'] == keep:
+                continue
+            victims.append(row['key'])
+            excess -= row['size']
+        RenditionService._delete(victims)
+        logger.info(f"Rendition cache over quota, evicted {len(victims)} renditions")
+
+    @staticmethod
+    def discard(relative_path):
+        """Remove all renditions of an original (deleted or renamed)."""
+        conn = IndexService.connect()
+        keys = [row['key'] for row in conn.execute('SELECT key FROM renditions WHERE original = ?', (relative_path,))]
+        RenditionService._delete(keys)
+
+    @staticmethod
+    def discard_many(relative_paths):
+        """Remove the renditions of several originals with one query per 500 paths."""
+        conn = IndexService.connect()
+        keys = []
+        for start in range(0, len(relative_paths), 500):
+            batch = relative_paths[start:start + 500]
+            keys += [row['key'] for row in conn.execute(
+                f"SELECT key FROM renditions WHERE original IN ({', '.join('?' for _ in batch)})", batch)]
+        RenditionService._delete(keys)
+
+    @staticmethod
+    def discard_folder(relative_path):
+        low, high = _subtree_bounds(relative_path)
+        conn = IndexService.connect()
+        keys = [row['key'] for row in conn.execute(
+            'SELECT key FROM renditions WHERE original > ? AND original < ?', (low, high))]
+        RenditionService._delete(keys)
+
+    @staticmethod
+    def stats():
+        conn = IndexService.connect()
+        row = conn.execute('SELECT COUNT(*) AS count, COALESCE(SUM(size), 0) AS bytes FROM renditions').fetchone()
+        return {'count': row['count'], 'bytes': row['bytes']}
+
+    @staticmethod
+    def _is_fresh(target, original_mtime):
+        try:
+            return os.stat(target).st_mtime >= original_mtime
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def _key_lock(key):
+        # A fixed table: keys come from request parameters, a lock per key would grow without bound
+        return RenditionService._locks[hash(key) % LOCK_SLOTS]
+
+    @staticmethod
+    def _record(key, original, size):
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            conn.execute('INSERT OR REPLACE INTO renditions (key, original, size, last_access) VALUES (?, ?, ?, ?)',
+                         (key, original, size, time.time()))
+
+    @staticmethod
+    def _touch(key):
+        now = time.time()
+        conn = IndexService.connect()
+        row = conn.execute('SELECT last_access FROM renditions WHERE key = ?', (key,)).fetchone()
+        if row is not None and row['last_access'] < now - ACCESS_RESOLUTION:
+            conn.execute('UPDATE renditions SET last_access = ? WHERE key = ?', (now, key))
+
+    @staticmethod
+    def _delete(keys):
+        if not keys:
+            return
+        cache_dir = RenditionService.cache_dir()
+        for key in keys:
+            for path in (os.path.join(cache_dir, key), os.path.join(cache_dir, key) + '.lock'):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            conn.executemany('DELETE FROM renditions WHERE key = ?', [(key,) for key in keys])
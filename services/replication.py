@@ -0,0 +1,276 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import PurePosixPath
+from flask import current_app
+from services.index import IndexService
+from services.external_storage import ExternalStorageService
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _sidecar_of(path):
+    return str(PurePosixPath(path).with_suffix('.json'))
+
+
+class ReplicationQueue:
+    """Durable outbox of pending S3 changes, stored in the index database.
+
+    A job says "make the bucket match the local state of this path", not
+    "upload" or "delete", so jobs are idempotent, coalesce per path and may
+    run in any order. ``file`` jobs cover one object (original or sidecar);
+    ``tree`` jobs compare a whole subtree with the bucket (folder deletes and
+    renames, ``flask replicate sync``). ``source`` is a path's previous name,
+    which lets the worker copy inside the bucket instead of uploading again;
+    objects that are still the source of a queued job are not deleted.
+
+    A change arriving while its job runs bumps ``version``, so the running
+    attempt does not complete it.
+    """
+
+    @staticmethod
+    def enabled():
+        return ExternalStorageService.is_enabled()
+
+    @staticmethod
+    def record_files(paths):
+        """Queue originals (and their sidecars) that were written or deleted."""
+        if ReplicationQueue.enabled() and paths:
+            ReplicationQueue.enqueue([('file', p, None) for path in paths for p in (path, _sidecar_of(path))])
+
+    @staticmethod
+    def record_sidecars(paths):
+        """Queue only the sidecars of ``paths`` (metadata changed, the original did not)."""
+        if ReplicationQueue.enabled() and paths:
+            ReplicationQueue.enqueue([('file', _sidecar_of(path), None) for path in paths])
+
+    @staticmethod
+    def record_move(old_path, new_path):
+        if ReplicationQueue.enabled():
+            ReplicationQueue.enqueue([('file', new_path, old_path),
+                                      ('file', _sidecar_of(new_path), _sidecar_of(old_path))])
+
+    @staticmethod
+    def record_folder(path, source=None):
+        """Queue a subtree comparison: a deleted folder, or one renamed from ``source``."""
+        if ReplicationQueue.enabled():
+            ReplicationQueue.enqueue([('tree', path, source)])
+
+    @staticmethod
+    def apply_changes(changes):
+        """Follow a bulk operation or watcher batch (see IndexService.apply_changes)."""
+        if not ReplicationQueue.enabled() or not changes:
+            return
+        jobs = []
+        for change in changes:
+            op = change['op']
+            if op in ('remove_file', 'upsert_file'):
+                path = change['path'] if op == 'remove_file' else change['record']['path']
+                jobs += [('file', path, None), ('file', _sidecar_of(path), None)]
+            elif op == 'move_file':
+                jobs += [('file', change['new'], change['old']),
+                         ('file', _sidecar_of(change['new']), _sidecar_of(change['old']))]
+            elif op == 'remove_folder':
+                jobs.append(('tree', change['path'], None))
+            elif op == 'move_folder':
+                jobs.append(('tree', change['new'], change['old']))
+        ReplicationQueue.enqueue(jobs)
+
+    @staticmethod
+    def enqueue(jobs, start_worker=True):
+        """Queue ``(kind, path, source)`` jobs in one transaction."""
+        if not jobs:
+            return
+        now = time.time()
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            conn.executemany(
+                "INSERT INTO replication_jobs (kind, path, source, status, attempts, created_at, available_at) "
+                "VALUES (?, ?, ?, 'queued', 0, ?, ?) "
+                "ON CONFLICT(kind, path) DO UPDATE SET source = COALESCE(excluded.source, source), "
+                "version = version + 1, attempts = 0, error = NULL, available_at = excluded.available_at, "
+                "status = CASE status WHEN 'running' THEN 'running' ELSE 'queued' END",
+                [(kind, path, source, now, now) for kind, path, source in jobs])
+        if start_worker:
+            ReplicationWorker.ensure_started(current_app._get_current_object())
+
+    @staticmethod
+    def is_protected(path):
+        return bool(ReplicationQueue.protected([path]))
+
+    @staticmethod
+    def protected(paths):
+        """The subset of ``paths`` whose objects a queued rename still copies from."""
+        conn = IndexService.connect()
+        file_sources = {row['source'] for row in conn.execute(
+            "SELECT source FROM replication_jobs WHERE kind = 'file' AND source IS NOT NULL")}
+        tree_sources = [row['source'] for row in conn.execute(
+            "SELECT source FROM replication_jobs WHERE kind = 'tree' AND source IS NOT NULL")]
+        return {path for path in paths
+                if path in file_sources or any(path.startswith(source + '/') for source in tree_sources)}
+
+    @staticmethod
+    def claim(limit):
+        """Atomically lease up to ``limit`` due jobs to the caller."""
+        now = time.time()
+        lease_expired = now - current_app.config['S3_JOB_LEASE']
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            rows = conn.execute(
+                "SELECT kind, path, source, version, attempts FROM replication_jobs "
+                "WHERE (status = 'queued' AND available_at <= ?) OR (status = 'running' AND claimed_at < ?) "
+                "ORDER BY available_at LIMIT ?", (now, lease_expired, limit)).fetchall()
+            conn.executemany(
+                "UPDATE replication_jobs SET status = 'running', claimed_at = ?, attempts = attempts + 1 "
+                "WHERE kind = ? AND path = ?", [(now, row['kind'], row['path']) for row in rows])
+        return [dict(row, attempts=row['attempts'] + 1) for row in rows]
+
+    @staticmethod
+    def complete(job, followups=()):
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            conn.execute('DELETE FROM replication_jobs WHERE kind = ? AND path = ? AND version = ?',
+                         (job['kind'], job['path'], job['version']))
+            ReplicationQueue._requeue_if_changed(conn, job)
+        # Only now: the job no longer protects its source from deletion
+        ReplicationQueue.enqueue(list(followups), start_worker=False)
+
+    @staticmethod
+    def fail(job, error):
+        """Record a failed attempt; back off exponentially until S3_MAX_ATTEMPTS, then mark the job failed."""
+        attempts = job['attempts']
+        final = attempts >= current_app.config['S3_MAX_ATTEMPTS']
+        delay = min(current_app.config['S3_RETRY_DELAY'] * 2 ** (attempts - 1), 3600)
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            conn.execute(
+                'UPDATE replication_jobs SET status = ?, error = ?, claimed_at = NULL, available_at = ? '
+                'WHERE kind = ? AND path = ? AND version = ?',
+                ('failed' if final else 'queued', str(error), time.time() + delay,
+                 job['kind'], job['path'], job['version']))
+            ReplicationQueue._requeue_if_changed(conn, job)
+        if final:
+            logger.error(f"Replication of {job['kind']} '{job['path']}' failed permanently: {error}")
+        else:
+            logger.warning(f"Replication of {job['kind']} '{job['path']}' failed (attempt {attempts}), "
+                           f"retrying in {delay:.0f}s: {error}")
+
+    @staticmethod
+    def _requeue_if_changed(conn, job):
+        # Still running means a newer change arrived during the attempt
+        conn.execute("UPDATE replication_jobs SET status = 'queued', claimed_at = NULL "
+                     "WHERE kind = ? AND path = ? AND status = 'running'", (job['kind'], job['path']))
+
+    @staticmethod
+    def retry_failed():
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            return conn.execute("UPDATE replication_jobs SET status = 'queued', attempts = 0, available_at = ? "
+                                "WHERE status = 'failed'", (time.time(),)).rowcount
+
+    @staticmethod
+    def stats():
+        conn = IndexService.connect()
+        return {row['status']: row['count'] for row in conn.execute(
+            'SELECT status, COUNT(*) AS count FROM replication_jobs GROUP BY status')}
+
+
+class ReplicationWorker:
+    """Dispatcher thread running queued replication jobs on a bounded thread pool.
+
+    S3 transfers are network-bound, so threads (sharing one pooled client)
+    rather than processes. Started lazily in each app process, or in the
+    foreground with ``flask replicate worker``.
+    """
+
+    _lock = threading.Lock()
+    _thread = None
+    _pid = None
+    _stop = threading.Event()
+
+    @staticmethod
+    def init_app(app):
+        if not app.config['S3_REPLICATION']:
+            return
+        if not app.config['AWS_BUCKET_NAME']:
+            raise RuntimeError("S3_REPLICATION requires AWS_BUCKET_NAME")
+        ExternalStorageService.check_available()
+        if app.config['S3_REPLICATION_IN_APP']:
+            # Pick up changes left over from before a restart
+            app.before_request(lambda: ReplicationWorker.ensure_started(app))
+
+    @staticmethod
+    def ensure_started(app):
+        if not app.config['S3_REPLICATION_IN_APP']:
+            return
+        if ReplicationWorker._thread is not None and ReplicationWorker._pid == os.getpid():
+            return
+        with ReplicationWorker._lock:
+            if ReplicationWorker._thread is not None and ReplicationWorker._pid == os.getpid():
+                return
+            ReplicationWorker._pid = os.getpid()
+            ReplicationWorker._thread = threading.Thread(
+                target=ReplicationWorker.run, args=(app,), name='replication-dispatcher', daemon=True)
+            ReplicationWorker._thread.start()
+
+    @staticmethod
+    def run(app, once=False):
+        """Dispatch loop. With ``once`` it returns as soon as no job is due."""
+        workers = max(1, app.config['S3_REPLICATION_WORKERS'])
+        poll = app.config['S3_REPLICATION_POLL']
+        inflight = {}
+        logger.info(f"Replication worker started with {workers} threads (pid {os.getpid()})")
+
+        with app.app_context(), ThreadPoolExecutor(max_workers=workers) as pool:
+            while not ReplicationWorker._stop.is_set():
+                try:
+                    free = workers * 2 - len(inflight)
+                    if free > 0:
+                        for job in ReplicationQueue.claim(free):
+                            inflight[pool.submit(ReplicationWorker._process, app, job)] = job
+
+                    if not inflight:
+                        if once:
+                            break
+                        ReplicationWorker._stop.wait(poll)
+                        continue
+
+                    done, _ = wait(inflight, timeout=poll, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        job = inflight.pop(future)
+                        error = future.exception()
+                        if error is None:
+                            ReplicationQueue.complete(job, future.result())
+                        else:
+                            ReplicationQueue.fail(job, error)
+                except Exception as e:
+                    logger.error(f"Replication dispatcher error: {e}", exc_info=True)
+                    ReplicationWorker._stop.wait(poll)
+
+    @staticmethod
+    def _process(app, job):
+        """Run one job on a pool thread; returns follow-up jobs."""
+        with app.app_context():
+            path, source = job['path'], job['source']
+            if job['kind'] == 'tree':
+                return ReplicationWorker.sync_tree(path, source)
+            action = ExternalStorageService.replicate_file(path, source)
+            logger.info(f"Replicated '{path}': {action}")
+            if source and source != path and action in ('uploaded', 'copied'):
+                # The old object goes once nothing needs it any more
+                return [('file', source, None)]
+            return []
+
+    @staticmethod
+    def sync_tree(folder, source=None):
+        """Queue a file job for every changed object below ``folder`` and delete the orphans."""
+        transfers, orphans, unchanged = ExternalStorageService.plan_sync(folder, source)
+        ReplicationQueue.enqueue([('file', path, src) for path, src in transfers], start_worker=False)
+        protected = ReplicationQueue.protected(orphans)
+        orphans = [path for path in orphans if path not in protected]
+        ExternalStorageService.delete_objects(orphans)
+        logger.info(f"Replication sync of '{folder or '/'}': {len(transfers)} queued, "
+                    f"{len(orphans)} deleted, {unchanged} unchanged")
+        return [('tree', source, None)] if source and source != folder else []
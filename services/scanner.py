@@ -0,0 +1,198 @@
+import os
+import json
+import hashlib
+from datetime import datetime
+from pathlib import Path
+from services.index import (decode_cursor, encode_cursor, file_version, IndexService, SORT_KEYS, rollup_tree,
+                            tree_node, sort_value)
+from services.thumbs import ThumbnailService
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def scan_directory(full_path, folder):
+    """Read one directory in a single pass.
+
+    Returns ``(subfolder_names, records)`` where each record uses the index
+    column names. ``.thumbs/`` is read once into a set and sidecars are paired
+    from the same scan, so the only per-file syscall left is the stat of the
+    original (``DirEntry.is_dir``/``is_file`` are answered from d_type) plus one
+    open per existing sidecar.
+    """
+    subfolders = []
+    files = []
+    sidecars = set()
+    thumbs = set()
+
+    with os.scandir(full_path) as entries:
+        for entry in entries:
+            name = entry.name
+            if name == '.thumbs':
+                try:
+                    thumbs = set(os.listdir(entry.path))
+                except OSError as e:
+                    logger.warning(f"Could not read thumbnail directory {entry.path}: {e}")
+                continue
+            if name.startswith('.'):
+                continue
+            if name.endswith('.json'):
+                sidecars.add(name)
+                continue
+            if entry.is_dir():
+                subfolders.append(name)
+            elif entry.is_file():
+                files.append(entry)
+
+    records = []
+    for entry in files:
+        try:
+            stats = entry.stat()
+        except FileNotFoundError:
+            continue  # Removed while scanning
+        stem = Path(entry.name).stem
+        metadata = {}
+        if stem + '.json' in sidecars:
+            metadata = IndexService.read_sidecar(os.path.join(full_path, stem + '.json'))
+        records.append(file_record(folder, entry.name, stats, metadata, thumbs))
+    return subfolders, records
+
+
+def file_record(folder, name, stats, metadata, thumbs):
+    """Index record of one original from its stat result, sidecar dict and the names in ``.thumbs/``.
+
+    The thumbnail's version comes from the sidecar, where it is stored when the
+    thumbnail is written; see ``with_thumb_versions`` for thumbnails without one.
+    """
+    stem = Path(name).stem
+    thumb_name = stem + ThumbnailService.thumbnail_extension()
+    return {
+        'path': '/'.join(filter(None, [folder, name])),
+        'folder': folder,
+        'name': name,
+        'size': stats.st_size,
+        'mtime': stats.st_mtime,
+        'thumb': '/'.join(filter(None, [folder, '.thumbs', thumb_name])) if thumb_name in thumbs else None,
+        'thumb_status': 'ready' if thumb_name in thumbs else None,
+        'display_name': metadata.get('display_name', stem),
+        'original_name': metadata.get('original_name', name),
+        'upload_date': metadata.get('upload_date', datetime.fromtimestamp(stats.st_mtime).isoformat()),
+        'mimetype': metadata.get('mimetype'),
+        'sha256': metadata.get('sha256'),
+        'width': metadata.get('width'),
+        'height': metadata.get('height'),
+        'taken_at': metadata.get('taken_at'),
+        'camera': metadata.get('camera'),
+        'placeholder': metadata.get('placeholder'),
+        'color': metadata.get('color'),
+        'thumb_version': metadata.get('thumb_version') if thumb_name in thumbs else None,
+    }
+
+
+def walk_tree(root):
+    """Yield ``(folder, subfolder_names, records)`` for every visible directory below ``root``."""
+    pending = ['']
+    while pending:
+        folder = pending.pop()
+        full_path = os.path.join(root, folder) if folder else root
+        try:
+            subfolders, records = scan_directory(full_path, folder)
+        except FileNotFoundError:
+            continue
+        yield folder, subfolders, records
+        pending.extend('/'.join(filter(None, [folder, name])) for name in sorted(subfolders, reverse=True))
+
+
+def tree_directory(full_path, folder, depth):
+    """IndexService.tree for when the index is disabled: walks the whole subtree.
+
+    The version is a hash of the response, so ETags still work.
+    """
+    direct = {}
+    for sub_folder, _, records in walk_tree(full_path):
+        direct['/'.join(filter(None, [folder, sub_folder]))] = (len(records), sum(r['size'] for r in records))
+    totals, children = rollup_tree(direct)
+    node = tree_node(totals, children, folder, depth)
+    version = hashlib.sha1(json.dumps(node, sort_keys=True).encode()).hexdigest()[:16]
+    return version, node
+
+
+def with_thumb_versions(full_path, records):
+    """Fill in ``thumb_version`` of records whose sidecar has none (files that
+    arrived without the app, thumbnails written before versions were stored)
+    by a stat of just those thumbnails. For the records of one listing page."""
+    for record in records:
+        if record['thumb'] and not record['thumb_version']:
+            try:
+                stats = os.stat(os.path.join(full_path, '.thumbs', record['thumb'].rpartition('/')[2]))
+            except FileNotFoundError:
+                continue
+            record['thumb_version'] = file_version(stats.st_mtime, stats.st_size)
+    return records
+
+
+def list_directory(full_path, folder):
+    """Listing of one directory in the list_files format, straight from disk."""
+    subfolders, records = scan_directory(full_path, folder)
+    items = [{'name': name, 'path': '/'.join(filter(None, [folder, name])), 'type': 'directory'}
+             for name in sorted(subfolders, key=lambda n: (n.lower(), n))]
+    records.sort(key=lambda r: (r['name'].lower(), r['name']))
+    items.extend(IndexService.row_to_item(record) for record in with_thumb_versions(full_path, records))
+    return items
+
+
+def page_directory(full_path, folder, limit, cursor=None, sort='name', order='asc', prefix=None, mimetype=None,
+                   taken_from=None, taken_to=None):
+    """In-memory equivalent of IndexService.list_page for when the index is disabled."""
+    if sort not in SORT_KEYS:
+        raise ValueError(f"Invalid sort key: {sort}")
+    if order not in ('asc', 'desc'):
+        raise ValueError(f"Invalid order: {order}")
+    state = decode_cursor(cursor) if cursor else {'phase': 'd'}
+    if state.get('phase') not in ('d', 'f'):
+        raise ValueError("Invalid cursor")
+    if state.get('sort', sort) != sort or state.get('order', order) != order:
+        raise ValueError("Cursor does not match sort order")
+    subfolders, records = scan_directory(full_path, folder)
+
+    def matches(name):
+        return not prefix or name.startswith(prefix)
+
+    def taken_matches(record):
+        taken = sort_value(record, 'taken_at')
+        return (not taken_from or taken >= taken_from) and (not taken_to or taken < taken_to)
+
+    def sort_key(value, name):
+        return (value.lower() if isinstance(value, str) and sort == 'name' else value, name)
+
+    items = []
+    after = state.get('after')
+    if state['phase'] == 'd' and not (mimetype or taken_from or taken_to):
+        names = sorted((n for n in subfolders if matches(n)), key=lambda n: (n.lower(), n))
+        if after:
+            names = [n for n in names if (n.lower(), n) > (after[0].lower(), after[0])]
+        for name in names[:limit]:
+            items.append({'name': name, 'path': '/'.join(filter(None, [folder, name])), 'type': 'directory'})
+        if len(names) > limit:
+            return {'items': items, 'next_cursor': encode_cursor(
+                {'phase': 'd', 'sort': sort, 'order': order, 'after': [items[-1]['name']]})}
+        after = None
+
+    remaining = limit - len(items)
+    descending = order == 'desc'
+    records = [r for r in records if matches(r['name']) and (not mimetype or r['mimetype'] == mimetype)
+               and taken_matches(r)]
+    records.sort(key=lambda r: sort_key(sort_value(r, sort), r['name']), reverse=descending)
+    if after:
+        bound = sort_key(after[0], after[1])
+        records = [r for r in records
+                   if (sort_key(sort_value(r, sort), r['name']) < bound if descending
+                       else sort_key(sort_value(r, sort), r['name']) > bound)]
+    page = records[:remaining]
+    next_cursor = None
+    if len(records) > remaining:
+        last = page[-1] if page else None
+        next_cursor = encode_cursor({'phase': 'f', 'sort': sort, 'order': order,
+                                     'after': [sort_value(last, sort), last['name']] if last else None})
+    items.extend(IndexService.row_to_item(record) for record in with_thumb_versions(full_path, page))
+    return {'items': items, 'next_cursor': next_cursor}
@@ -0,0 +1,252 @@
+import os
+import json
+import math
+import uuid
+import fcntl
+import hashlib
+import threading
+from PIL import Image
+from flask import current_app
+from services.index import IndexService, file_version
+from services.thumbs import THUMBNAIL_EXTENSIONS
+from services.backends import storage_backend
+from services.metrics import Metrics
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Cells per row of a sprite sheet
+SPRITE_COLUMNS = 16
+# Largest image side WebP can encode (the tightest of the thumbnail formats)
+MAX_SPRITE_HEIGHT = 16383
+# Fill of cells that hold no thumbnail (removed files)
+BACKGROUND = (255, 255, 255)
+# Folders with fewer thumbnails than this get no sheet
+MIN_FILES = 2
+# Size of the in-process lock table; folders whose names share a slot update one after the other
+LOCK_SLOTS = 64
+
+
+class SpriteService:
+    """One packed image of a folder's thumbnails, so a folder view costs one
+    image request instead of one per file.
+
+    The sheet is a grid of THUMBNAIL_SIZE cells, ``SPRITE_COLUMNS`` wide, stored
+    as ``<folder>/.thumbs/.sprite-<id><ext>``; the index (``sprites`` table)
+    maps file names to cells. Triggers mark a folder's sheet as changed whenever
+    one of its files is added, removed, renamed or gets a new thumbnail, and the
+    next listing brings it up to date incrementally: renamed files keep their
+    cell, cells of removed files are blanked and reused, and only thumbnails
+    that are new to the sheet (or regenerated) are decoded. Each update is written under a new
+    name, so a listing never pairs offsets with a different image.
+    """
+
+    _locks = [threading.Lock() for _ in range(LOCK_SLOTS)]
+
+    @staticmethod
+    def enabled():
+        return current_app.config['THUMBNAIL_SPRITES'] and IndexService.enabled()
+
+    @staticmethod
+    def attach(folder, page):
+        """Add the folder's sheet to a list_page result.
+
+        Sets ``page['sprite'] = {'url', 'version', 'width', 'height'}`` and, on every
+        file whose current thumbnail is on it, ``item['sprite'] = [x, y, width, height]``.
+        Files without one keep using ``thumb``. Never raises: a failed update
+        only costs the listing its sprite.
+        """
+        try:
+            sprite = SpriteService.get(folder)
+        except Exception as e:
+            logger.warning(f"Could not update the sprite sheet of '{folder}': {e}")
+            return page
+        if sprite is None:
+            return page
+        cells = sprite['cells']
+        attached = False
+        for item in page['items']:
+            entry = cells.get(item['name']) if item['type'] == 'file' else None
+            if entry and entry[1] == (item['thumb_version'] or item['version']):
+                x, y = SpriteService._origin(entry[0], sprite['cell_width'], sprite['cell_height'])
+                item['sprite'] = [x, y, entry[2], entry[3]]
+                attached = True
+        if attached:
+            page['sprite'] = {'url': sprite['file'], 'version': sprite['version'],
+                              'width': sprite['width'], 'height': sprite['height']}
+        return page
+
+    @staticmethod
+    def get(folder):
+        """The folder's current sheet as a dict (``cells``: name -> ``[cell, thumbnail
+        version, width, height]``), updating it first if files changed; None if it has none."""
+        conn = IndexService.connect()
+        row = conn.execute('SELECT * FROM sprites WHERE folder = ?', (folder,)).fetchone()
+        if row is None:
+            with IndexService._transaction(conn):
+                conn.execute('INSERT OR IGNORE INTO sprites (folder) VALUES (?)', (folder,))
+        elif SpriteService._is_current(row):
+            return SpriteService._parse(row)
+
+        with SpriteService._folder_lock(folder):
+            lock_path = SpriteService._lock_path(folder)
+            os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+            with open(lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    # Another thread or process may have updated it while we waited
+                    row = conn.execute('SELECT * FROM sprites WHERE folder = ?', (folder,)).fetchone()
+                    if row is None:
+                        return None  # Folder deleted meanwhile
+                    if not SpriteService._is_current(row):
+                        row = SpriteService.update(folder, row)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return SpriteService._parse(row)
+
+    @staticmethod
+    def update(folder, row):
+        """Bring one sheet up to date; call with the folder locked. Returns the new row."""
+        conn = IndexService.connect()
+        changes = row['changes']
+        cell_width, cell_height = current_app.config['THUMBNAIL_SIZE']
+        capacity = min(current_app.config['THUMBNAIL_SPRITE_MAX_FILES'],
+                       MAX_SPRITE_HEIGHT // cell_height * SPRITE_COLUMNS)
+        # Cells are keyed by the thumbnail's own version (the original's for rows
+        # indexed before thumb_version), so a regenerated thumbnail is drawn again
+        rows = conn.execute(
+            "SELECT name, mtime, size, thumb, thumb_version FROM files WHERE folder = ? AND thumb_status = 'ready' "
+            "AND thumb IS NOT NULL ORDER BY name LIMIT ?", (folder, capacity))
+        current = {r['name']: (r['thumb_version'] or file_version(r['mtime'], r['size']), r['thumb']) for r in rows}
+
+        old_cells = json.loads(row['cells']) if row['file'] else {}
+        rebuild = (row['cell_width'], row['cell_height']) != (cell_width, cell_height)
+        cells, freed = {}, {}
+        if not rebuild:
+            for name, entry in old_cells.items():
+                if name in current and current[name][0] == entry[1]:
+                    cells[name] = entry
+                else:
+                    freed.setdefault(entry[1], []).append(entry)
+        added = []
+        for name in sorted(set(current) - set(cells)):
+            # A renamed file keeps its thumbnail's version, and with it its cell
+            if freed.get(current[name][0]):
+                cells[name] = freed[current[name][0]].pop()
+            else:
+                added.append(name)
+        blank = sorted(entry[0] for entries in freed.values() for entry in entries)
+        slots = max((entry[0] for entry in cells.values()), default=-1) + 1
+        if len(current) < MIN_FILES:
+            cells, added, blank = {}, [], []
+        elif slots > 2 * (len(cells) + len(added)) + SPRITE_COLUMNS:
+            # Mostly holes after many deletes: pack the remaining thumbnails again
+            rebuild = True
+        if rebuild and len(current) >= MIN_FILES:
+            cells, added, blank, slots = {}, sorted(current), [], 0
+
+        # Holes left by earlier updates are blank already; fill them first
+        used = {entry[0] for entry in cells.values()}
+        free = [cell for cell in range(slots) if cell not in used]
+        for name in added:
+            cell = free.pop(0) if free else slots
+            slots = max(slots, cell + 1)
+            cells[name] = [cell, current[name][0], 0, 0]
+
+        backend = storage_backend()
+        file, version, width, height = row['file'], row['version'], row['width'], row['height']
+        if not cells:
+            file = version = width = height = None
+        elif added or blank or rebuild or not file:
+            file, version, width, height = SpriteService._render(
+                folder, None if rebuild else row['file'], cells, added, blank, current,
+                (cell_width, cell_height))
+            # Files whose thumbnail could not be read stay off the sheet
+            cells = {name: entry for name, entry in cells.items() if entry[2]}
+
+        with IndexService._transaction(conn):
+            conn.execute(
+                'UPDATE sprites SET file = ?, version = ?, width = ?, height = ?, cell_width = ?, '
+                'cell_height = ?, cells = ?, built = ? WHERE folder = ?',
+                (file, version, width, height, cell_width, cell_height, json.dumps(cells), changes, folder))
+        if row['file'] and row['file'] != file:
+            try:
+                backend.remove(row['file'])
+            except OSError as e:
+                logger.warning(f"Could not remove old sprite sheet {row['file']}: {e}")
+        return conn.execute('SELECT * FROM sprites WHERE folder = ?', (folder,)).fetchone()
+
+    @staticmethod
+    def _render(folder, base_file, cells, added, blank, current, cell_size):
+        """Draw the changed cells onto the previous sheet (or a new one) and store it
+        under a new name. Returns ``(file, version, width, height)``."""
+        cell_width, cell_height = cell_size
+        slots = max(entry[0] for entry in cells.values()) + 1
+        width = min(slots, SPRITE_COLUMNS) * cell_width
+        height = math.ceil(slots / SPRITE_COLUMNS) * cell_height
+        backend = storage_backend()
+        config = current_app.config
+
+        with Metrics.timer('sprite'):
+            sheet = Image.new('RGB', (width, height), BACKGROUND)
+            if base_file:
+                try:
+                    with backend.fetch(base_file) as local_file, Image.open(local_file) as previous:
+                        # Cells past the new size are cut off
+                        sheet.paste(previous.convert('RGB'), (0, 0))
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Sprite sheet {base_file} unreadable, drawing all cells again: {e}")
+                    added = sorted(cells)
+            for cell in blank:
+                x, y = SpriteService._origin(cell, cell_width, cell_height)
+                sheet.paste(BACKGROUND, (x, y, x + cell_width, y + cell_height))
+            for name in added:
+                entry = cells[name]
+                x, y = SpriteService._origin(entry[0], cell_width, cell_height)
+                try:
+                    with backend.fetch(current[name][1]) as local_file, Image.open(local_file) as thumb:
+                        thumb = thumb.convert('RGB')
+                        thumb.thumbnail(cell_size)
+                        sheet.paste(thumb, (x, y))
+                        entry[2], entry[3] = thumb.size
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Thumbnail {current[name][1]} left off the sprite sheet: {e}")
+
+            fmt = config['THUMBNAIL_FORMAT']
+            file = '/'.join(filter(None, [folder, '.thumbs',
+                                          f".sprite-{uuid.uuid4().hex[:12]}{THUMBNAIL_EXTENSIONS[fmt]}"]))
+            with backend.writer(file) as tmp_path:
+                if fmt == 'PNG':
+                    sheet.save(tmp_path, fmt, optimize=True)
+                else:
+                    sheet.save(tmp_path, fmt, quality=config['THUMBNAIL_QUALITY_MAX'])
+        st = backend.stat(file)
+        logger.debug(f"Sprite sheet {file}: {len(added)} thumbnails drawn, {len(blank)} cells cleared")
+        return file, file_version(st.st_mtime, st.st_size), width, height
+
+    @staticmethod
+    def _origin(cell, cell_width, cell_height):
+        return (cell % SPRITE_COLUMNS) * cell_width, (cell // SPRITE_COLUMNS) * cell_height
+
+    @staticmethod
+    def _is_current(row):
+        return row['built'] == row['changes'] and \
+            (row['cell_width'], row['cell_height']) == tuple(current_app.config['THUMBNAIL_SIZE'])
+
+    @staticmethod
+    def _parse(row):
+        if not row['file']:
+            return None
+        return {'file': row['file'], 'version': row['version'], 'width': row['width'], 'height': row['height'],
+                'cell_width': row['cell_width'], 'cell_height': row['cell_height'],
+                'cells': json.loads(row['cells'])}
+
+    @staticmethod
+    def _lock_path(folder):
+        return os.path.join(os.path.dirname(IndexService.db_path()), '.sprite-locks',
+                            hashlib.sha1(folder.encode()).hexdigest() + '.lock')
+
+    @staticmethod
+    def _folder_lock(folder):
+        # A fixed table, like the renditions': a lock per folder would grow with the tree
+        return SpriteService._locks[hash(folder) % LOCK_SLOTS]
@@ -1,197 +1,380 @@
 import os
-import shutil
+import stat
 import json
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from pathlib import Path
 from werkzeug.utils import secure_filename
 from flask import current_app
+from services.index import IndexService
+from services.thumb_queue import ThumbnailQueue
+from services.thumbs import ThumbnailService
+from services.renditions import RenditionService
+from services.sprites import SpriteService
+from services.naming import NamingService
+from services.blobs import BlobStore
+from services.replication import ReplicationQueue
+from services.backends import storage_backend
+from services.metrics import Metrics
+from services.image_info import ImageInfoService, SIDECAR_KEYS
+from services import scanner
 import logging
 
 logger = logging.getLogger(__name__)
 
 class StorageService:
-    @staticmethod
-    def get_unique_filename(directory, filename):
-        """Handle filename collisions by adding incrementing numbers"""
-        if not os.path.exists(os.path.join(directory, filename)):
-            return filename
-        
-        name, ext = os.path.splitext(filename)
-        counter = 1
-        while os.path.exists(os.path.join(directory, f"{name}-{counter}{ext}")):
-            counter += 1
-        return f"{name}-{counter}{ext}"
-    
     @staticmethod
     def save_file(file, folder_path=None, original_filename=None):
         """Save uploaded file with proper organization and create sidecar JSON"""
-        try:
-            # Use provided folder or generate date-based path
+        if BlobStore.enabled():
+            # Hashed while it streams into the blob store; the folder entry is a hard link
+            sha256 = BlobStore.ingest_stream(file.stream)
+            return StorageService._store(folder_path, file.filename, original_filename, file.content_type,
+                                         lambda file_path: BlobStore.link(sha256, file_path), sha256)
+        return StorageService._store(folder_path, file.filename, original_filename, file.content_type, file.save)
+
+    @staticmethod
+    def save_staged(staged_path, folder_path, filename, mimetype, sha256=None):
+        """Move an assembled upload (e.g. a committed chunked upload) into place.
+
+        ``staged_path`` must be on the same filesystem as UPLOAD_FOLDER; the
+        file is renamed, not copied. ``sha256`` is the verified content hash,
+        if known (saves a read pass with DEDUP_STORAGE).
+        """
+        if BlobStore.enabled():
+            sha256 = BlobStore.ingest_file(staged_path, sha256)
+            return StorageService._store(folder_path, filename, filename, mimetype,
+                                         lambda file_path: BlobStore.link(sha256, file_path), sha256)
+        return StorageService._store(folder_path, filename, filename, mimetype,
+                                     lambda file_path: os.replace(staged_path, file_path))
+
+    @staticmethod
+    def _prepare_folder(folder_path):
+        """Validate an upload folder and create it (plus .thumbs/); returns ``(full_dir, folder_path)``."""
+        # If folder_path is '.' or empty, treat as UPLOAD_FOLDER root
+        if folder_path == '.' or folder_path == '':
+            full_dir = current_app.config['UPLOAD_FOLDER']
+            folder_path = '' # Normalize to empty string for consistent relative paths
+        else:
             # Remove leading/trailing slashes and ensure it's safe
-            # If folder_path is '.' or empty, treat as UPLOAD_FOLDER root
-            if folder_path == '.' or folder_path == '':
-                full_dir = current_app.config['UPLOAD_FOLDER']
-                folder_path = '' # Normalize to empty string for consistent relative paths
-            else:
-                # Remove leading/trailing slashes and ensure it's safe
-                folder_path = folder_path.strip('/')
-                if '..' in folder_path or folder_path.startswith('/'):
-                    raise ValueError("Invalid folder path")
-                
-                # Create full directory path
-                full_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], folder_path)
-            
-            os.makedirs(full_dir, exist_ok=True)
+            folder_path = folder_path.strip('/')
+            if '..' in folder_path or folder_path.startswith('/'):
+                raise ValueError("Invalid folder path")
             
-            # Create thumbnails directory
-            thumb_dir = os.path.join(full_dir, '.thumbs')
-            os.makedirs(thumb_dir, exist_ok=True)
+            # Create full directory path
+            full_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], folder_path)
+        
+        # Creates the folder and its thumbnails directory
+        storage_backend().makedirs(folder_path)
+        return full_dir, folder_path
+
+    @staticmethod
+    def _store(folder_path, filename, original_filename, mimetype, write, sha256=None):
+        """Shared part of save_file/save_staged: ``write(file_path)`` puts the bytes in place."""
+        try:
+            full_dir, folder_path = StorageService._prepare_folder(folder_path)
             
             # Get secure filename and handle collisions
-            filename = secure_filename(file.filename)
+            filename = secure_filename(filename)
             if not filename:
                 raise ValueError("Invalid filename")
             
-            unique_filename = StorageService.get_unique_filename(full_dir, filename)
-            
-            # Save original file
+            # Claim a collision-free name and save the original under it
+            write, image_info = StorageService._probing(write)
+            with Metrics.timer('save'):
+                unique_filename = NamingService.create(full_dir, folder_path, filename, write, sha256)
             file_path = os.path.join(full_dir, unique_filename)
-            file.save(file_path)
             
-            # Get file stats
-            file_stats = os.stat(file_path)
+            record, result = StorageService._describe_saved(
+                folder_path, unique_filename, original_filename, mimetype, sha256, image_info=image_info)
+            IndexService.upsert_file(record)
+            ReplicationQueue.record_files([record['path']])
             
-            # Generate public URL (this is the path relative to the UPLOAD_FOLDER)
-            # Use Path.joinpath for cleaner path concatenation, especially when folder_path is empty
-            public_url = str(Path(folder_path).joinpath(unique_filename)).replace('\\', '/')
-            current_app.logger.info(f"StorageService.save_file public_url: {public_url}")
+            logger.debug(f"File saved: {file_path}")
             
-            # Create sidecar JSON file
-            json_filename = Path(unique_filename).stem + ".json"
-            json_path = os.path.join(full_dir, json_filename)
+            return result
             
-            metadata = {
-                'original_name': original_filename if original_filename else unique_filename,
-                'display_name': Path(original_filename).stem if original_filename else Path(unique_filename).stem,
-                'upload_date': datetime.now().isoformat(),
-                'size': file_stats.st_size,
-                'mimetype': file.content_type,
-                'secure_name': unique_filename,
-                'public_url': public_url
-            }
+        except Exception as e:
+            logger.error(f"Error saving file: {str(e)}")
+            raise
+
+    @staticmethod
+    def save_batch(files, folder_path):
+        """Save several uploads into one folder.
+
+        The folder is prepared once; the files are named (see NamingService)
+        and written in parallel together with their sidecars, then indexed in
+        one transaction.
+        Returns one entry per input file, in order: the save_file result, or
+        ``{'error': ...}`` for files that failed (the others are kept).
+        """
+        full_dir, folder_path = StorageService._prepare_folder(folder_path)
+        app = current_app._get_current_object()
+
+        def store(file):
+            filename = secure_filename(file.filename or '')
+            if not filename:
+                raise ValueError("Invalid filename")
+            with app.app_context():
+                sha256, write = None, file.save
+                if BlobStore.enabled():
+                    sha256 = BlobStore.ingest_stream(file.stream)
+                    write = lambda file_path: BlobStore.link(sha256, file_path)
+                write, image_info = StorageService._probing(write)
+                with Metrics.timer('save'):
+                    unique_filename = NamingService.create(full_dir, folder_path, filename, write, sha256)
+                return StorageService._describe_saved(
+                    folder_path, unique_filename, file.filename, file.content_type, sha256, image_info=image_info)
+
+        results, records = [], []
+        workers = max(1, min(current_app.config['BATCH_UPLOAD_WORKERS'], len(files)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(store, file) for file in files]
+            for file, future in zip(files, futures):
+                try:
+                    record, result = future.result()
+                    records.append(record)
+                    results.append(result)
+                except Exception as e:
+                    logger.error(f"Error saving file '{file.filename}' in batch: {str(e)}")
+                    results.append({'error': str(e), 'original_name': file.filename})
+
+        IndexService.upsert_files(records)
+        ReplicationQueue.record_files([record['path'] for record in records])
+        logger.info(f"Batch saved {len(records)} of {len(files)} files in {full_dir}")
+        return results
+
+    @staticmethod
+    def _probing(write):
+        """Wrap an upload's ``write(path)`` so the image header is read right after
+        the bytes are in place (still in the page cache, and before an object
+        store upload). Returns ``(write, info)``; ``info`` is filled by the call."""
+        image_info = {}
+
+        def write_and_probe(path):
+            write(path)
+            with Metrics.timer('metadata'):
+                image_info.update(ImageInfoService.extract(path))
+
+        return write_and_probe, image_info
+
+    @staticmethod
+    def _describe_saved(folder_path, unique_filename, original_filename, mimetype, sha256=None,
+                        upload_date=None, image_info=None):
+        """Write the sidecar for a stored original; returns ``(index record, API result)``.
+
+        ``image_info`` is the ImageInfoService.extract result, if the caller has it.
+        """
+        backend = storage_backend()
+
+        # Generate public URL (this is the path relative to the UPLOAD_FOLDER)
+        # Use Path.joinpath for cleaner path concatenation, especially when folder_path is empty
+        public_url = str(Path(folder_path).joinpath(unique_filename)).replace('\\', '/')
+        current_app.logger.debug(f"StorageService.save_file public_url: {public_url}")
+
+        # Get file stats
+        with Metrics.timer('stat'):
+            file_stats = backend.stat(public_url)
+        
+        # Create sidecar JSON file
+        json_filename = Path(unique_filename).stem + ".json"
+        json_path = str(Path(folder_path).joinpath(json_filename)).replace('\\', '/')
+        
+        metadata = {
+            'original_name': original_filename if original_filename else unique_filename,
+            'display_name': Path(original_filename).stem if original_filename else Path(unique_filename).stem,
+            'upload_date': upload_date or datetime.now().isoformat(),
+            'size': file_stats.st_size,
+            'mimetype': mimetype,
+            'secure_name': unique_filename,
+            'public_url': public_url
+        }
+        if sha256:
+            metadata['sha256'] = sha256
+        if image_info is None:
+            with backend.fetch(public_url) as local_file, Metrics.timer('metadata'):
+                image_info = ImageInfoService.extract(local_file)
+        metadata.update((key, image_info[key]) for key in SIDECAR_KEYS if key in image_info)
+        
+        backend.put_bytes(json_path, json.dumps(metadata, indent=4).encode())
+        
+        record = {
+            'path': public_url,
+            'folder': folder_path,
+            'name': unique_filename,
+            'size': file_stats.st_size,
+            'mtime': file_stats.st_mtime,
+            'thumb': None,
+            'thumb_status': None,
+            'display_name': metadata['display_name'],
+            'original_name': metadata['original_name'],
+            'upload_date': metadata['upload_date'],
+            'mimetype': metadata['mimetype'],
+            'sha256': sha256,
+            'width': metadata.get('width'),
+            'height': metadata.get('height'),
+            'taken_at': metadata.get('taken_at'),
+            'camera': metadata.get('camera')
+        }
+        result = {
+            'url': public_url,
+            'path': public_url,
+            'name': unique_filename,
+            'size': file_stats.st_size,
+            'type': mimetype,
+            'display_name': metadata['display_name'],
+            'upload_date': metadata['upload_date'],
+            'taken_at': metadata.get('taken_at'),
+            'width': metadata.get('width'),
+            'height': metadata.get('height')
+        }
+        return record, result
+    
+    @staticmethod
+    def update_sidecar(relative_path, fields):
+        """Merge ``fields`` into the sidecar of an original (no-op if it has none)."""
+        backend = storage_backend()
+        json_path = str(Path(relative_path).with_suffix('.json')).replace('\\', '/')
+        try:
+            with backend.open(json_path) as f:
+                metadata = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not update sidecar {json_path}: {e}")
+            return
+        metadata.update(fields)
+        backend.put_bytes(json_path, json.dumps(metadata, indent=4).encode())
+        ReplicationQueue.record_sidecars([relative_path])
+
+    @staticmethod
+    def list_files(path=''):
+        """List files in a given path (from the metadata index, or a directory scan if it is disabled)"""
+        try:
+            # Sanitize path
+            path = path.strip('/')
+            if '..' in path:
+                raise ValueError("Invalid path")
             
-            with open(json_path, 'w') as f:
-                json.dump(metadata, f, indent=4)
+            # Directories first, then files by name
+            if not IndexService.enabled():
+                full_path = os.path.join(current_app.config['UPLOAD_FOLDER'], path) if path else current_app.config['UPLOAD_FOLDER']
+                if not os.path.isdir(full_path):
+                    return []
+                return scanner.list_directory(full_path, path)
             
-            logger.info(f"File saved: {file_path}, Metadata saved: {json_path}")
+            if not IndexService.folder_exists(path):
+                logger.debug(f"StorageService.list_files Path not indexed: '{path}'")
+                return []
             
-            return {
-                'url': public_url,
-                'path': str(Path(folder_path).joinpath(unique_filename)).replace('\\', '/'),
-                'name': unique_filename,
-                'size': file_stats.st_size,
-                'type': file.content_type,
-                'display_name': metadata['display_name'],
-                'upload_date': metadata['upload_date']
-            }
+            return IndexService.list_folder(path)
             
         except Exception as e:
-            logger.error(f"Error saving file: {str(e)}")
+            logger.error(f"Error listing files: {str(e)}")
             raise
     
     @staticmethod
-    def list_files(path=''):
-        """List files in a given path"""
+    def folder_tree(path='', depth=1):
+        """Folder hierarchy below ``path`` to ``depth`` levels with subtree file counts and bytes.
+
+        Returns ``(version, node)``; the version changes with every change to the tree.
+        """
         try:
-            current_app.logger.info(f"StorageService.list_files called with path: '{path}'")
-            current_app.logger.info(f"StorageService.list_files UPLOAD_FOLDER: {current_app.config['UPLOAD_FOLDER']}")
+            path = path.strip('/')
+            if '..' in path:
+                raise ValueError("Invalid path")
+            if depth < 0:
+                raise ValueError("depth must not be negative")
 
-            # Sanitize path
+            if not IndexService.enabled():
+                full_path = os.path.join(current_app.config['UPLOAD_FOLDER'], path) if path else current_app.config['UPLOAD_FOLDER']
+                if not os.path.isdir(full_path):
+                    raise FileNotFoundError(f"Folder not found: {path}")
+                return scanner.tree_directory(full_path, path, depth)
+
+            return IndexService.tree(path, depth)
+
+        except Exception as e:
+            logger.error(f"Error building folder tree: {str(e)}")
+            raise
+
+    @staticmethod
+    def list_page(path='', limit=100, cursor=None, sort='name', order='asc', prefix=None, mimetype=None,
+                  taken_from=None, taken_to=None):
+        """List one page of a folder, see IndexService.list_page. Capture dates are ISO dates or datetimes (both inclusive).
+
+        With THUMBNAIL_SPRITES the page also carries the folder's sprite sheet (see SpriteService.attach).
+        """
+        try:
             path = path.strip('/')
             if '..' in path:
                 raise ValueError("Invalid path")
             
-            full_path = os.path.join(current_app.config['UPLOAD_FOLDER'], path) if path else current_app.config['UPLOAD_FOLDER']
-            current_app.logger.info(f"StorageService.list_files full_path: {full_path}")
+            taken_from = StorageService._date_bound(taken_from)
+            taken_to = StorageService._date_bound(taken_to, end=True)
             
-            if not os.path.exists(full_path):
-                current_app.logger.info(f"StorageService.list_files Path does not exist: {full_path}")
-                return []
+            if not IndexService.enabled():
+                full_path = os.path.join(current_app.config['UPLOAD_FOLDER'], path) if path else current_app.config['UPLOAD_FOLDER']
+                if not os.path.isdir(full_path):
+                    return {'items': [], 'next_cursor': None}
+                return scanner.page_directory(full_path, path, limit, cursor=cursor, sort=sort, order=order,
+                                              prefix=prefix, mimetype=mimetype,
+                                              taken_from=taken_from, taken_to=taken_to)
             
-            files = []
-            for item in os.listdir(full_path):
-                current_app.logger.info(f"StorageService.list_files processing item: {item}")
-                if item.startswith('.'):
-                    current_app.logger.info(f"StorageService.list_files skipping hidden item: {item}")
-                    continue
-                
-                # Skip .json files as they are sidecar metadata and not to be displayed as separate files
-                if item.endswith('.json'):
-                    current_app.logger.info(f"StorageService.list_files skipping JSON metadata file: {item}")
-                    continue
-                    
-                item_path = os.path.join(full_path, item)
-                # relative_path is the path relative to UPLOAD_FOLDER (e.g., "2025/07/06/my_image.png")
-                relative_path = os.path.join(path, item).replace('\\', '/')
-                current_app.logger.info(f"StorageService.list_files relative_path for item {item}: {relative_path}")
-                
-                if os.path.isfile(item_path):
-                    stats = os.stat(item_path)
-                    
-                    # Check for thumbnail
-                    # Thumbnail filename has .jpg extension, regardless of original file type
-                    thumb_name = Path(item).stem + ".jpg" 
-                    thumb_path_full = os.path.join(full_path, '.thumbs', thumb_name)
-                    thumb_url = None
-                    current_app.logger.info(f"StorageService.list_files checking thumb_path_full: {thumb_path_full}")
-                    if os.path.exists(thumb_path_full):
-                        # Construct relative path for thumbnail (e.g., "2025/07/06/.thumbs/my_image.jpg")
-                        thumb_relative_path = os.path.join(os.path.dirname(relative_path), '.thumbs', thumb_name).replace('\\', '/')
-                        thumb_url = thumb_relative_path
-                        current_app.logger.info(f"StorageService.list_files thumb_url generated: {thumb_url}")
-                    else:
-                        current_app.logger.info(f"StorageService.list_files thumbnail not found for {item}")
-                    
-                    # Try to read sidecar JSON for metadata
-                    metadata = {}
-                    json_path = os.path.join(full_path, Path(item).stem + ".json")
-                    if os.path.exists(json_path):
-                        try:
-                            with open(json_path, 'r') as f:
-                                metadata = json.load(f)
-                        except json.JSONDecodeError:
-                            logger.warning(f"Error decoding JSON for {json_path}. Skipping metadata.")
-                    
-                    display_name = metadata.get('display_name', Path(item).stem)
-                    upload_date = metadata.get('upload_date', datetime.fromtimestamp(stats.st_mtime).isoformat())
-
-                    files.append({
-                        'name': item,
-                        'display_name': display_name, # Use display_name from metadata
-                        'path': relative_path, # Add the full relative path
-                        'url': relative_path, # This is now just the path relative to UPLOAD_FOLDER
-                        'size': stats.st_size,
-                        'thumb': thumb_url,
-                        'mtime': stats.st_mtime,
-                        'upload_date': upload_date, # Use upload_date from metadata
-                        'type': 'file'
-                    })
-                elif os.path.isdir(item_path):
-                    current_app.logger.info(f"StorageService.list_files found directory: {item}")
-                    files.append({
-                        'name': item,
-                        'path': relative_path,
-                        'type': 'directory'
-                    })
+            if not IndexService.folder_exists(path):
+                return {'items': [], 'next_cursor': None}
             
-            # Sort directories first, then files by name
-            files.sort(key=lambda x: (x['type'] != 'directory', x['name']))
-            return files
+            page = IndexService.list_page(path, limit, cursor=cursor, sort=sort, order=order,
+                                          prefix=prefix, mimetype=mimetype,
+                                          taken_from=taken_from, taken_to=taken_to)
+            if SpriteService.enabled():
+                SpriteService.attach(path, page)
+            return page
             
         except Exception as e:
             logger.error(f"Error listing files: {str(e)}")
             raise
     
+    @staticmethod
+    def search(query=None, folder=None, mimetypes=None, date_from=None, date_to=None,
+               min_size=None, max_size=None, sort='upload_date', order='desc', limit=50, cursor=None,
+               taken_from=None, taken_to=None):
+        """Search the whole tree, see IndexService.search. Dates are ISO dates or datetimes (both inclusive)."""
+        try:
+            if not IndexService.enabled():
+                raise RuntimeError("Search requires the metadata index (METADATA_INDEX)")
+            folder = (folder or '').strip('/')
+            if '..' in folder:
+                raise ValueError("Invalid folder")
+            return IndexService.search(
+                query=query, folder=folder or None, mimetypes=mimetypes,
+                date_from=StorageService._date_bound(date_from),
+                date_to=StorageService._date_bound(date_to, end=True),
+                min_size=min_size, max_size=max_size, sort=sort, order=order, limit=limit, cursor=cursor,
+                taken_from=StorageService._date_bound(taken_from),
+                taken_to=StorageService._date_bound(taken_to, end=True))
+
+        except Exception as e:
+            logger.error(f"Error searching files: {str(e)}")
+            raise
+
+    @staticmethod
+    def _date_bound(value, end=False):
+        """ISO date/datetime -> string comparable with upload_date; ``end`` makes a date inclusive."""
+        if not value:
+            return None
+        try:
+            parsed = datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"Invalid date: {value}")
+        if end and len(value) == 10:
+            # A plain date covers the whole day
+            return (parsed + timedelta(days=1)).isoformat()
+        if end:
+            # Sorts after any fraction of the given second
+            return parsed.isoformat() + '\uffff'
+        return parsed.isoformat()
+
     @staticmethod
     def create_folder(path):
         """Create a new folder"""
@@ -201,14 +384,12 @@ class StorageService:
             if '..' in path or not path:
                 raise ValueError("Invalid path")
             
-            full_path = os.path.join(current_app.config['UPLOAD_FOLDER'], path)
-            os.makedirs(full_path, exist_ok=True)
+            # Creates the folder and its thumbnails directory
+            storage_backend().makedirs(path)
             
-            # Create thumbnails directory
-            thumb_dir = os.path.join(full_path, '.thumbs')
-            os.makedirs(thumb_dir, exist_ok=True)
+            IndexService.add_folder(path)
             
-            logger.info(f"Folder created: {full_path}")
+            logger.info(f"Folder created: {path}")
             return True
             
         except Exception as e:
@@ -227,45 +408,49 @@ class StorageService:
             if not new_name:
                 raise ValueError("Invalid new file name")
 
-            base_upload_folder = current_app.config['UPLOAD_FOLDER']
-            old_full_path = os.path.join(base_upload_folder, old_relative_path)
+            backend = storage_backend()
+            old_full_path = os.path.join(current_app.config['UPLOAD_FOLDER'], old_relative_path)
             
-            if not os.path.exists(old_full_path):
+            if not backend.exists(old_relative_path):
                 raise FileNotFoundError(f"File not found: {old_full_path}")
 
-            # Determine new full path
+            # Claim a collision-free new name; the rename replaces its placeholder
+            old_folder = os.path.dirname(old_relative_path)
             old_dir = os.path.dirname(old_full_path)
-            new_full_path = os.path.join(old_dir, new_name)
-
-            # Handle filename collisions for the new name
-            new_full_path_unique = StorageService.get_unique_filename(old_dir, new_name)
-            new_name_unique = os.path.basename(new_full_path_unique)
+            new_name_unique = NamingService.reserve(old_dir, old_folder, new_name)
+            new_relative_path = os.path.join(old_folder, new_name_unique).replace('\\', '/')
 
             # Rename main file
-            os.rename(old_full_path, new_full_path_unique)
-            logger.info(f"File renamed from {old_full_path} to {new_full_path_unique}")
+            try:
+                backend.rename(old_relative_path, new_relative_path)
+            except OSError:
+                backend.remove(new_relative_path)
+                raise
+            logger.info(f"File renamed from {old_relative_path} to {new_relative_path}")
 
             # Rename thumbnail
-            old_thumb_name = Path(old_full_path).stem + ".jpg"
-            old_thumb_path = os.path.join(old_dir, '.thumbs', old_thumb_name)
-            if os.path.exists(old_thumb_path):
-                new_thumb_name = Path(new_full_path_unique).stem + ".jpg"
-                new_thumb_path = os.path.join(old_dir, '.thumbs', new_thumb_name)
-                os.rename(old_thumb_path, new_thumb_path)
-                logger.info(f"Thumbnail renamed from {old_thumb_path} to {new_thumb_path}")
+            old_thumb_path = ThumbnailService.thumbnail_path_for(old_relative_path).replace('\\', '/')
+            new_thumb = None
+            if backend.exists(old_thumb_path):
+                new_thumb = ThumbnailService.thumbnail_path_for(new_relative_path).replace('\\', '/')
+                backend.rename(old_thumb_path, new_thumb)
+                logger.info(f"Thumbnail renamed from {old_thumb_path} to {new_thumb}")
 
             # Rename sidecar JSON (if implemented)
-            old_json_name = Path(old_full_path).stem + ".json"
-            old_json_path = os.path.join(old_dir, old_json_name)
-            if os.path.exists(old_json_path):
-                new_json_name = Path(new_full_path_unique).stem + ".json"
-                new_json_path = os.path.join(old_dir, new_json_name)
-                os.rename(old_json_path, new_json_path)
+            old_json_path = os.path.join(old_folder, Path(old_relative_path).stem + ".json").replace('\\', '/')
+            if backend.exists(old_json_path):
+                new_json_path = os.path.join(old_folder, Path(new_name_unique).stem + ".json").replace('\\', '/')
+                backend.rename(old_json_path, new_json_path)
                 logger.info(f"Sidecar JSON renamed from {old_json_path} to {new_json_path}")
+
+            IndexService.rename_file(old_relative_path, new_relative_path, new_thumb)
+            ThumbnailQueue.move(old_relative_path, new_relative_path)
+            ReplicationQueue.record_move(old_relative_path, new_relative_path)
+            RenditionService.discard(old_relative_path)
             
             return {
                 'old_path': old_relative_path,
-                'new_path': os.path.join(os.path.dirname(old_relative_path), new_name_unique).replace('\\', '/'),
+                'new_path': new_relative_path,
                 'new_name': new_name_unique
             }
 
@@ -281,32 +466,29 @@ class StorageService:
             if '..' in relative_path or not relative_path:
                 raise ValueError("Invalid file path")
 
-            base_upload_folder = current_app.config['UPLOAD_FOLDER']
-            full_path = os.path.join(base_upload_folder, relative_path)
+            backend = storage_backend()
+            full_path = os.path.join(current_app.config['UPLOAD_FOLDER'], relative_path)
 
-            if not os.path.exists(full_path):
+            try:
+                stats = backend.stat(relative_path)
+            except FileNotFoundError:
+                if backend.isdir(relative_path):
+                    raise ValueError(f"Path is not a file: {full_path}")
                 raise FileNotFoundError(f"File not found: {full_path}")
             
-            if not os.path.isfile(full_path):
+            if not stat.S_ISREG(stats.st_mode):
                 raise ValueError(f"Path is not a file: {full_path}")
 
-            # Delete main file
-            os.remove(full_path)
-            logger.info(f"File deleted: {full_path}")
-
-            # Delete thumbnail
-            thumb_name = Path(full_path).stem + ".jpg"
-            thumb_path = os.path.join(os.path.dirname(full_path), '.thumbs', thumb_name)
-            if os.path.exists(thumb_path):
-                os.remove(thumb_path)
-                logger.info(f"Thumbnail deleted: {thumb_path}")
-
-            # Delete sidecar JSON (if implemented)
-            json_name = Path(full_path).stem + ".json"
-            json_path = os.path.join(os.path.dirname(full_path), json_name)
-            if os.path.exists(json_path):
-                os.remove(json_path)
-                logger.info(f"Sidecar JSON deleted: {json_path}")
+            # Delete main file, thumbnail and sidecar JSON (missing ones are skipped)
+            backend.remove(relative_path)
+            logger.info(f"File deleted: {relative_path}")
+            backend.remove(ThumbnailService.thumbnail_path_for(relative_path).replace('\\', '/'))
+            backend.remove(str(Path(relative_path).with_suffix('.json')))
+            
+            IndexService.remove_file(relative_path)
+            ThumbnailQueue.discard(relative_path)
+            ReplicationQueue.record_files([relative_path])
+            RenditionService.discard(relative_path)
             
             return {'message': 'File deleted successfully', 'path': relative_path}
 
@@ -322,20 +504,25 @@ class StorageService:
             if '..' in relative_path or not relative_path:
                 raise ValueError("Invalid folder path")
 
+            backend = storage_backend()
             base_upload_folder = current_app.config['UPLOAD_FOLDER']
             full_path = os.path.join(base_upload_folder, relative_path)
 
-            if not os.path.exists(full_path):
+            if not backend.isdir(relative_path):
+                if backend.exists(relative_path):
+                    raise ValueError(f"Path is not a directory: {full_path}")
                 raise FileNotFoundError(f"Folder not found: {full_path}")
 
-            if not os.path.isdir(full_path):
-                raise ValueError(f"Path is not a directory: {full_path}")
-
-            shutil.rmtree(full_path)
+            backend.rmtree(relative_path)
+            IndexService.remove_folder(relative_path)
+            ThumbnailQueue.discard_folder(relative_path)
+            ReplicationQueue.record_folder(relative_path)
+            RenditionService.discard_folder(relative_path)
             logger.info(f"Folder deleted: {full_path}")
 
-            # Clean up parent directories if they become empty
-            StorageService._cleanup_empty_parent_dirs(full_path, base_upload_folder)
+            # Clean up parent directories if they become empty (object stores have none)
+            if backend.is_local:
+                StorageService._cleanup_empty_parent_dirs(full_path, base_upload_folder)
 
             return {'message': 'Folder deleted successfully', 'path': relative_path}
 
@@ -355,27 +542,30 @@ class StorageService:
             if not new_name:
                 raise ValueError("Invalid new folder name")
 
-            base_upload_folder = current_app.config['UPLOAD_FOLDER']
-            old_full_path = os.path.join(base_upload_folder, old_relative_path)
+            backend = storage_backend()
+            old_full_path = os.path.join(current_app.config['UPLOAD_FOLDER'], old_relative_path)
             
-            if not os.path.exists(old_full_path):
+            if not backend.isdir(old_relative_path):
+                if backend.exists(old_relative_path):
+                    raise ValueError(f"Path is not a directory: {old_full_path}")
                 raise FileNotFoundError(f"Folder not found: {old_full_path}")
-            
-            if not os.path.isdir(old_full_path):
-                raise ValueError(f"Path is not a directory: {old_full_path}")
 
-            parent_dir = os.path.dirname(old_full_path)
-            new_full_path = os.path.join(parent_dir, new_name)
+            new_relative_path = os.path.join(os.path.dirname(old_relative_path), new_name).replace('\\', '/')
 
-            if os.path.exists(new_full_path):
+            if backend.exists(new_relative_path):
                 raise FileExistsError(f"Folder with new name '{new_name}' already exists.")
 
-            os.rename(old_full_path, new_full_path)
-            logger.info(f"Folder renamed from {old_full_path} to {new_full_path}")
+            backend.rename(old_relative_path, new_relative_path)
+            logger.info(f"Folder renamed from {old_relative_path} to {new_relative_path}")
+
+            IndexService.rename_folder(old_relative_path, new_relative_path)
+            ThumbnailQueue.move_folder(old_relative_path, new_relative_path)
+            ReplicationQueue.record_folder(new_relative_path, source=old_relative_path)
+            RenditionService.discard_folder(old_relative_path)
 
             return {
                 'old_path': old_relative_path,
-                'new_path': os.path.join(os.path.dirname(old_relative_path), new_name).replace('\\', '/'),
+                'new_path': new_relative_path,
                 'new_name': new_name
             }
 
@@ -397,6 +587,7 @@ class StorageService:
                 # For now, if it's empty according to os.listdir, we delete it.
                 if not os.listdir(current_dir):
                     os.rmdir(current_dir)
+                    IndexService.remove_folder(current_dir.relative_to(base_path_obj).as_posix())
                     logger.info(f"Cleaned up empty directory: {current_dir}")
                 else:
                     break # Stop if a parent directory is not empty
@@ -0,0 +1,337 @@
+import os
+import time
+import atexit
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from flask import current_app
+from services.index import IndexService, _subtree_bounds, file_version
+from services.thumbs import ThumbnailService
+from services.blobs import BlobStore
+from services.backends import storage_backend
+from services.metrics import Metrics
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _render_job(original_path, thumb_path, size, encoding):
+    """Runs in a pool process: no app context, everything is passed in. Returns the placeholder."""
+    if not os.path.exists(original_path):
+        raise FileNotFoundError(original_path)
+    os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+    placeholder = ThumbnailService.generate_thumbnail(original_path, thumb_path, size, encoding)
+    if not placeholder:
+        raise RuntimeError(f"Thumbnail generation failed for {original_path}")
+    return placeholder
+
+
+def _render_in_pool(original_path, thumb_path, size, encoding):
+    """_render_job for the process pool; returns ``(placeholder, metrics recorded in the pool process)``."""
+    placeholder = _render_job(original_path, thumb_path, size, encoding)
+    return placeholder, Metrics.drain()
+
+
+def _render_remote(backend, path, thumb_path, size, encoding, pool=None):
+    """Download the original, render it (in ``pool`` if given) and upload the thumbnail.
+
+    Returns ``(placeholder, metrics)`` like _render_in_pool; metrics is None when rendered here.
+    """
+    with backend.fetch(path) as original, backend.writer(thumb_path) as tmp_path:
+        if pool is None:
+            return _render_job(original, tmp_path, size, encoding), None
+        return pool.submit(_render_in_pool, original, tmp_path, size, encoding).result()
+
+
+class ThumbnailQueue:
+    """Persistent thumbnail job queue, stored in the index database.
+
+    Jobs are keyed by the original's path relative to UPLOAD_FOLDER. A claimed
+    job that is not finished within THUMBNAIL_JOB_LEASE seconds (worker crash,
+    restart) is handed out again.
+    """
+
+    @staticmethod
+    def submit(relative_path):
+        """Schedule the thumbnail for a freshly saved original.
+
+        Returns the thumb_status to report to the client: 'pending' when queued,
+        or 'ready'/'failed' when THUMBNAIL_WORKERS is 0 and it ran inline.
+        """
+        return ThumbnailQueue.submit_many([relative_path])[relative_path]
+
+    @staticmethod
+    def submit_many(paths):
+        """submit() for a batch of originals; returns ``{path: thumb_status}``.
+
+        Queued with a single index transaction. When THUMBNAIL_WORKERS is 0 the
+        thumbnails are rendered inline on a thread pool (Pillow releases the GIL
+        while decoding and resizing).
+        """
+        if not paths:
+            return {}
+        statuses = {}
+        if BlobStore.enabled():
+            # Content seen before: hard-link its thumbnail instead of rendering again
+            statuses = {path: 'ready' for path in BlobStore.link_thumbnails(paths)}
+            paths = [path for path in paths if path not in statuses]
+            if not paths:
+                return statuses
+        if current_app.config['THUMBNAIL_WORKERS'] <= 0:
+            backend = storage_backend()
+            size = current_app.config['THUMBNAIL_SIZE']
+            encoding = ThumbnailService.encoding_options()
+
+            # Resolved here: the pool threads have no app context
+            jobs = [(path, ThumbnailQueue.thumb_relative_path(path)) for path in paths]
+
+            def render(job):
+                path, thumb_path = job
+                if backend.is_local:
+                    thumb_path = backend.local_path(thumb_path)
+                    os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+                    return ThumbnailService.generate_thumbnail(backend.local_path(path), thumb_path, size, encoding)
+                try:
+                    placeholder, _ = _render_remote(backend, path, thumb_path, size, encoding)
+                    return placeholder
+                except Exception as e:
+                    logger.error(f"Error generating thumbnail for {path}: {e}")
+                    return False
+
+            with ThreadPoolExecutor(max_workers=min(len(paths), os.cpu_count() or 1)) as executor:
+                results = dict(zip(paths, executor.map(render, jobs)))
+            for path, placeholder in results.items():
+                if placeholder:
+                    ThumbnailQueue._store_result(path, placeholder)
+                else:
+                    IndexService.set_thumb_status(path, 'failed')
+                statuses[path] = 'ready' if placeholder else 'failed'
+            if BlobStore.enabled():
+                BlobStore.share_thumbnails([path for path, ok in results.items() if ok])
+            return statuses
+
+        ThumbnailQueue.enqueue(paths)
+        ThumbnailWorker.ensure_started(current_app._get_current_object())
+        statuses.update((path, 'pending') for path in paths)
+        return statuses
+
+    @staticmethod
+    def enqueue(paths):
+        """Queue (or re-queue) thumbnail jobs for several originals at once."""
+        now = time.time()
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            conn.executemany(
+                "INSERT INTO thumb_jobs (path, status, attempts, created_at) VALUES (?, 'queued', 0, ?) "
+                "ON CONFLICT(path) DO UPDATE SET status = 'queued', attempts = 0, error = NULL, claimed_at = NULL",
+                [(path, now) for path in paths])
+            if IndexService.enabled():
+                conn.executemany("UPDATE files SET thumb_status = 'pending' WHERE path = ?",
+                                 [(path,) for path in paths])
+
+    @staticmethod
+    def thumb_relative_path(relative_path):
+        return ThumbnailService.thumbnail_path_for(relative_path).replace('\\', '/')
+
+    @staticmethod
+    def claim(limit):
+        """Atomically lease up to ``limit`` jobs to the caller."""
+        now = time.time()
+        lease_expired = now - current_app.config['THUMBNAIL_JOB_LEASE']
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            rows = conn.execute(
+                "SELECT path, attempts FROM thumb_jobs "
+                "WHERE status = 'queued' OR (status = 'running' AND claimed_at < ?) "
+                "ORDER BY created_at LIMIT ?", (lease_expired, limit)).fetchall()
+            conn.executemany(
+                "UPDATE thumb_jobs SET status = 'running', claimed_at = ?, attempts = attempts + 1 WHERE path = ?",
+                [(now, row['path']) for row in rows])
+        return [(row['path'], row['attempts'] + 1) for row in rows]
+
+    @staticmethod
+    def complete(path, placeholder=None):
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            conn.execute('DELETE FROM thumb_jobs WHERE path = ?', (path,))
+        ThumbnailQueue._store_result(path, placeholder)
+        if BlobStore.enabled():
+            BlobStore.share_thumbnails([path])
+
+    @staticmethod
+    def _store_result(path, placeholder):
+        """Mark the thumbnail ready; its version and the placeholder go into the
+        sidecar and the index, so directory scans need not stat thumbnails."""
+        thumb_path = ThumbnailQueue.thumb_relative_path(path)
+        try:
+            st = storage_backend().stat(thumb_path)
+            version = file_version(st.st_mtime, st.st_size)
+        except FileNotFoundError:
+            version = None  # Replaced or removed meanwhile; served unversioned
+        # storage imports this module
+        from services.storage import StorageService
+        StorageService.update_sidecar(path, dict(placeholder or {}, thumb_version=version))
+        IndexService.set_thumb(path, thumb_path, placeholder=placeholder, version=version)
+
+    @staticmethod
+    def fail(path, attempts, error):
+        """Record a failed attempt; retry until THUMBNAIL_MAX_ATTEMPTS, then mark the job failed."""
+        conn = IndexService.connect()
+        if isinstance(error, FileNotFoundError):
+            # The original was deleted or renamed in the meantime
+            with IndexService._transaction(conn):
+                conn.execute('DELETE FROM thumb_jobs WHERE path = ?', (path,))
+            return
+        final = attempts >= current_app.config['THUMBNAIL_MAX_ATTEMPTS']
+        with IndexService._transaction(conn):
+            conn.execute('UPDATE thumb_jobs SET status = ?, error = ?, claimed_at = NULL WHERE path = ?',
+                         ('failed' if final else 'queued', str(error), path))
+        if final:
+            IndexService.set_thumb_status(path, 'failed')
+            logger.error(f"Thumbnail job failed permanently for {path}: {error}")
+
+    @staticmethod
+    def move(old_path, new_path):
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            conn.execute('UPDATE OR REPLACE thumb_jobs SET path = ? WHERE path = ?', (new_path, old_path))
+
+    @staticmethod
+    def move_folder(old_path, new_path):
+        low, high = _subtree_bounds(old_path)
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            conn.execute('UPDATE OR REPLACE thumb_jobs SET path = ? || substr(path, ?) WHERE path > ? AND path < ?',
+                         (new_path, len(old_path) + 1, low, high))
+
+    @staticmethod
+    def discard(path):
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            conn.execute('DELETE FROM thumb_jobs WHERE path = ?', (path,))
+
+    @staticmethod
+    def discard_folder(path):
+        low, high = _subtree_bounds(path)
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            conn.execute('DELETE FROM thumb_jobs WHERE path > ? AND path < ?', (low, high))
+
+    @staticmethod
+    def apply_changes(changes):
+        """Follow a bulk operation (see IndexService.apply_changes) in one transaction."""
+        if not changes:
+            return
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            for change in changes:
+                op = change['op']
+                if op == 'remove_file':
+                    conn.execute('DELETE FROM thumb_jobs WHERE path = ?', (change['path'],))
+                elif op == 'move_file':
+                    conn.execute('UPDATE OR REPLACE thumb_jobs SET path = ? WHERE path = ?', (change['new'], change['old']))
+                elif op == 'remove_folder':
+                    low, high = _subtree_bounds(change['path'])
+                    conn.execute('DELETE FROM thumb_jobs WHERE path > ? AND path < ?', (low, high))
+                elif op == 'move_folder':
+                    low, high = _subtree_bounds(change['old'])
+                    conn.execute('UPDATE OR REPLACE thumb_jobs SET path = ? || substr(path, ?) WHERE path > ? AND path < ?',
+                                 (change['new'], len(change['old']) + 1, low, high))
+
+    @staticmethod
+    def stats():
+        conn = IndexService.connect()
+        return {row['status']: row['count'] for row in conn.execute(
+            'SELECT status, COUNT(*) AS count FROM thumb_jobs GROUP BY status')}
+
+
+class ThumbnailWorker:
+    """Dispatcher thread feeding queued jobs into a process pool.
+
+    Started lazily in each app process (so it survives gunicorn's fork), or in
+    the foreground with ``flask thumbs worker``.
+    """
+
+    _lock = threading.Lock()
+    _thread = None
+    _pid = None
+    _stop = threading.Event()
+
+    @staticmethod
+    def init_app(app):
+        if app.config['THUMBNAIL_WORKERS'] > 0 and app.config['THUMBNAIL_WORKER_IN_APP']:
+            # Pick up jobs left over from before a restart
+            app.before_request(lambda: ThumbnailWorker.ensure_started(app))
+
+    @staticmethod
+    def ensure_started(app):
+        if not app.config['THUMBNAIL_WORKER_IN_APP']:
+            return
+        if ThumbnailWorker._thread is not None and ThumbnailWorker._pid == os.getpid():
+            return
+        with ThumbnailWorker._lock:
+            if ThumbnailWorker._thread is not None and ThumbnailWorker._pid == os.getpid():
+                return
+            ThumbnailWorker._pid = os.getpid()
+            ThumbnailWorker._thread = threading.Thread(
+                target=ThumbnailWorker.run, args=(app,), name='thumbnail-dispatcher', daemon=True)
+            ThumbnailWorker._thread.start()
+
+    @staticmethod
+    def run(app, once=False):
+        """Dispatch loop. With ``once`` it returns as soon as the queue is drained."""
+        workers = max(1, app.config['THUMBNAIL_WORKERS'])
+        poll = app.config['THUMBNAIL_QUEUE_POLL']
+        size = app.config['THUMBNAIL_SIZE']
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        atexit.register(pool.shutdown, wait=False, cancel_futures=True)
+        staging = None
+        inflight = {}
+        logger.info(f"Thumbnail worker started with {workers} processes (pid {os.getpid()})")
+
+        with app.app_context():
+            encoding = ThumbnailService.encoding_options()
+            backend = storage_backend()
+            if not backend.is_local:
+                # Downloads and uploads overlap with rendering
+                staging = ThreadPoolExecutor(max_workers=workers * 2, thread_name_prefix='thumbnail-staging')
+            while not ThumbnailWorker._stop.is_set():
+                try:
+                    free = workers * 2 - len(inflight)
+                    if free > 0:
+                        for path, attempts in ThumbnailQueue.claim(free):
+                            thumb_path = ThumbnailQueue.thumb_relative_path(path)
+                            if staging is not None:
+                                future = staging.submit(_render_remote, backend, path, thumb_path, size,
+                                                        encoding, pool)
+                            else:
+                                future = pool.submit(_render_in_pool, backend.local_path(path),
+                                                     backend.local_path(thumb_path), size, encoding)
+                            inflight[future] = (path, attempts)
+
+                    if not inflight:
+                        if once:
+                            break
+                        ThumbnailWorker._stop.wait(poll)
+                        continue
+
+                    done, _ = wait(inflight, timeout=poll, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        path, attempts = inflight.pop(future)
+                        error = future.exception()
+                        if error is None:
+                            placeholder, metrics = future.result()
+                            ThumbnailQueue.complete(path, placeholder)
+                            Metrics.merge(metrics)
+                        else:
+                            ThumbnailQueue.fail(path, attempts, error)
+                    Metrics.maybe_flush(app.config)
+                except Exception as e:
+                    logger.error(f"Thumbnail dispatcher error: {e}", exc_info=True)
+                    ThumbnailWorker._stop.wait(poll)
+
+            Metrics.maybe_flush(app.config, force=True)
+
+        if staging is not None:
+            staging.shutdown(wait=True)
+        pool.shutdown(wait=True)
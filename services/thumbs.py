@@ -1,57 +1,221 @@
+import io
 import os
-from PIL import Image
-from flask import current_app
+import base64
+import tempfile
+from PIL import Image, features
+from flask import current_app, has_app_context
+from services.metrics import Metrics
+from services.image_info import ImageInfoService, ORIENTATION_TRANSPOSE, ROTATED_ORIENTATIONS
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Modes that are downscaled as-is and converted to RGB afterwards
+RESIZABLE_MODES = ('RGB', 'L', 'CMYK')
+REDUCING_GAP = 2.0
+
+# Supported THUMBNAIL_FORMAT values and the extension of the files they produce
+THUMBNAIL_EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp', 'PNG': '.png'}
+# Formats whose size is controlled by a quality setting
+LOSSY_FORMATS = ('JPEG', 'WEBP')
+# Upper bound for encodes per thumbnail (1 + binary search steps)
+MAX_ENCODES = 6
+
+# Inline placeholder (LQIP): longest side in pixels, format and quality
+PLACEHOLDER_SIZE = 16
+PLACEHOLDER_FORMAT = 'WEBP' if features.check('webp') else 'PNG'
+PLACEHOLDER_QUALITY = 40
+
 class ThumbnailService:
     @staticmethod
-    def generate_thumbnail(original_path, thumbnail_path):
-        """Generate thumbnail for an image"""
+    def encoding_options():
+        """Thumbnail encoder settings from the app config, in the shape
+        generate_thumbnail expects (so they can be handed to pool processes)."""
+        config = current_app.config
+        return {
+            'format': config['THUMBNAIL_FORMAT'],
+            'max_bytes': config['THUMBNAIL_MAX_BYTES'],
+            'quality_min': config['THUMBNAIL_QUALITY_MIN'],
+            'quality_max': config['THUMBNAIL_QUALITY_MAX'],
+        }
+
+    @staticmethod
+    def generate_thumbnail(original_path, thumbnail_path, size=None, encoding=None):
+        """Generate thumbnail for an image.
+
+        ``size`` and ``encoding`` default to the app config; pass them explicitly
+        when running outside of an app context (e.g. in the thumbnail worker pool).
+        The file is written once, atomically, so a half-written thumbnail is
+        never visible.
+
+        Returns the inline placeholder (see ``placeholder``) on success, False
+        on failure.
+        """
+        size = size or current_app.config['THUMBNAIL_SIZE']
+        encoding = encoding or ThumbnailService.encoding_options()
         try:
             with Image.open(original_path) as img:
-                # Convert to RGB if necessary (for PNG with transparency, etc.)
+                img = ThumbnailService.load_reduced(img, size)
+                
+                # Convert to RGB if necessary (for PNG with transparency, etc.).
+                # Done after downscaling so only the small image is converted.
                 if img.mode != 'RGB':
                     img = img.convert('RGB')
                 
-                # Create thumbnail
-                img.thumbnail(current_app.config['THUMBNAIL_SIZE'], Image.Resampling.LANCZOS)
-                
-                # Save thumbnail with optimization
-                img.save(thumbnail_path, 'JPEG', optimize=True, quality=85)
-                
-                # Check if thumbnail is under 30KB
-                if os.path.getsize(thumbnail_path) > 30 * 1024:
-                    # If too large, reduce quality
-                    img.save(thumbnail_path, 'JPEG', optimize=True, quality=60)
-                
-                logger.info(f"Thumbnail generated: {thumbnail_path}")
-                return True
+                data, quality = ThumbnailService.encode(img, encoding)
+                placeholder = ThumbnailService.placeholder(img)
+            ThumbnailService._write_atomic(thumbnail_path, data)
+            logger.debug(f"Thumbnail generated: {thumbnail_path} ({len(data)} bytes, quality {quality})")
+            return placeholder
                 
         except Exception as e:
             logger.error(f"Error generating thumbnail: {str(e)}")
-            # If thumbnail generation fails, remove the partial file
-            if os.path.exists(thumbnail_path):
-                os.remove(thumbnail_path)
             return False
+
+    @staticmethod
+    def encode(img, encoding):
+        """Encode ``img`` in memory within ``max_bytes`` if possible.
+
+        Tries ``quality_max`` first; if that is over budget, binary-searches the
+        highest quality down to ``quality_min`` that fits. Returns
+        ``(data, quality)``; if even ``quality_min`` is too large its output is
+        used anyway.
+        """
+        fmt = encoding['format']
+
+        encoded = {}
+
+        def render(quality):
+            if quality not in encoded:
+                buffer = io.BytesIO()
+                with Metrics.timer('image_encode'):
+                    if fmt == 'JPEG':
+                        img.save(buffer, fmt, optimize=True, quality=quality)
+                    elif fmt == 'WEBP':
+                        img.save(buffer, fmt, quality=quality, method=4)
+                    else:
+                        img.save(buffer, fmt, optimize=True)
+                encoded[quality] = buffer.getvalue()
+            return encoded[quality]
+
+        low, high = encoding['quality_min'], encoding['quality_max']
+        if fmt not in LOSSY_FORMATS or len(render(high)) <= encoding['max_bytes']:
+            return render(high), high
+
+        best = low
+        high -= 1
+        while low <= high and len(encoded) < MAX_ENCODES:
+            quality = (low + high + 1) // 2
+            if len(render(quality)) <= encoding['max_bytes']:
+                best = quality
+                low = quality + 1
+            else:
+                high = quality - 1
+        return render(best), best
+
+    @staticmethod
+    def placeholder(img):
+        """Low-quality placeholder for listings, from the already downscaled RGB image.
+
+        Returns ``{'placeholder': <data URI of a ~16px image>, 'color': '#rrggbb'}``
+        (a couple hundred bytes), so a grid can be painted before any thumbnail
+        arrives. The color is the most frequent one of a 4-color quantization.
+        """
+        with Metrics.timer('placeholder'):
+            small = img.copy()
+            small.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), Image.Resampling.BOX)
+            buffer = io.BytesIO()
+            small.save(buffer, PLACEHOLDER_FORMAT, quality=PLACEHOLDER_QUALITY)
+            quantized = small.quantize(colors=4)
+            _, index = max(quantized.getcolors())
+            red, green, blue = quantized.getpalette()[index * 3:index * 3 + 3]
+        return {
+            'placeholder': f"data:image/{PLACEHOLDER_FORMAT.lower()};base64,"
+                           f"{base64.b64encode(buffer.getvalue()).decode()}",
+            'color': f"#{red:02x}{green:02x}{blue:02x}",
+        }
+
+    @staticmethod
+    def _write_atomic(path, data):
+        """Write ``data`` to a temp file next to ``path`` and rename it into place."""
+        directory = os.path.dirname(path)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix=os.path.basename(path))
+        # mkstemp creates 0600; the web server (X-Accel-Redirect) must be able to read it
+        os.fchmod(fd, 0o644)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
     
     @staticmethod
-    def process_uploaded_image(file_path):
+    def load_reduced(img, size, reducing_gap=REDUCING_GAP, keep_alpha=False):
+        """Decode ``img`` at reduced size and downscale it to fit ``size``.
+
+        For JPEGs ``draft()`` makes libjpeg decode at 1/2, 1/4 or 1/8 scale
+        (DCT scaling), so a 24 MP original never exists as a full RGB buffer.
+        Other formats have no scaled decode; they use ``reduce()`` via
+        ``reducing_gap`` before the final LANCZOS pass. Mode conversion to RGB
+        happens on the small image (in generate_thumbnail), except where the
+        format has to be fully decoded anyway. With ``keep_alpha`` transparent
+        images are resized as RGBA (for output formats that keep transparency).
+
+        The result is upright: ``size`` is the box as displayed, and the EXIF
+        orientation is applied after downscaling, where the transpose is cheap.
+        """
+        orientation = ImageInfoService.orientation(img)
+        if orientation in ROTATED_ORIENTATIONS:
+            size = (size[1], size[0])
+        with Metrics.timer('image_decode'):
+            if img.format == 'JPEG':
+                # Request at least reducing_gap * size so the LANCZOS pass still has detail to work with
+                img.draft('RGB' if img.mode in ('RGB', 'YCbCr') else None,
+                          (int(size[0] * reducing_gap), int(size[1] * reducing_gap)))
+            elif keep_alpha and (img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info):
+                img = img.convert('RGBA')
+            elif img.mode not in RESIZABLE_MODES:
+                # Formats without draft support are decoded at full size anyway. The
+                # thumbnail drops alpha, so flatten first instead of resampling with
+                # premultiplied alpha; palette images would otherwise be resized with NEAREST.
+                img = img.convert('L' if img.mode in ('LA', '1') else 'RGB')
+            # Decode now (thumbnail() would do it), so the timings separate decode from resize
+            img.load()
+        with Metrics.timer('image_resize'):
+            img.thumbnail(size, Image.Resampling.LANCZOS, reducing_gap=reducing_gap)
+            if orientation in ORIENTATION_TRANSPOSE:
+                img = img.transpose(ORIENTATION_TRANSPOSE[orientation])
+        return img
+
+    @staticmethod
+    def thumbnail_extension():
+        """Extension of thumbnail files for the configured THUMBNAIL_FORMAT."""
+        fmt = current_app.config.get('THUMBNAIL_FORMAT', 'JPEG') if has_app_context() else 'JPEG'
+        return THUMBNAIL_EXTENSIONS[fmt]
+
+    @staticmethod
+    def thumbnail_name(original_name):
+        """File name of the thumbnail inside .thumbs/ for an original's file name."""
+        stem, _ = os.path.splitext(original_name)
+        return stem + ThumbnailService.thumbnail_extension()
+
+    @staticmethod
+    def thumbnail_path_for(file_path):
+        """Thumbnail path for an original: <dir>/.thumbs/<stem><ext>"""
+        directory = os.path.dirname(file_path)
+        return os.path.join(directory, '.thumbs', ThumbnailService.thumbnail_name(os.path.basename(file_path)))
+
+    @staticmethod
+    def process_uploaded_image(file_path, size=None):
         """Process uploaded image and generate thumbnail"""
         try:
-            directory = os.path.dirname(file_path)
-            filename = os.path.basename(file_path)
-            
-            # Create thumbnail path
-            thumb_dir = os.path.join(directory, '.thumbs')
-            os.makedirs(thumb_dir, exist_ok=True)
-            
-            # Generate thumbnail with same name but .jpg extension
-            name, _ = os.path.splitext(filename)
-            thumb_path = os.path.join(thumb_dir, f"{name}.jpg")
+            # Generate thumbnail with same name in the configured thumbnail format
+            thumb_path = ThumbnailService.thumbnail_path_for(file_path)
+            os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
             
-            return ThumbnailService.generate_thumbnail(file_path, thumb_path)
+            return ThumbnailService.generate_thumbnail(file_path, thumb_path, size)
             
         except Exception as e:
             logger.error(f"Error processing uploaded image: {str(e)}")
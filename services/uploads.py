@@ -0,0 +1,221 @@
+import os
+import re
+import time
+import uuid
+import hashlib
+from flask import current_app
+from services.index import IndexService
+from services.storage import StorageService
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Size of the blocks read from the request stream while a chunk is written
+READ_BLOCK = 64 * 1024
+SESSION_ID = re.compile(r'[0-9a-f]{32}')
+
+
+class UploadSessionService:
+    """Chunked, resumable uploads.
+
+    A session is created with the final size; its staging file in
+    UPLOAD_FOLDER/.uploads/ is preallocated and every chunk is written at its
+    own offset (``pwrite``), so chunks may arrive in parallel and in any order.
+    Acknowledged chunks are recorded in the index, so an interrupted upload
+    resumes by asking which chunks the server already has. ``commit`` moves the
+    staging file into the target folder like a normal upload.
+    """
+
+    @staticmethod
+    def staging_dir():
+        return os.path.join(current_app.config['UPLOAD_FOLDER'], '.uploads')
+
+    @staticmethod
+    def staging_path(session_id):
+        return os.path.join(UploadSessionService.staging_dir(), f"{session_id}.part")
+
+    @staticmethod
+    def create(filename, folder, size, mimetype, sha256=None):
+        if not filename or not filename.strip():
+            raise ValueError("Filename required")
+        if folder is None or '..' in folder or folder.startswith('/'):
+            raise ValueError("Invalid folder path")
+        if not StorageService.is_allowed_file(mimetype):
+            raise ValueError("File type not allowed")
+        try:
+            size = int(size)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid size")
+        max_size = current_app.config['UPLOAD_SESSION_MAX_MB'] * 1024 * 1024
+        if size <= 0 or size > max_size:
+            raise ValueError(f"Size must be between 1 byte and {current_app.config['UPLOAD_SESSION_MAX_MB']} MB")
+
+        UploadSessionService.cleanup_expired()
+
+        session_id = uuid.uuid4().hex
+        chunk_size = current_app.config['UPLOAD_CHUNK_SIZE']
+        os.makedirs(UploadSessionService.staging_dir(), exist_ok=True)
+        with open(UploadSessionService.staging_path(session_id), 'wb') as f:
+            f.truncate(size)
+
+        now = time.time()
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            conn.execute(
+                "INSERT INTO upload_sessions (id, folder, filename, mimetype, size, chunk_size, sha256, status, "
+                "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, 'open', ?, ?)",
+                (session_id, folder, filename.strip(), mimetype, size, chunk_size, sha256, now, now))
+        logger.info(f"Upload session {session_id} created for {filename} ({size} bytes)")
+        return UploadSessionService.get(session_id)
+
+    @staticmethod
+    def get(session_id):
+        """Session state including the numbers of the chunks received so far."""
+        session = UploadSessionService._load(session_id)
+        conn = IndexService.connect()
+        received = [row['number'] for row in conn.execute(
+            'SELECT number FROM upload_chunks WHERE session_id = ? ORDER BY number', (session_id,))]
+        return {
+            'id': session['id'],
+            'filename': session['filename'],
+            'folder': session['folder'],
+            'size': session['size'],
+            'chunk_size': session['chunk_size'],
+            'chunk_count': UploadSessionService._chunk_count(session),
+            'received': received,
+            'status': session['status'],
+        }
+
+    @staticmethod
+    def write_chunk(session_id, number, stream, sha256=None):
+        """Stream one chunk from ``stream`` into the staging file.
+
+        The chunk must have exactly its expected length (the last one may be
+        shorter); with ``sha256`` it is verified before it is acknowledged.
+        Re-sending an acknowledged chunk overwrites it.
+        """
+        session = UploadSessionService._load(session_id)
+        if session['status'] != 'open':
+            raise ValueError(f"Upload session is {session['status']}")
+        chunk_count = UploadSessionService._chunk_count(session)
+        if not 0 <= number < chunk_count:
+            raise ValueError(f"Chunk number must be between 0 and {chunk_count - 1}")
+        offset = number * session['chunk_size']
+        expected = min(session['chunk_size'], session['size'] - offset)
+
+        digest = hashlib.sha256()
+        written = 0
+        fd = os.open(UploadSessionService.staging_path(session_id), os.O_WRONLY)
+        try:
+            while True:
+                block = stream.read(min(READ_BLOCK, expected - written + 1))
+                if not block:
+                    break
+                written += len(block)
+                if written > expected:
+                    raise ValueError(f"Chunk {number} is larger than {expected} bytes")
+                digest.update(block)
+                os.pwrite(fd, block, offset + written - len(block))
+            if written != expected:
+                raise ValueError(f"Chunk {number} has {written} bytes, expected {expected}")
+            if sha256 and digest.hexdigest() != sha256.lower():
+                raise ValueError(f"Checksum mismatch for chunk {number}")
+            # Only acknowledge what is on disk, so a resumed upload can trust the list
+            if hasattr(os, 'fdatasync'):
+                os.fdatasync(fd)
+            else:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        now = time.time()
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            conn.execute('INSERT OR REPLACE INTO upload_chunks (session_id, number, size, sha256) VALUES (?, ?, ?, ?)',
+                         (session_id, number, written, digest.hexdigest()))
+            conn.execute('UPDATE upload_sessions SET updated_at = ? WHERE id = ?', (now, session_id))
+            received = conn.execute('SELECT COUNT(*) FROM upload_chunks WHERE session_id = ?',
+                                    (session_id,)).fetchone()[0]
+        return {'number': number, 'size': written, 'sha256': digest.hexdigest(),
+                'received_count': received, 'chunk_count': chunk_count}
+
+    @staticmethod
+    def commit(session_id):
+        """Verify that every chunk arrived and store the file like a regular upload."""
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            session = UploadSessionService._load(session_id)
+            if session['status'] != 'open':
+                raise ValueError(f"Upload session is {session['status']}")
+            received = {row['number'] for row in conn.execute(
+                'SELECT number FROM upload_chunks WHERE session_id = ?', (session_id,))}
+            missing = [n for n in range(UploadSessionService._chunk_count(session)) if n not in received]
+            if missing:
+                raise ValueError(f"Missing chunks: {', '.join(map(str, missing[:20]))}")
+            # Claim the session so a concurrent commit cannot store the file twice
+            conn.execute("UPDATE upload_sessions SET status = 'committing' WHERE id = ?", (session_id,))
+
+        staged = UploadSessionService.staging_path(session_id)
+        try:
+            if session['sha256']:
+                digest = hashlib.sha256()
+                with open(staged, 'rb') as f:
+                    for block in iter(lambda: f.read(1024 * 1024), b''):
+                        digest.update(block)
+                if digest.hexdigest() != session['sha256'].lower():
+                    raise ValueError("Checksum mismatch for the assembled file")
+            result = StorageService.save_staged(staged, session['folder'], session['filename'], session['mimetype'],
+                                                session['sha256'])
+        except Exception:
+            with IndexService._transaction(conn):
+                conn.execute("UPDATE upload_sessions SET status = 'open' WHERE id = ?", (session_id,))
+            raise
+
+        UploadSessionService._forget(session_id)
+        logger.info(f"Upload session {session_id} committed as {result['path']}")
+        return result
+
+    @staticmethod
+    def abort(session_id):
+        UploadSessionService._load(session_id)
+        UploadSessionService._forget(session_id)
+        logger.info(f"Upload session {session_id} aborted")
+
+    @staticmethod
+    def cleanup_expired():
+        """Drop sessions without activity for UPLOAD_SESSION_TTL seconds. Returns the number removed."""
+        cutoff = time.time() - current_app.config['UPLOAD_SESSION_TTL']
+        conn = IndexService.connect()
+        expired = [row['id'] for row in conn.execute(
+            'SELECT id FROM upload_sessions WHERE updated_at < ?', (cutoff,))]
+        for session_id in expired:
+            UploadSessionService._forget(session_id)
+        if expired:
+            logger.info(f"Removed {len(expired)} expired upload sessions")
+        return len(expired)
+
+    @staticmethod
+    def _load(session_id):
+        # Session ids end up in file names, so accept nothing but our own format
+        if not SESSION_ID.fullmatch(session_id or ''):
+            raise FileNotFoundError(f"Upload session not found: {session_id}")
+        conn = IndexService.connect()
+        row = conn.execute('SELECT * FROM upload_sessions WHERE id = ?', (session_id,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"Upload session not found: {session_id}")
+        return row
+
+    @staticmethod
+    def _chunk_count(session):
+        return -(-session['size'] // session['chunk_size'])
+
+    @staticmethod
+    def _forget(session_id):
+        try:
+            os.remove(UploadSessionService.staging_path(session_id))
+        except FileNotFoundError:
+            pass
+        conn = IndexService.connect()
+        with IndexService._transaction(conn):
+            conn.execute('DELETE FROM upload_chunks WHERE session_id = ?', (session_id,))
+            conn.execute('DELETE FROM upload_sessions WHERE id = ?', (session_id,))
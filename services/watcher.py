@@ -0,0 +1,510 @@
+import os
+import time
+import errno
+import fcntl
+import select
+import struct
+import ctypes
+import ctypes.util
+import mimetypes
+import threading
+from datetime import datetime
+from pathlib import Path
+from flask import current_app
+from services import scanner
+from services.index import IndexService
+from services.storage import StorageService
+from services.thumbs import ThumbnailService
+from services.thumb_queue import ThumbnailQueue
+from services.replication import ReplicationQueue
+import logging
+
+logger = logging.getLogger(__name__)
+
+# <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# IN_CREATE only matters for directories: files are picked up once they are
+# closed after writing (IN_CLOSE_WRITE) or renamed into place (IN_MOVED_TO)
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    """Minimal ctypes binding of Linux inotify: one watch per directory, ``wd`` <-> folder."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available on this platform')
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.folders = {}  # wd -> folder
+        self.watches = {}  # folder -> wd
+
+    def add(self, full_path, folder):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(full_path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), full_path)
+        self.folders[wd] = folder
+        self.watches[folder] = wd
+
+    def _subtree(self, folder):
+        return [path for path in self.watches if path == folder or path.startswith(folder + '/')]
+
+    def remove_tree(self, folder):
+        for path in self._subtree(folder):
+            wd = self.watches.pop(path)
+            self.folders.pop(wd, None)
+            self._libc.inotify_rm_watch(self.fd, wd)
+
+    def move_tree(self, old, new):
+        # Watches follow the inode, only the folder names change
+        for path in self._subtree(old):
+            wd = self.watches.pop(path)
+            self.watches[new + path[len(old):]] = wd
+            self.folders[wd] = new + path[len(old):]
+
+    def forget(self, wd):
+        folder = self.folders.pop(wd, None)
+        if folder is not None and self.watches.get(folder) == wd:
+            del self.watches[folder]
+
+    def read(self, timeout):
+        """Events as ``(wd, mask, cookie, name)``, waiting up to ``timeout`` seconds for the first."""
+        ready, _, _ = select.select([self.fd], [], [], max(0, timeout))
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class TreeSync:
+    """Brings index, sidecars and thumbnails of folders in line with what is on disk.
+
+    Works on the names of one folder at a time: a single ``scandir`` of the
+    folder, one index query, and a stat only for the names being checked.
+    Sidecars are read (or written, for files that arrived without one) only for
+    files whose size or mtime differ from the index.
+    """
+
+    def __init__(self, inotify=None):
+        self.root = current_app.config['UPLOAD_FOLDER']
+        self.inotify = inotify
+        self.allowed_types = set(current_app.config['ALLOWED_TYPES'])
+        self.settle = current_app.config['FS_WATCHER_DEBOUNCE']
+        self.batch = current_app.config['FS_WATCHER_BATCH']
+        self.dir_mtimes = {}  # folder -> st_mtime_ns of the last complete sync
+        self.retry = set()  # (folder, name) of files that were still being written
+        self.changes = []
+        self.thumbnails = []
+        self._watch_limit_logged = False
+
+    def _full_path(self, folder):
+        return os.path.join(self.root, folder) if folder else self.root
+
+    # ------------------------------------------------------------------
+    # Whole tree (startup) and periodic mtime pass
+    # ------------------------------------------------------------------
+
+    def walk(self):
+        """Sync every folder below the root; the only full walk, run at startup."""
+        started = time.time()
+        pending = ['']
+        folders = 0
+        while pending:
+            folder = pending.pop()
+            pending.extend(self.sync_folder(folder, recurse_all=True))
+            folders += 1
+        self.flush()
+        logger.info(f"Watcher synced {folders} folders in {time.time() - started:.1f}s")
+
+    def reconcile(self):
+        """Rescan the folders whose directory mtime changed since their last sync."""
+        changed = 0
+        for folder, mtime in list(self.dir_mtimes.items()):
+            try:
+                current = os.stat(self._full_path(folder)).st_mtime_ns
+            except FileNotFoundError:
+                current = None  # Its parent's mtime changed as well; that sync removes it
+            if current is not None and current != mtime:
+                pending = [folder]
+                while pending:
+                    pending.extend(self.sync_folder(pending.pop()))
+                changed += 1
+        self.flush()
+        if changed:
+            logger.info(f"Watcher reconcile: {changed} folders changed outside the app")
+
+    # ------------------------------------------------------------------
+    # One folder
+    # ------------------------------------------------------------------
+
+    def sync_folder(self, folder, names=None, recurse_all=False):
+        """Sync ``names`` of ``folder`` (all entries if None); returns subfolders that need a full sync.
+
+        New subfolders are returned so the caller can walk into them; with
+        ``recurse_all`` every subfolder is returned (startup walk).
+        """
+        full_path = self._full_path(folder)
+        if self.inotify is not None and folder not in self.inotify.watches:
+            # Watch before scanning, so nothing created in between is missed
+            self._watch(full_path, folder)
+        # Index before disk: anything the app adds in between then shows up on
+        # disk only (re-added, harmless) instead of in the index only (removed)
+        indexed_files, indexed_dirs = IndexService.folder_entries(folder)
+        try:
+            dir_mtime = os.stat(full_path).st_mtime_ns
+            with os.scandir(full_path) as entries:
+                entries = list(entries)
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+
+        disk_files, disk_dirs, sidecars, thumbs = {}, set(), set(), set()
+        for entry in entries:
+            name = entry.name
+            if name == '.thumbs':
+                try:
+                    thumbs = set(os.listdir(entry.path))
+                except OSError:
+                    pass
+            elif name.startswith('.'):
+                continue
+            elif name.endswith('.json'):
+                sidecars.add(name)
+            elif entry.is_dir():
+                disk_dirs.add(name)
+            elif entry.is_file():
+                disk_files[name] = entry
+
+        complete = names is None
+        if names is None:
+            names = set(disk_files) | disk_dirs | set(indexed_files) | indexed_dirs
+        walk_into = []
+        for name in sorted(names):
+            path = '/'.join(filter(None, [folder, name]))
+            if name in disk_dirs:
+                if name not in indexed_dirs:
+                    self.changes.append({'op': 'add_folder', 'path': path})
+                    walk_into.append(path)
+                elif recurse_all:
+                    walk_into.append(path)
+                continue
+            if name in indexed_dirs:
+                self.changes.append({'op': 'remove_folder', 'path': path})
+                self._forget(path)
+            entry, row = disk_files.get(name), indexed_files.get(name)
+            if entry is None:
+                if row is not None:
+                    self.changes.append({'op': 'remove_file', 'path': path})
+                    self._remove_thumbnail(full_path, name)
+                continue
+            try:
+                stats = entry.stat()
+            except FileNotFoundError:
+                continue
+            if row is not None and row['size'] == stats.st_size and row['mtime'] == stats.st_mtime:
+                status = row['thumb_status']
+                mimetype = mimetypes.guess_type(name)[0]
+            else:
+                if time.time() - stats.st_mtime < self.settle:
+                    # Possibly still being written; checked again on the next pass
+                    self.retry.add((folder, name))
+                    complete = False
+                    continue
+                record = self._describe(full_path, folder, name, stats, sidecars, thumbs)
+                self.changes.append({'op': 'upsert_file', 'record': record})
+                # A replaced original makes its old thumbnail stale
+                status = record['thumb_status'] if row is None else None
+                mimetype = record['mimetype']
+            has_thumb = Path(name).stem + ThumbnailService.thumbnail_extension() in thumbs
+            if status not in ('pending', 'failed') and (status is None or not has_thumb) \
+                    and mimetype in self.allowed_types:
+                self.thumbnails.append(path)
+
+        if complete:
+            self.dir_mtimes[folder] = dir_mtime
+        if len(self.changes) + len(self.thumbnails) >= self.batch:
+            self.flush()
+        return walk_into
+
+    def _describe(self, full_path, folder, name, stats, sidecars, thumbs):
+        """Index record for a new or changed original; writes the sidecar if it has none."""
+        stem = Path(name).stem
+        if stem + '.json' in sidecars:
+            metadata = IndexService.read_sidecar(os.path.join(full_path, stem + '.json'))
+        else:
+            mimetype = mimetypes.guess_type(name)[0]
+            if mimetype not in self.allowed_types:
+                metadata = {'mimetype': mimetype}
+            else:
+                # Arrived outside the app (SFTP, rsync): the mtime is the best upload date there is
+                metadata, _ = StorageService._describe_saved(
+                    folder, name, name, mimetype,
+                    upload_date=datetime.fromtimestamp(stats.st_mtime).isoformat())
+                logger.info(f"Watcher: wrote sidecar for {metadata['path']}")
+        return scanner.file_record(folder, name, stats, metadata, thumbs)
+
+    # ------------------------------------------------------------------
+    # Renames (paired inotify events)
+    # ------------------------------------------------------------------
+
+    def move_file(self, old_folder, old_name, new_folder, new_name):
+        """Carry sidecar and thumbnail along with an original renamed outside the app."""
+        old_dir, new_dir = self._full_path(old_folder), self._full_path(new_folder)
+        old_stem, new_stem = Path(old_name).stem, Path(new_name).stem
+        try:
+            if not os.path.exists(os.path.join(new_dir, new_stem + '.json')):
+                os.rename(os.path.join(old_dir, old_stem + '.json'), os.path.join(new_dir, new_stem + '.json'))
+        except FileNotFoundError:
+            pass
+        thumb = None
+        old_thumb = ThumbnailService.thumbnail_path_for(os.path.join(old_dir, old_name))
+        new_thumb = ThumbnailService.thumbnail_path_for(os.path.join(new_dir, new_name))
+        try:
+            os.makedirs(os.path.dirname(new_thumb), exist_ok=True)
+            os.rename(old_thumb, new_thumb)
+        except FileNotFoundError:
+            pass
+        if os.path.exists(new_thumb):
+            thumb = os.path.relpath(new_thumb, self.root).replace(os.sep, '/')
+        self.changes.append({'op': 'move_file', 'thumb': thumb,
+                             'old': '/'.join(filter(None, [old_folder, old_name])),
+                             'new': '/'.join(filter(None, [new_folder, new_name]))})
+
+    def move_folder(self, old, new):
+        self.changes.append({'op': 'move_folder', 'old': old, 'new': new})
+        if self.inotify is not None:
+            self.inotify.move_tree(old, new)
+        for path in [p for p in self.dir_mtimes if p == old or p.startswith(old + '/')]:
+            self.dir_mtimes[new + path[len(old):]] = self.dir_mtimes.pop(path)
+
+    # ------------------------------------------------------------------
+    # Helpers
+    # ------------------------------------------------------------------
+
+    def flush(self):
+        """Apply collected index changes in one transaction and queue the thumbnails."""
+        changes, thumbnails = self.changes, self.thumbnails
+        self.changes, self.thumbnails = [], []
+        if changes:
+            IndexService.apply_changes(changes)
+            ReplicationQueue.apply_changes(changes)
+        for start in range(0, len(thumbnails), self.batch):
+            ThumbnailQueue.submit_many(thumbnails[start:start + self.batch])
+        if changes or thumbnails:
+            logger.info(f"Watcher applied {len(changes)} index changes, queued {len(thumbnails)} thumbnails")
+
+    def _watch(self, full_path, folder):
+        try:
+            self.inotify.add(full_path, folder)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # ENOSPC: fs.inotify.max_user_watches reached; the mtime pass still covers the folder
+            if not self._watch_limit_logged:
+                logger.warning(f"Watcher: cannot watch {full_path} ({e}); relying on the periodic reconcile")
+                self._watch_limit_logged = True
+
+    def _forget(self, folder):
+        if self.inotify is not None:
+            self.inotify.remove_tree(folder)
+        for path in [p for p in self.dir_mtimes if p == folder or p.startswith(folder + '/')]:
+            del self.dir_mtimes[path]
+
+    @staticmethod
+    def _remove_thumbnail(full_path, name):
+        try:
+            os.remove(ThumbnailService.thumbnail_path_for(os.path.join(full_path, name)))
+        except FileNotFoundError:
+            pass
+
+
+class FolderWatcher:
+    """Keeps index, sidecars and thumbnails coherent with files changed outside the app.
+
+    Files dropped into UPLOAD_FOLDER by SFTP or rsync bypass StorageService.
+    After one walk of the tree at startup, inotify events (Linux) are collected
+    per folder, debounced and applied in batches; renames carry sidecar and
+    thumbnail along. Every FS_WATCHER_RECONCILE_INTERVAL seconds the directory
+    mtimes are compared as a fallback (no inotify, watch limit, queue overflow)
+    and only changed folders are rescanned. One process per UPLOAD_FOLDER
+    watches (flock on .watcher.lock); the others stand by.
+    """
+
+    _lock = threading.Lock()
+    _thread = None
+    _pid = None
+    _stop = threading.Event()
+
+    @staticmethod
+    def init_app(app):
+        # Only a local tree can be watched; object stores change through the app only
+        if app.config['FS_WATCHER'] and app.config['METADATA_INDEX'] and app.config['STORAGE_BACKEND'] == 'local':
+            app.before_request(lambda: FolderWatcher.ensure_started(app))
+
+    @staticmethod
+    def ensure_started(app):
+        if FolderWatcher._thread is not None and FolderWatcher._pid == os.getpid():
+            return
+        with FolderWatcher._lock:
+            if FolderWatcher._thread is not None and FolderWatcher._pid == os.getpid():
+                return
+            FolderWatcher._pid = os.getpid()
+            FolderWatcher._thread = threading.Thread(
+                target=FolderWatcher.run, args=(app,), name='folder-watcher', daemon=True)
+            FolderWatcher._thread.start()
+
+    @staticmethod
+    def run(app, once=False):
+        """Watch loop. With ``once`` it returns after the startup walk (``flask watch reconcile``).
+
+        Returns False if another process is already watching (only with ``once``).
+        """
+        with app.app_context():
+            leader = FolderWatcher._acquire_leadership(app, wait=not once)
+            if leader is None:
+                return False
+            inotify = None
+            try:
+                if not once:
+                    try:
+                        inotify = Inotify()
+                    except OSError as e:
+                        logger.warning(f"Watcher: inotify unavailable ({e}); polling directory mtimes only")
+                sync = TreeSync(inotify)
+                sync.walk()
+                if not once:
+                    FolderWatcher._loop(app, sync)
+            except Exception as e:
+                logger.error(f"Folder watcher stopped: {e}", exc_info=True)
+            finally:
+                if inotify is not None:
+                    inotify.close()
+                leader.close()
+        return True
+
+    @staticmethod
+    def _acquire_leadership(app, wait):
+        """flock on UPLOAD_FOLDER/.watcher.lock; ``wait`` keeps trying so a standby takes over."""
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+        handle = open(os.path.join(app.config['UPLOAD_FOLDER'], '.watcher.lock'), 'a')
+        while True:
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                logger.info(f"Folder watcher active (pid {os.getpid()})")
+                return handle
+            except BlockingIOError:
+                if not wait or FolderWatcher._stop.wait(app.config['FS_WATCHER_RECONCILE_INTERVAL']):
+                    handle.close()
+                    return None
+
+    @staticmethod
+    def _loop(app, sync):
+        debounce = app.config['FS_WATCHER_DEBOUNCE']
+        max_delay = app.config['FS_WATCHER_MAX_DELAY']
+        interval = app.config['FS_WATCHER_RECONCILE_INTERVAL']
+        inotify = sync.inotify
+        pending = {}  # folder -> names changed since the last batch
+        moved_from = {}  # cookie -> (folder, name, is_dir)
+        renames = []
+        first_event = last_event = None
+        next_reconcile = time.monotonic() + interval
+
+        while not FolderWatcher._stop.is_set():
+            now = time.monotonic()
+            deadline = next_reconcile
+            if pending:
+                deadline = min(deadline, last_event + debounce, first_event + max_delay)
+            if inotify is None:
+                FolderWatcher._stop.wait(max(0, deadline - now))
+                events = []
+            else:
+                events = inotify.read(deadline - now)
+
+            overflow = False
+            for wd, mask, cookie, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                if mask & IN_IGNORED:
+                    inotify.forget(wd)
+                    continue
+                folder = inotify.folders.get(wd)
+                if folder is None or not name or name.startswith('.') or name.endswith('.json'):
+                    continue
+                is_dir = bool(mask & IN_ISDIR)
+                if mask & IN_CREATE and not is_dir:
+                    continue
+                if mask & IN_MOVED_FROM:
+                    moved_from[cookie] = (folder, name, is_dir)
+                elif mask & IN_MOVED_TO and cookie in moved_from:
+                    renames.append((moved_from.pop(cookie), (folder, name)))
+                pending.setdefault(folder, set()).add(name)
+                last_event = time.monotonic()
+                first_event = first_event or last_event
+
+            now = time.monotonic()
+            if pending and (now - last_event >= debounce or now - first_event >= max_delay):
+                try:
+                    for (old_folder, old_name, is_dir), (new_folder, new_name) in renames:
+                        if is_dir:
+                            sync.move_folder('/'.join(filter(None, [old_folder, old_name])),
+                                             '/'.join(filter(None, [new_folder, new_name])))
+                        else:
+                            sync.move_file(old_folder, old_name, new_folder, new_name)
+                    sync.flush()  # The folder syncs below must see the renamed rows
+                    for folder, names in pending.items():
+                        walk = sync.sync_folder(folder, names)
+                        while walk:
+                            walk.extend(sync.sync_folder(walk.pop()))
+                    sync.flush()
+                except Exception as e:
+                    logger.error(f"Watcher batch failed: {e}", exc_info=True)
+                    overflow = True  # Let the mtime pass pick up whatever was missed
+                pending, moved_from, renames = {}, {}, []
+                first_event = last_event = None
+
+            if sync.retry:
+                # Files that were still being written: look again after the debounce
+                for folder, name in sync.retry:
+                    pending.setdefault(folder, set()).add(name)
+                sync.retry.clear()
+                last_event = time.monotonic()
+                first_event = first_event or last_event
+
+            if overflow or now >= next_reconcile:
+                if overflow:
+                    logger.warning("Watcher: event queue overflowed, reconciling by directory mtime")
+                try:
+                    sync.reconcile()
+                except Exception as e:
+                    logger.error(f"Watcher reconcile failed: {e}", exc_info=True)
+                next_reconcile = time.monotonic() + interval
@@ -44,6 +44,37 @@ class ApiService {
         return this.fetchJson(url);
     }
 
+    // Folder hierarchy with subtree counts: resolves to { version, tree }
+    async getTree(path = '', depth = 1) {
+        const params = new URLSearchParams({ path, depth });
+        const url = `${this.basePath}/api/tree?${params.toString()}`;
+        console.log('API: Loading folder tree at', url);
+        return this.fetchJson(url);
+    }
+
+    // Paginated listing: resolves to { items, next_cursor }
+    async listFilesPage(path, { limit = 100, cursor = null, sort = 'name', order = 'asc', prefix = null, type = null } = {}) {
+        const params = new URLSearchParams({ path, limit, sort, order });
+        if (cursor) params.set('cursor', cursor);
+        if (prefix) params.set('prefix', prefix);
+        if (type) params.set('type', type);
+        const url = `${this.basePath}/api/list?${params.toString()}`;
+        console.log('API: Listing page at', url);
+        return this.fetchJson(url);
+    }
+
+    // Search the whole tree: { q, folder, type, from, to, min_size, max_size, sort, order, limit, cursor };
+    // resolves to { items, next_cursor }
+    async search(criteria = {}) {
+        const params = new URLSearchParams();
+        Object.entries(criteria).forEach(([key, value]) => {
+            if (value !== null && value !== undefined && value !== '') params.set(key, value);
+        });
+        const url = `${this.basePath}/api/search?${params.toString()}`;
+        console.log('API: Searching', url);
+        return this.fetchJson(url);
+    }
+
     async uploadFile(formData) {
         const url = `${this.basePath}/api/upload`;
         console.log('API: Uploading file to', url);
@@ -53,6 +84,58 @@ class ApiService {
         });
     }
 
+    // Several files in one request; resolves to { results, stored, failed } even when
+    // some (207) or all (400) files were rejected, so callers can report per file
+    async uploadBatch(files, folder) {
+        const url = `${this.basePath}/api/upload/batch`;
+        console.log('API: Uploading batch of', files.length, 'files to', url);
+        const formData = new FormData();
+        files.forEach(file => formData.append('files', file));
+        formData.append('folder', folder);
+        const response = await fetch(url, { method: 'POST', body: formData });
+        const contentType = response.headers.get('content-type');
+        const body = contentType && contentType.includes('application/json') ? await response.json() : {};
+        if (!body.results) {
+            throw new Error(body.error || `HTTP ${response.status}: ${response.statusText}`);
+        }
+        return body;
+    }
+
+    // Chunked uploads: create a session, PUT chunks (any order, in parallel), then commit
+    async createUploadSession({ filename, folder, size, mimetype }) {
+        const url = `${this.basePath}/api/uploads`;
+        console.log('API: Creating upload session for', filename);
+        return this.fetchJson(url, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ filename, folder, size, mimetype })
+        });
+    }
+
+    async getUploadSession(sessionId) {
+        const url = `${this.basePath}/api/uploads/${encodeURIComponent(sessionId)}`;
+        return this.fetchJson(url);
+    }
+
+    async putUploadChunk(sessionId, number, blob, sha256 = null) {
+        const url = `${this.basePath}/api/uploads/${encodeURIComponent(sessionId)}/chunks/${number}`;
+        const headers = { 'Content-Type': 'application/octet-stream' };
+        if (sha256) headers['X-Chunk-SHA256'] = sha256;
+        return this.fetchJson(url, {
+            method: 'PUT',
+            headers,
+            body: blob
+        });
+    }
+
+    async commitUploadSession(sessionId) {
+        const url = `${this.basePath}/api/uploads/${encodeURIComponent(sessionId)}/commit`;
+        console.log('API: Committing upload session', sessionId);
+        return this.fetchJson(url, { method: 'POST' });
+    }
+
     async renameFile(filePath, newName) {
         const url = `${this.basePath}/api/file/rename`;
         console.log('API: Renaming file', filePath, 'to', newName);
@@ -77,6 +160,25 @@ class ApiService {
         });
     }
 
+    // operations: [{ op: 'delete' | 'move' | 'rename', path, to?, name? }];
+    // resolves to { results, succeeded, failed } unless the request itself is invalid
+    async bulk(operations) {
+        const url = `${this.basePath}/api/bulk`;
+        console.log('API: Bulk operations', operations.length);
+        const response = await fetch(url, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ operations })
+        });
+        const body = await response.json();
+        if (!body.results) {
+            throw new Error(body.error || `HTTP ${response.status}: ${response.statusText}`);
+        }
+        return body;
+    }
+
     async createFolder(path) {
         const url = `${this.basePath}/api/folder`;
         console.log('API: Creating folder', path);
@@ -21,6 +21,16 @@ class ImageStorageApp {
         
         this.publicBaseUrl = ''; // Initialize publicBaseUrl
 
+        // Paginated folder listing state
+        this.pageSize = 100;
+        this.currentFiles = [];
+        this.nextCursor = null;
+        this.loadingPage = false;
+        this.loadToken = 0; // Incremented per loadFolder call so stale pages are dropped
+        this.pageObserver = null;
+        this.searchQuery = ''; // Non-empty while the grid shows search results instead of a folder
+        this.searchTimer = null;
+
         this.ui = new UiUtils(this); // Pass this (app instance) to UiUtils
         this.api = new ApiService(this); // Instantiate ApiService
         this.folderTree = new FolderTreeView(this); // Instantiate FolderTreeView
@@ -99,6 +109,11 @@ class ImageStorageApp {
         document.getElementById('refreshTree').addEventListener('click', () => this.folderTree.loadFolderTree()); // Delegate to folderTree
         document.getElementById('addSubfolderBtn').addEventListener('click', () => this.fileManagement.addSubfolderAtPath(this.currentPath));
         document.getElementById('refreshTreeBtn').addEventListener('click', () => this.folderTree.loadFolderTree()); // Delegate to folderTree
+        document.getElementById('searchInput').addEventListener('input', (e) => {
+            clearTimeout(this.searchTimer);
+            const query = e.target.value.trim();
+            this.searchTimer = setTimeout(() => query ? this.search(query) : this.loadFolder(this.currentPath), 300);
+        });
         document.getElementById('toggleCustomFolder').addEventListener('click', () => this.uploadManager.toggleCustomFolderInput()); // Delegate to uploadManager
         document.getElementById('fileInput').addEventListener('change', (e) => {
             const files = e.target.files;
@@ -165,19 +180,27 @@ class ImageStorageApp {
     async loadFolder(path) {
         console.log(`[App] loadFolder called with path: ${path}`);
         this.currentPath = path;
+        this.currentFiles = [];
+        this.nextCursor = null;
+        this.clearSearch();
+        const token = ++this.loadToken;
         this.ui.showLoading(true); // Use ui.showLoading
 
         try {
-            const data = await this.api.listFiles(path); // Use ApiService
-            
-            // Filter out directories from the main file grid
-            const filesOnly = data.filter(item => item.type === 'file');
+            const page = await this.api.listFilesPage(path, { limit: this.pageSize }); // Use ApiService
+            if (token !== this.loadToken) return; // A newer navigation has started
+
+            // Directories come first, so the first page carries the subfolders
+            const filesOnly = page.items.filter(item => item.type === 'file');
             console.log(`[App] loadFolder received ${filesOnly.length} files. Calling renderFiles.`);
-            this.renderFiles(filesOnly);
+            this.nextCursor = page.next_cursor;
+            this.renderFiles(filesOnly, false, page.sprite);
 
             this.updateBreadcrumb(path);
             this.updateCurrentFolderDisplay(path);
-            this.folderTree.updateFolderSelects(data.filter(item => item.type === 'directory')); // Delegate to folderTree
+            // The whole subtree as one streamed ZIP
+            document.getElementById('downloadFolderBtn').href = `${this.basePath === '/' ? '' : this.basePath}/api/export?path=${encodeURIComponent(path)}`;
+            this.folderTree.updateFolderSelects(page.items.filter(item => item.type === 'directory')); // Delegate to folderTree
 
         } catch (error) {
             console.error('Error loading folder:', error);
@@ -185,6 +208,86 @@ class ImageStorageApp {
         } finally {
             this.ui.showLoading(false); // Use ui.showLoading
         }
+        this.fillViewport();
+    }
+
+    // Searches the whole tree; results page through the same grid and sentinel as a folder
+    async search(query) {
+        console.log(`[App] search called with query: ${query}`);
+        this.searchQuery = query;
+        this.currentFiles = [];
+        this.nextCursor = null;
+        const token = ++this.loadToken;
+        this.ui.showLoading(true);
+
+        try {
+            const page = await this.api.search({ q: query, limit: this.pageSize });
+            if (token !== this.loadToken) return;
+            this.nextCursor = page.next_cursor;
+            this.renderFiles(page.items);
+            this.updateCurrentFolderDisplay(`${this.t('searchResults')}: ${query}`);
+        } catch (error) {
+            console.error('Error searching:', error);
+            this.ui.showToast('Error searching: ' + error.message, 'error');
+        } finally {
+            this.ui.showLoading(false);
+        }
+        this.fillViewport();
+    }
+
+    clearSearch() {
+        clearTimeout(this.searchTimer);
+        this.searchQuery = '';
+        const input = document.getElementById('searchInput');
+        if (input) input.value = '';
+    }
+
+    async loadNextPage() {
+        if (!this.nextCursor || this.loadingPage) return;
+        const token = this.loadToken;
+        this.loadingPage = true;
+
+        try {
+            const page = this.searchQuery
+                ? await this.api.search({ q: this.searchQuery, limit: this.pageSize, cursor: this.nextCursor })
+                : await this.api.listFilesPage(this.currentPath, { limit: this.pageSize, cursor: this.nextCursor });
+            if (token !== this.loadToken) return;
+            this.nextCursor = page.next_cursor;
+            this.renderFiles(page.items.filter(item => item.type === 'file'), true, page.sprite);
+        } catch (error) {
+            console.error('Error loading next page:', error);
+            this.ui.showToast('Error loading folder: ' + error.message, 'error');
+        } finally {
+            this.loadingPage = false;
+        }
+        this.fillViewport();
+    }
+
+    // The observer only fires on changes, so keep loading while the sentinel is still visible
+    fillViewport() {
+        const sentinel = document.getElementById('fileGridSentinel');
+        if (this.nextCursor && sentinel && sentinel.getBoundingClientRect().top < window.innerHeight + 400) {
+            this.loadNextPage();
+        }
+    }
+
+    // Loads the next page once the sentinel below the grid scrolls into view
+    observeNextPage() {
+        const fileGrid = document.getElementById('fileGrid');
+        let sentinel = document.getElementById('fileGridSentinel');
+        if (!sentinel) {
+            sentinel = document.createElement('div');
+            sentinel.id = 'fileGridSentinel';
+            fileGrid.after(sentinel);
+        }
+        if (!this.pageObserver) {
+            this.pageObserver = new IntersectionObserver((entries) => {
+                if (entries.some(entry => entry.isIntersecting)) {
+                    this.loadNextPage();
+                }
+            }, { rootMargin: '400px' });
+            this.pageObserver.observe(sentinel);
+        }
     }
 
     updateCurrentFolderDisplay(path) {
@@ -215,30 +318,44 @@ class ImageStorageApp {
         breadcrumb.innerHTML = html;
     }
 
-    renderFiles(files) {
-        console.log(`[App] renderFiles called with ${files.length} files.`);
+    // sprite: the folder's thumbnail sprite sheet from /api/list, if the server sends one
+    renderFiles(files, append = false, sprite = null) {
+        console.log(`[App] renderFiles called with ${files.length} files (append: ${append}).`);
         const fileGrid = document.getElementById('fileGrid');
         const emptyState = document.getElementById('emptyState');
         
-        // Clear previous files and log its state
-        fileGrid.innerHTML = ''; 
-        console.log(`[App] fileGrid cleared. InnerHTML length: ${fileGrid.innerHTML.length}`);
+        if (!append) {
+            // Clear previous files
+            fileGrid.innerHTML = ''; 
+            this.currentFiles = [];
+        }
+        const offset = this.currentFiles.length;
+        this.currentFiles.push(...files);
+        this.observeNextPage();
 
-        if (files.length === 0) {
+        if (this.currentFiles.length === 0) {
             emptyState.classList.remove('d-none');
             return;
         } else {
             emptyState.classList.add('d-none');
         }
 
-        files.forEach((file, index) => { // Added index to the loop
+        files.forEach((file, pageIndex) => {
+            const index = offset + pageIndex; // Position in this.currentFiles
             const fileItem = document.createElement('div');
             fileItem.className = 'file-item';
 
             // Construct full image URL for display (always relative to base path, ensuring no double slashes)
             // basePath already handled in constructor to ensure no trailing slash (unless it's just '/')
             const displayImageUrl = `${this.basePath === '/' ? '' : this.basePath}/images/${file.url}`;
-            const displayThumbnailUrl = file.thumb ? `${this.basePath === '/' ? '' : this.basePath}/images/${file.thumb}` : displayImageUrl;
+            // ?v= pins the thumbnail's current version so the browser can cache it as immutable
+            const thumbVersion = file.thumb_version ? `?v=${file.thumb_version}` : '';
+            const displayThumbnailUrl = file.thumb ? `${this.basePath === '/' ? '' : this.basePath}/images/${file.thumb}${thumbVersion}` : displayImageUrl;
+            // Files on the sprite sheet show their cell of it: one image request for the whole folder
+            const spriteUrl = sprite && file.sprite ? `${this.basePath === '/' ? '' : this.basePath}/images/${sprite.url}?v=${sprite.version}` : null;
+            const thumbnailHtml = spriteUrl
+                ? `<div class="file-sprite" role="img" aria-label="${file.display_name}" style="width: ${file.sprite[2]}px; height: ${file.sprite[3]}px; background-image: url('${spriteUrl}'); background-position: -${file.sprite[0]}px -${file.sprite[1]}px"></div>`
+                : `<img src="${displayThumbnailUrl}" alt="${file.display_name}" loading="lazy" onerror="this.onerror=null;this.src='${(displayImageUrl).replace(/'/g, "\\'")}'">`;
             
             // Construct full image URL for copying (uses publicBaseUrl if set, ensuring no double slashes)
             // publicBaseUrl already handled in save/reset to ensure trailing slash (if not empty)
@@ -246,7 +363,7 @@ class ImageStorageApp {
 
             fileItem.innerHTML = `
                 <div class="file-thumbnail">
-                    <img src="${displayThumbnailUrl}" alt="${file.display_name}" loading="lazy" onerror="this.onerror=null;this.src='${(displayImageUrl).replace(/'/g, "\\'")}'">
+                    ${thumbnailHtml}
                     <div class="file-overlay">
                         <button class="btn-overlay view-btn" data-file-index="${index}">
                             <i class="fas fa-eye"></i>
@@ -268,6 +385,10 @@ class ImageStorageApp {
                     <span class="file-date">${new Date(file.upload_date).toLocaleDateString()}</span>
                 </div>
             `;
+            // Paint the inline placeholder (tiny image / dominant color) while the thumbnail loads
+            const thumbnail = fileItem.querySelector('.file-thumbnail');
+            if (file.color) thumbnail.style.backgroundColor = file.color;
+            if (file.placeholder) thumbnail.style.backgroundImage = `url("${file.placeholder}")`;
             fileGrid.appendChild(fileItem);
 
             // Bind events for rename and delete buttons
@@ -297,7 +418,7 @@ class ImageStorageApp {
             if (viewBtn) {
                 viewBtn.addEventListener('click', (e) => {
                     const fileIndex = parseInt(e.currentTarget.dataset.fileIndex);
-                    this.previewModal.previewImage(files, fileIndex); // Pass all files and the clicked index
+                    this.previewModal.previewImage(this.currentFiles, fileIndex); // Pass all loaded files and the clicked index
                 });
             }
         });
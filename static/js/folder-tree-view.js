@@ -3,18 +3,25 @@
 class FolderTreeView {
     constructor(appInstance) {
         this.app = appInstance; // Reference to the main app instance
+        this.depth = 3; // Levels per /api/tree request; deeper levels are fetched per cut-off node
+        this.version = null; // Tree version of the last render
     }
 
     async loadFolderTree() {
         console.log('Loading folder tree...');
         try {
-            const data = await this.app.api.listFiles(''); // Use ApiService
-            
+            // Revalidated with the ETag, so an unchanged tree is a cheap 304
+            const data = await this.app.api.getTree('', this.depth); // Use ApiService
+            if (data.version === this.version) {
+                console.log('Folder tree unchanged, skipping render');
+                return;
+            }
+            this.version = data.version;
+
             const rootFolderElement = document.getElementById('rootFolder');
             rootFolderElement.innerHTML = ''; // Clear existing tree
 
-            // Filter for directories only and sort them
-            const topLevelFolders = data.filter(item => item.type === 'directory');
+            const topLevelFolders = data.tree.children || [];
             
             this.renderFolderTree(topLevelFolders, rootFolderElement, '');
 
@@ -35,10 +42,11 @@ class FolderTreeView {
             li.className = 'folder-item';
 
             const folderPath = currentPath ? `${currentPath}/${folder.name}` : folder.name;
+            const summary = `${folder.file_count} · ${this.app.ui.formatFileSize(folder.total_bytes)}`;
 
             li.innerHTML = `
                 <div class="folder-header">
-                    <span class="folder-name" data-path="${folderPath}"><i class="fas fa-folder"></i> ${folder.name}</span>
+                    <span class="folder-name" data-path="${folderPath}" title="${summary}"><i class="fas fa-folder"></i> ${folder.name}</span>
                     <div class="folder-actions">
                         <button class="btn-action rename-folder-btn" data-path="${folderPath}" title="${this.app.t('renameFolder')}">
                             <i class="fas fa-edit"></i>
@@ -81,17 +89,19 @@ class FolderTreeView {
                 this.app.fileManagement.deleteFolder(path);
             });
 
-            // Recursively load subfolders (lazy loading for deeper levels)
-            // For now, load all subfolders on initial tree load for simplicity
-            this.fetchAndRenderSubfolders(folderPath, li.querySelector('.folder-list'));
+            // Levels below the requested depth come with has_children but without children
+            if (folder.children) {
+                this.renderFolderTree(folder.children, li.querySelector('.folder-list'), folderPath);
+            } else if (folder.has_children) {
+                this.fetchAndRenderSubfolders(folderPath, li.querySelector('.folder-list'));
+            }
         });
     }
 
     async fetchAndRenderSubfolders(parentPath, parentElement) {
         try {
-            const data = await this.app.api.listFiles(parentPath); // Use ApiService
-            const subfolders = data.filter(item => item.type === 'directory');
-            this.renderFolderTree(subfolders, parentElement, parentPath);
+            const data = await this.app.api.getTree(parentPath, this.depth); // Use ApiService
+            this.renderFolderTree(data.tree.children || [], parentElement, parentPath);
         } catch (error) {
             console.error(`Error fetching subfolders for ${parentPath}:`, error);
         }
@@ -123,8 +133,8 @@ class FolderTreeView {
             parentOption.textContent = prefix + folder.name;
             folderParentSelect.appendChild(parentOption);
 
-            if (folder.subfolders && folder.subfolders.length > 0) {
-                this.updateFolderSelects(folder.subfolders, path, depth + 1);
+            if (folder.children && folder.children.length > 0) {
+                this.updateFolderSelects(folder.children, path, depth + 1);
             }
         });
 
@@ -58,7 +58,10 @@ class PreviewModal {
         const copyImageUrl = `${this.app.publicBaseUrl || (window.location.origin + (this.app.basePath === '/' ? '' : this.app.basePath) + '/') }images/${file.url}`;
 
         this.previewTitleElement.textContent = file.display_name;
-        this.previewImageElement.src = displayImageUrl;
+        // Load a rendition sized for the modal (modal-lg) instead of the full original;
+        // GIFs keep the original so animations still play
+        const renditionWidth = Math.round(Math.min(window.innerWidth, 800) * (window.devicePixelRatio || 1));
+        this.previewImageElement.src = /\.gif$/i.test(file.url) ? displayImageUrl : `${displayImageUrl}?w=${renditionWidth}&v=${file.version}`;
         this.imageUrlInput.value = copyImageUrl;
 
         // Update navigation button states
@@ -22,6 +22,9 @@ class UiUtils {
                 folderRenamed: 'Ordner erfolgreich umbenannt',
                 loading: 'Lädt...',
                 noImagesFound: 'Keine Bilder gefunden',
+                searchPlaceholder: 'Alle Bilder durchsuchen…',
+                downloadFolder: 'Ordner als ZIP herunterladen',
+                searchResults: 'Suchergebnisse',
                 uploadImages: 'Bilder hochladen',
                 dragDrop: 'Bilder hierher ziehen & ablegen',
                 orUseButton: 'oder verwenden Sie den "Dateien wählen" Button oben',
@@ -77,6 +80,9 @@ class UiUtils {
                 folderRenamed: 'Folder renamed successfully',
                 loading: 'Loading...',
                 noImagesFound: 'No images found',
+                searchPlaceholder: 'Search all images…',
+                downloadFolder: 'Download folder as ZIP',
+                searchResults: 'Search results',
                 uploadImages: 'Upload Images',
                 dragDrop: 'Drag & Drop your images here',
                 orUseButton: 'or use the "Choose Files" button above',
@@ -188,6 +194,14 @@ class UiUtils {
         const uploadBtn = document.getElementById('uploadImageBtn');
         if (uploadBtn) uploadBtn.innerHTML = `${this.t('uploadImages')} <i class="fas fa-sparkles"></i>`;
 
+        // Update search placeholder
+        const searchInput = document.getElementById('searchInput');
+        if (searchInput) searchInput.placeholder = this.t('searchPlaceholder');
+
+        // Update folder download button
+        const downloadBtn = document.getElementById('downloadFolderBtn');
+        if (downloadBtn) downloadBtn.title = this.t('downloadFolder');
+
         // Update modal title
         const modalTitle = document.getElementById('uploadModalTitle');
         if (modalTitle) modalTitle.textContent = this.t('uploadImages');
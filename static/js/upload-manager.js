@@ -1,5 +1,14 @@
 // static/js/upload-manager.js
 
+// Files above this size are sent as a chunked, resumable upload
+const CHUNKED_UPLOAD_THRESHOLD = 4 * 1024 * 1024;
+// Chunks in flight per file
+const CHUNK_PARALLELISM = 3;
+const CHUNK_RETRIES = 3;
+// Smaller files are grouped into /api/upload/batch requests of this many files / bytes
+const BATCH_MAX_FILES = 20;
+const BATCH_MAX_BYTES = 40 * 1024 * 1024;
+
 class UploadManager {
     constructor(appInstance) {
         this.app = appInstance; // Reference to the main app instance
@@ -229,30 +238,63 @@ class UploadManager {
         let completed = 0;
         const total = this.selectedFiles.length;
 
-        for (let i = 0; i < this.selectedFiles.length; i++) {
-            const file = this.selectedFiles[i];
-            const fileItem = document.querySelector(`[data-index="${i}"]`);
-            const statusDiv = fileItem.querySelector('.file-preview-status');
+        const statusDivFor = (i) => document.querySelector(`[data-index="${i}"]`).querySelector('.file-preview-status');
+        const markUploading = (i, label = 'Uploading...') => {
+            statusDivFor(i).innerHTML = `<span class="status-uploading"><i class="fas fa-spinner fa-spin"></i> ${label}</span>`;
+        };
+        const markDone = (i) => {
+            completed++;
+            progressFill.style.width = `${(completed / total) * 100}%`;
+            statusDivFor(i).innerHTML = '<span class="status-success"><i class="fas fa-check"></i> Uploaded</span>';
+        };
+        const markFailed = (i, message) => {
+            console.error('Upload error:', this.selectedFiles[i].name, message);
+            statusDivFor(i).innerHTML = '<span class="status-error"><i class="fas fa-times"></i> Failed</span>';
+            this.app.ui.showToast(`${this.app.t('uploadFilesFailed')} ${this.selectedFiles[i].name}: ${message}`, 'error');
+        };
+
+        // Small files go in batches (one request per group), large ones chunked
+        const batches = [];
+        const large = [];
+        let batch = [], batchBytes = 0;
+        this.selectedFiles.forEach((file, i) => {
+            if (file.size > CHUNKED_UPLOAD_THRESHOLD) {
+                large.push(i);
+                return;
+            }
+            if (batch.length >= BATCH_MAX_FILES || (batch.length && batchBytes + file.size > BATCH_MAX_BYTES)) {
+                batches.push(batch);
+                batch = [];
+                batchBytes = 0;
+            }
+            batch.push(i);
+            batchBytes += file.size;
+        });
+        if (batch.length) batches.push(batch);
 
+        for (const indices of batches) {
+            statusEl.textContent = `Uploading ${indices.length} file(s)...`;
+            indices.forEach(i => markUploading(i));
             try {
-                statusEl.textContent = `Uploading ${file.name}...`;
-                statusDiv.innerHTML = '<span class="status-uploading"><i class="fas fa-spinner fa-spin"></i> Uploading...</span>';
-
-                const formData = new FormData();
-                formData.append('file', file);
-                formData.append('folder', selectedFolder);
-                const result = await this.app.api.uploadFile(formData);
-
-                completed++;
-                const progress = (completed / total) * 100;
-                progressFill.style.width = `${progress}%`;
-
-                statusDiv.innerHTML = '<span class="status-success"><i class="fas fa-check"></i> Uploaded</span>';
+                const response = await this.app.api.uploadBatch(indices.map(i => this.selectedFiles[i]), selectedFolder);
+                response.results.forEach((result, k) => {
+                    if (result.error) markFailed(indices[k], result.error);
+                    else markDone(indices[k]);
+                });
+            } catch (error) {
+                indices.forEach(i => markFailed(i, error.message));
+            }
+        }
 
+        for (const i of large) {
+            const file = this.selectedFiles[i];
+            statusEl.textContent = `Uploading ${file.name}...`;
+            markUploading(i);
+            try {
+                await this.uploadChunked(file, selectedFolder, (fraction) => markUploading(i, `${Math.round(fraction * 100)}%`));
+                markDone(i);
             } catch (error) {
-                console.error('Upload error:', error);
-                statusDiv.innerHTML = '<span class="status-error"><i class="fas fa-times"></i> Failed</span>';
-                this.app.ui.showToast(`${this.app.t('uploadFilesFailed')} ${file.name}: ${error.message}`, 'error');
+                markFailed(i, error.message);
             }
         }
 
@@ -276,6 +318,72 @@ class UploadManager {
         uploadBtn.disabled = false;
     }
 
+    // Upload one file in chunks. The session id is kept in localStorage, so
+    // retrying the same file (even after a reload) only sends missing chunks.
+    async uploadChunked(file, folder, onProgress) {
+        const api = this.app.api;
+        const resumeKey = `upload:${folder}:${file.name}:${file.size}:${file.lastModified}`;
+        let session = null;
+
+        const savedId = localStorage.getItem(resumeKey);
+        if (savedId) {
+            try {
+                session = await api.getUploadSession(savedId);
+                if (session.status !== 'open') session = null;
+            } catch (error) {
+                session = null; // Expired or already committed
+            }
+        }
+        if (!session) {
+            session = await api.createUploadSession({
+                filename: file.name, folder, size: file.size, mimetype: file.type
+            });
+            localStorage.setItem(resumeKey, session.id);
+        }
+
+        const received = new Set(session.received);
+        const pending = [];
+        for (let n = 0; n < session.chunk_count; n++) {
+            if (!received.has(n)) pending.push(n);
+        }
+        let done = received.size;
+        onProgress(done / session.chunk_count);
+
+        const sendChunk = async (n) => {
+            const blob = file.slice(n * session.chunk_size, Math.min(file.size, (n + 1) * session.chunk_size));
+            const sha256 = await this.sha256Hex(blob);
+            for (let attempt = 1; ; attempt++) {
+                try {
+                    return await api.putUploadChunk(session.id, n, blob, sha256);
+                } catch (error) {
+                    if (attempt >= CHUNK_RETRIES) throw error;
+                    await new Promise(resolve => setTimeout(resolve, 500 * attempt));
+                }
+            }
+        };
+
+        const worker = async () => {
+            while (pending.length > 0) {
+                const n = pending.shift();
+                await sendChunk(n);
+                done++;
+                onProgress(done / session.chunk_count);
+            }
+        };
+        await Promise.all(Array.from({ length: Math.min(CHUNK_PARALLELISM, pending.length) }, worker));
+
+        const result = await api.commitUploadSession(session.id);
+        localStorage.removeItem(resumeKey);
+        return result;
+    }
+
+    // SubtleCrypto is only available in secure contexts; without it chunks are sent unverified
+    async sha256Hex(blob) {
+        if (!window.crypto || !window.crypto.subtle) return null;
+        const digest = await window.crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+        return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+    }
+
     resetUploadForm() {
         this.selectedFiles = [];
         document.getElementById('fileInput').value = '';
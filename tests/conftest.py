@@ -0,0 +1,61 @@
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# app.py builds an app from Config at import time; keep that one from starting
+# the watcher or thumbnail processes, and from writing logs/app.log into the tree
+os.environ.setdefault('FS_WATCHER', 'false')
+os.environ.setdefault('THUMBNAIL_WORKERS', '0')
+os.environ['LOG_FILE'] = ''
+
+from PIL import Image  # noqa: E402
+from config import Config  # noqa: E402
+
+
+def png_bytes(color=(200, 30, 30), size=(300, 200)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def upload_png(client, name='photo.png', folder='album', color=(200, 30, 30)):
+    """Upload a PNG through the API; returns the JSON response."""
+    response = client.post('/api/upload', data={'file': (io.BytesIO(png_bytes(color)), name, 'image/png'),
+                                                'folder': folder},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return response.get_json()
+
+
+def list_item(client, path):
+    """The /api/list entry of one file."""
+    folder, name = path.rsplit('/', 1)
+    return next(item for item in client.get(f'/api/list?path={folder}').get_json() if item['name'] == name)
+
+
+@pytest.fixture
+def make_app(tmp_path, monkeypatch):
+    """Build an app on a fresh UPLOAD_FOLDER; keyword arguments override Config."""
+    def make(**config):
+        settings = {'UPLOAD_FOLDER': str(tmp_path / 'images'), 'FS_WATCHER': False, 'THUMBNAIL_WORKERS': 0,
+                    'S3_REPLICATION': False, 'STORAGE_BACKEND': 'local', 'TESTING': True}
+        settings.update(config)
+        for name, value in settings.items():
+            monkeypatch.setattr(Config, name, value, raising=False)
+        from app import create_app
+        return create_app()
+    return make
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
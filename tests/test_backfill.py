@@ -0,0 +1,55 @@
+import os
+
+from conftest import list_item, upload_png
+from services.blobs import BlobStore
+
+
+def backfill(app, *args):
+    return app.test_cli_runner().invoke(args=['thumbs', 'backfill', '--workers', '1', *args])
+
+
+def test_backfill_renders_only_missing_or_outdated_thumbnails(app, client):
+    for name in ('a.png', 'b.png', 'c.png'):
+        upload_png(client, name)
+    root = app.config['UPLOAD_FOLDER']
+    result = backfill(app)
+    assert result.exit_code == 0 and 'Rendered 0 thumbnails' in result.output
+
+    os.remove(os.path.join(root, 'album', '.thumbs', 'a.jpg'))
+    os.utime(os.path.join(root, 'album', '.thumbs', 'b.jpg'), (0, 0))
+    result = backfill(app)
+    assert result.exit_code == 0 and 'Rendered 2 thumbnails' in result.output and '1 up to date' in result.output
+    assert list_item(client, 'album/a.png')['thumb_status'] == 'ready'
+
+
+def test_forced_backfill_resumes_after_failures(app, client):
+    upload_png(client)
+    root = app.config['UPLOAD_FOLDER']
+    with open(os.path.join(root, 'album', 'broken.png'), 'wb') as f:
+        f.write(b'not an image')
+    result = backfill(app, '--force')
+    assert result.exit_code == 1 and 'Rendered 1 thumbnails' in result.output
+    # Only the failed file is tried again
+    result = backfill(app, '--force')
+    assert result.exit_code == 1 and 'Rendered 0 thumbnails' in result.output and '1 up to date' in result.output
+    os.remove(os.path.join(root, 'album', 'broken.png'))
+    assert backfill(app, '--force').exit_code == 0
+    assert not os.path.exists(os.path.join(root, '.thumb-backfill.json'))
+
+
+def test_backfill_replaces_the_shared_thumbnail(make_app):
+    app = make_app(DEDUP_STORAGE=True)
+    client = app.test_client()
+    upload_png(client, folder='one')
+    upload_png(client, folder='two')
+    root = app.config['UPLOAD_FOLDER']
+    with app.app_context():
+        sha256 = BlobStore.hashes_for(['one/photo.png'])['one/photo.png']
+        shared = BlobStore.thumb_path(sha256)
+    stale = os.stat(shared).st_ino
+
+    assert backfill(app, '--force').exit_code == 0
+    assert os.stat(shared).st_ino != stale
+    # Later copies get the regenerated thumbnail
+    upload_png(client, folder='three')
+    assert os.path.samefile(os.path.join(root, 'three', '.thumbs', 'photo.jpg'), shared)
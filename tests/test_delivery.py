@@ -0,0 +1,102 @@
+import os
+
+import pytest
+
+from conftest import png_bytes, upload_png
+
+
+@pytest.fixture
+def accel_client(make_app):
+    return make_app(IMAGE_DELIVERY='x-accel', IMAGE_ACCEL_PREFIX='/_protected_images/').test_client()
+
+
+def test_accel_redirect_maps_onto_the_internal_location(accel_client):
+    path = upload_png(accel_client)['path']
+    response = accel_client.get(f'/images/{path}')
+    assert response.status_code == 200
+    assert response.headers['X-Accel-Redirect'] == f'/_protected_images/{path}'
+    assert response.data == b''
+    assert response.mimetype == 'image/png'
+    assert response.headers['ETag'] and response.headers['Last-Modified']
+
+
+def test_accel_redirect_quotes_the_path(accel_client):
+    upload_png(accel_client)
+    app = accel_client.application
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], 'album', 'summer photo.png'), 'wb') as f:
+        f.write(png_bytes())
+    response = accel_client.get('/images/album/summer%20photo.png')
+    assert response.headers['X-Accel-Redirect'] == '/_protected_images/album/summer%20photo.png'
+
+
+def test_accel_redirect_answers_revalidation_itself(accel_client):
+    path = upload_png(accel_client)['path']
+    etag = accel_client.get(f'/images/{path}').headers['ETag']
+    response = accel_client.get(f'/images/{path}', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert 'X-Accel-Redirect' not in response.headers
+    assert response.headers['ETag'] == etag
+
+
+def test_accel_redirect_honours_if_modified_since(accel_client):
+    path = upload_png(accel_client)['path']
+    last_modified = accel_client.get(f'/images/{path}').headers['Last-Modified']
+    response = accel_client.get(f'/images/{path}', headers={'If-Modified-Since': last_modified})
+    assert response.status_code == 304
+    assert 'X-Accel-Redirect' not in response.headers
+    stale = accel_client.get(f'/images/{path}', headers={'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+    assert stale.status_code == 200
+    assert stale.headers['X-Accel-Redirect'] == f'/_protected_images/{path}'
+
+
+def test_accel_redirect_of_renditions_inside_the_upload_folder(accel_client):
+    path = upload_png(accel_client)['path']
+    response = accel_client.get(f'/images/{path}?w=320&fmt=jpeg')
+    assert response.status_code == 200
+    assert response.headers['X-Accel-Redirect'].startswith('/_protected_images/.renditions/')
+    assert response.data == b''
+    assert response.mimetype == 'image/jpeg'
+
+
+def test_renditions_outside_the_mapped_root_are_sent_by_the_app(make_app, tmp_path):
+    client = make_app(IMAGE_DELIVERY='x-accel', RENDITION_CACHE_DIR=str(tmp_path / 'renditions'),
+                      IMAGE_ACCEL_RENDITION_PREFIX=None).test_client()
+    path = upload_png(client)['path']
+    response = client.get(f'/images/{path}?w=320&fmt=jpeg')
+    assert response.status_code == 200
+    assert 'X-Accel-Redirect' not in response.headers
+    assert response.data[:2] == b'\xff\xd8'
+    assert response.headers['ETag']
+
+
+def test_renditions_outside_the_upload_folder_use_their_own_location(make_app, tmp_path):
+    client = make_app(IMAGE_DELIVERY='x-accel', RENDITION_CACHE_DIR=str(tmp_path / 'renditions'),
+                      IMAGE_ACCEL_RENDITION_PREFIX='/_renditions/').test_client()
+    path = upload_png(client)['path']
+    response = client.get(f'/images/{path}?w=320&fmt=jpeg')
+    assert response.headers['X-Accel-Redirect'].startswith('/_renditions/')
+    assert response.data == b''
+
+
+def test_sendfile_hands_over_the_absolute_path(make_app):
+    app = make_app(IMAGE_DELIVERY='x-sendfile')
+    client = app.test_client()
+    path = upload_png(client)['path']
+    response = client.get(f'/images/{path}')
+    assert response.status_code == 200
+    assert response.headers['X-Sendfile'] == os.path.join(os.path.abspath(app.config['UPLOAD_FOLDER']), path)
+    assert response.data == b''
+    etag = response.headers['ETag']
+    revalidated = client.get(f'/images/{path}', headers={'If-None-Match': etag})
+    assert revalidated.status_code == 304
+    assert 'X-Sendfile' not in revalidated.headers
+    since = client.get(f'/images/{path}', headers={'If-Modified-Since': response.headers['Last-Modified']})
+    assert since.status_code == 304
+    assert 'X-Sendfile' not in since.headers
+
+
+def test_direct_delivery_streams_the_file(client):
+    path = upload_png(client)['path']
+    response = client.get(f'/images/{path}')
+    assert 'X-Accel-Redirect' not in response.headers and 'X-Sendfile' not in response.headers
+    assert response.data[:8] == b'\x89PNG\r\n\x1a\n'
@@ -0,0 +1,75 @@
+import io
+import zipfile
+
+import pytest
+
+from conftest import upload_png
+
+
+def _archive(response):
+    assert response.status_code == 200, response.get_data(as_text=True)
+    archive = zipfile.ZipFile(io.BytesIO(response.data))
+    assert archive.testzip() is None
+    return archive
+
+
+@pytest.mark.parametrize('metadata_index', [True, False])
+def test_export_round_trips(make_app, metadata_index):
+    client = make_app(METADATA_INDEX=metadata_index).test_client()
+    red = upload_png(client, 'red.png', color=(200, 30, 30))['path']
+    blue = upload_png(client, 'blue.png', folder='album/sub', color=(30, 30, 200))['path']
+    response = client.get('/api/export?path=album')
+    assert response.mimetype == 'application/zip'
+    assert 'album.zip' in response.headers['Content-Disposition']
+    assert int(response.headers['Content-Length']) == len(response.data)
+    archive = _archive(response)
+    assert sorted(archive.namelist()) == ['album/red.png', 'album/sub/blue.png']
+    assert archive.read('album/red.png') == client.get(f'/images/{red}').data
+    assert archive.read('album/sub/blue.png') == client.get(f'/images/{blue}').data
+
+    flat = _archive(client.get('/api/export?path=album&recursive=false'))
+    assert flat.namelist() == ['album/red.png']
+
+
+def test_range_requests_resume_the_same_bytes(client):
+    for color in ((200, 30, 30), (30, 200, 30)):
+        upload_png(client, f'{color[1]}.png', color=color)
+    full = client.get('/api/export?path=album')
+    body, etag = full.data, full.headers['ETag']
+
+    partial = client.get('/api/export?path=album', headers={'Range': 'bytes=100-499', 'If-Range': etag})
+    assert partial.status_code == 206
+    assert partial.data == body[100:500]
+    assert partial.headers['Content-Range'] == f'bytes 100-499/{len(body)}'
+    tail = client.get('/api/export?path=album', headers={'Range': f'bytes={len(body) - 50}-'})
+    assert tail.status_code == 206 and tail.data == body[-50:]
+
+    stale = client.get('/api/export?path=album', headers={'Range': 'bytes=100-499', 'If-Range': '"other"'})
+    assert stale.status_code == 200 and stale.data == body
+    unsatisfiable = client.get('/api/export?path=album', headers={'Range': f'bytes={len(body)}-'})
+    assert unsatisfiable.status_code == 416
+
+
+def test_duplicate_display_names_are_numbered(client):
+    first = upload_png(client, 'photo.png', color=(200, 30, 30))['path']
+    second = upload_png(client, 'photo.png', color=(30, 30, 200))['path']
+    assert first != second
+    archive = _archive(client.post('/api/export', json={'paths': [first, second]}))
+    assert archive.namelist() == ['photo.png', 'photo (2).png']
+    assert archive.read('photo (2).png') == client.get(f'/images/{second}').data
+
+
+def test_exports_over_the_file_limit_are_rejected(make_app):
+    client = make_app(EXPORT_MAX_FILES=1).test_client()
+    upload_png(client, 'one.png')
+    assert client.get('/api/export?path=album').status_code == 200
+    upload_png(client, 'two.png')
+    response = client.get('/api/export?path=album')
+    assert response.status_code == 400
+    assert 'limit 1' in response.get_json()['error']
+
+
+def test_unknown_paths_are_not_found(client):
+    upload_png(client)
+    assert client.get('/api/export?path=missing').status_code == 404
+    assert client.get('/api/export').status_code == 400
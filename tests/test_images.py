@@ -0,0 +1,85 @@
+import os
+import json
+
+from conftest import list_item, upload_png
+
+
+def test_serves_uploaded_image(client):
+    result = upload_png(client)
+    response = client.get(f"/images/{result['path']}")
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+
+
+def test_internal_state_is_not_served(app, client):
+    upload_png(client)
+    assert os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], '.index.sqlite3'))
+    assert client.get('/images/.index.sqlite3').status_code == 404
+    assert client.get('/images/album/.index.sqlite3').status_code == 404
+    assert client.get('/images/.index.sqlite3?w=320').status_code == 404
+
+
+def test_thumbnails_and_sprite_sheets_are_served(make_app):
+    client = make_app(THUMBNAIL_SPRITES=True).test_client()
+    upload_png(client, 'red.png', color=(200, 30, 30))
+    upload_png(client, 'green.png', color=(30, 200, 30))
+    item = list_item(client, 'album/red.png')
+    assert client.get(f"/images/{item['thumb']}").status_code == 200
+    page = client.get('/api/list?path=album&limit=10').get_json()
+    assert page['sprite']['url'].startswith('album/.thumbs/.sprite-')
+    assert client.get(f"/images/{page['sprite']['url']}").status_code == 200
+
+
+def _immutable(response):
+    return bool(response.cache_control.immutable)
+
+
+def test_thumbnail_urls_are_pinned_by_their_own_version(client):
+    item = list_item(client, upload_png(client)['path'])
+    assert item['thumb_version'] and item['thumb_version'] != item['version']
+    assert _immutable(client.get(f"/images/{item['thumb']}?v={item['thumb_version']}"))
+    assert not _immutable(client.get(f"/images/{item['thumb']}?v={item['version']}"))
+    assert not _immutable(client.get(f"/images/{item['thumb']}?v=bogus"))
+
+
+def test_regenerated_thumbnail_gets_a_new_version(app, client):
+    item = list_item(client, upload_png(client)['path'])
+    os.utime(os.path.join(app.config['UPLOAD_FOLDER'], item['thumb']), (0, 0))
+    result = app.test_cli_runner().invoke(args=['thumbs', 'backfill', '--force', '--workers', '1', 'album'])
+    assert result.exit_code == 0, result.output
+    fresh = list_item(client, item['path'])
+    assert fresh['thumb_version'] != item['thumb_version']
+    assert not _immutable(client.get(f"/images/{item['thumb']}?v={item['thumb_version']}"))
+    assert _immutable(client.get(f"/images/{fresh['thumb']}?v={fresh['thumb_version']}"))
+
+
+def test_index_rebuild_keeps_thumbnail_versions(app, client):
+    item = list_item(client, upload_png(client)['path'])
+    assert app.test_cli_runner().invoke(args=['index', 'rebuild']).exit_code == 0
+    assert list_item(client, item['path'])['thumb_version'] == item['thumb_version']
+
+
+def test_disk_listing_has_thumbnail_versions(make_app):
+    client = make_app(METADATA_INDEX=False).test_client()
+    item = list_item(client, upload_png(client)['path'])
+    assert item['thumb_version']
+    assert _immutable(client.get(f"/images/{item['thumb']}?v={item['thumb_version']}"))
+
+
+def test_thumbnail_version_is_stored_in_the_sidecar(app, client):
+    item = list_item(client, upload_png(client)['path'])
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], 'album', 'photo.json')) as f:
+        assert json.load(f)['thumb_version'] == item['thumb_version']
+
+
+def test_disk_listing_stats_thumbnails_without_a_stored_version(make_app):
+    app = make_app(METADATA_INDEX=False)
+    client = app.test_client()
+    item = list_item(client, upload_png(client)['path'])
+    sidecar = os.path.join(app.config['UPLOAD_FOLDER'], 'album', 'photo.json')
+    with open(sidecar) as f:
+        metadata = json.load(f)
+    del metadata['thumb_version']
+    with open(sidecar, 'w') as f:
+        json.dump(metadata, f)
+    assert list_item(client, item['path'])['thumb_version'] == item['thumb_version']
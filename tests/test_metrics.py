@@ -0,0 +1,25 @@
+import os
+
+from conftest import upload_png
+from services.metrics import Metrics
+
+
+def test_metrics_require_the_token(make_app):
+    app = make_app(METRICS_TOKEN='secret')
+    client = app.test_client()
+    assert client.get('/metrics').status_code == 401
+    response = client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200
+    assert 'image_storage_http_request_duration_seconds' in response.get_data(as_text=True)
+
+
+def test_metrics_snapshots_are_not_served(make_app):
+    app = make_app(METRICS_TOKEN='secret')
+    client = app.test_client()
+    upload_png(client)
+    Metrics.maybe_flush(app.config, force=True)
+    directory = Metrics.directory(app.config)
+    snapshot = f"{os.getpid()}.json"
+    assert os.path.exists(os.path.join(directory, snapshot))
+    relative = os.path.relpath(directory, app.config['UPLOAD_FOLDER'])
+    assert client.get(f'/images/{relative}/{snapshot}').status_code == 404
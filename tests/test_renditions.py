@@ -0,0 +1,47 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from conftest import upload_png
+from services.renditions import RenditionService
+
+
+def test_renditions_are_resized(client):
+    path = upload_png(client)['path']
+    response = client.get(f'/images/{path}?w=320&fmt=jpeg')
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    assert client.get(f'/images/{path}?w=abc').status_code == 400
+
+
+def test_variants_share_the_fixed_lock_table(client, monkeypatch):
+    locks = []
+    key_lock = RenditionService._key_lock
+
+    def recording(key):
+        locks.append(key_lock(key))
+        return locks[-1]
+    monkeypatch.setattr(RenditionService, '_key_lock', staticmethod(recording))
+
+    paths = [upload_png(client, f'photo{i}.png')['path'] for i in range(3)]
+    for path in paths:
+        for width in (320, 640, 800):
+            for fmt in ('webp', 'jpeg'):
+                assert client.get(f'/images/{path}?w={width}&fmt={fmt}').status_code == 200
+    assert len(locks) == 18
+    assert all(any(lock is slot for slot in RenditionService._locks) for lock in locks)
+
+
+def test_concurrent_requests_render_once(app, client, monkeypatch):
+    path = upload_png(client)['path']
+    renders = []
+    render = RenditionService.render
+
+    def counting(*args):
+        renders.append(args)
+        return render(*args)
+    monkeypatch.setattr(RenditionService, 'render', staticmethod(counting))
+
+    def fetch(_):
+        return app.test_client().get(f'/images/{path}?w=320&fmt=webp').status_code
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        assert set(pool.map(fetch, range(8))) == {200}
+    assert len(renders) == 1
@@ -0,0 +1,178 @@
+import os
+import time
+
+import pytest
+
+from conftest import png_bytes, upload_png
+
+boto3 = pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+
+from services.external_storage import ExternalStorageService  # noqa: E402
+from services.index import IndexService  # noqa: E402
+from services.replication import ReplicationQueue, ReplicationWorker  # noqa: E402
+
+BUCKET = 'backup'
+RETRY_DELAY = 100
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name, value in (('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1')):
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        # The process-wide client must not outlive the mock
+        monkeypatch.setattr(ExternalStorageService, '_client', None)
+        yield client
+
+
+@pytest.fixture
+def app(make_app, s3):
+    return make_app(S3_REPLICATION=True, AWS_BUCKET_NAME=BUCKET, AWS_REGION='us-east-1', S3_PREFIX='bk/',
+                    S3_REPLICATION_IN_APP=False, S3_RETRY_DELAY=RETRY_DELAY, S3_MAX_ATTEMPTS=3)
+
+
+def keys(s3):
+    return sorted(obj['Key'] for obj in s3.list_objects_v2(Bucket=BUCKET).get('Contents', []))
+
+
+def drain(app):
+    ReplicationWorker.run(app, once=True)
+
+
+def jobs(app):
+    with app.app_context():
+        return [dict(row) for row in IndexService.connect().execute('SELECT * FROM replication_jobs')]
+
+
+@pytest.fixture
+def uploads(app, monkeypatch):
+    """Paths passed to ExternalStorageService._upload (the transfers that are not server-side copies)."""
+    calls = []
+    upload = ExternalStorageService._upload
+
+    def record(local_path, s3_key):
+        calls.append(s3_key)
+        upload(local_path, s3_key)
+    monkeypatch.setattr(ExternalStorageService, '_upload', staticmethod(record))
+    return calls
+
+
+def test_uploads_are_replicated(app, client, s3):
+    upload_png(client)
+    drain(app)
+    assert keys(s3) == ['bk/album/photo.json', 'bk/album/photo.png']
+    body = s3.get_object(Bucket=BUCKET, Key='bk/album/photo.png')['Body'].read()
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], 'album', 'photo.png'), 'rb') as f:
+        assert body == f.read()
+    assert jobs(app) == []
+
+
+def test_replicate_file_actions(app, client, s3):
+    upload_png(client)
+    drain(app)
+    with app.app_context():
+        assert ExternalStorageService.replicate_file('album/photo.png') == 'uploaded'
+        assert ExternalStorageService.replicate_file('album/missing.png') == 'deleted'
+        os.link(os.path.join(app.config['UPLOAD_FOLDER'], 'album', 'photo.png'),
+                os.path.join(app.config['UPLOAD_FOLDER'], 'album', 'copy.png'))
+        assert ExternalStorageService.replicate_file('album/copy.png', source='album/photo.png') == 'copied'
+        with open(os.path.join(app.config['UPLOAD_FOLDER'], 'album', 'other.png'), 'wb') as f:
+            f.write(png_bytes((1, 2, 3)))
+        # Different content: the source object cannot be reused
+        assert ExternalStorageService.replicate_file('album/other.png', source='album/photo.png') == 'uploaded'
+    assert 'bk/album/copy.png' in keys(s3)
+
+
+def test_unchanged_objects_are_skipped_by_etag(app, client, s3):
+    upload_png(client)
+    upload_png(client, 'second.png', color=(1, 2, 3))
+    drain(app)
+    with app.app_context():
+        transfers, orphans, unchanged = ExternalStorageService.plan_sync('')
+        assert (transfers, orphans, unchanged) == ([], [], 4)
+        # Same size, different content: only the ETag tells them apart
+        full_path = os.path.join(app.config['UPLOAD_FOLDER'], 'album', 'photo.png')
+        with open(full_path, 'r+b') as f:
+            f.seek(-4, os.SEEK_END)
+            f.write(b'zzzz')
+        transfers, orphans, unchanged = ExternalStorageService.plan_sync('')
+        assert [path for path, _ in transfers] == ['album/photo.png'] and unchanged == 3
+
+
+def test_deletes_are_replicated(app, client, s3):
+    upload_png(client)
+    upload_png(client, 'keep.png')
+    drain(app)
+    assert client.delete('/api/file', json={'path': 'album/photo.png'}).status_code == 200
+    drain(app)
+    assert keys(s3) == ['bk/album/keep.json', 'bk/album/keep.png']
+    assert client.delete('/api/folder', json={'path': 'album'}).status_code == 200
+    drain(app)
+    assert keys(s3) == []
+
+
+def test_renames_are_copied_inside_the_bucket(app, client, s3, uploads):
+    upload_png(client)
+    drain(app)
+    uploads.clear()
+    assert client.post('/api/file/rename', json={'path': 'album/photo.png', 'newName': 'renamed.png'}).status_code == 200
+    drain(app)
+    assert keys(s3) == ['bk/album/renamed.json', 'bk/album/renamed.png']
+    assert 'bk/album/renamed.png' not in uploads
+
+    assert client.post('/api/folder/rename', json={'oldPath': 'album', 'newPath': 'moved'}).status_code == 200
+    drain(app)
+    assert keys(s3) == ['bk/moved/renamed.json', 'bk/moved/renamed.png']
+    assert 'bk/moved/renamed.png' not in uploads
+    assert jobs(app) == []
+
+
+def test_failed_uploads_back_off_and_retry(app, client, s3, monkeypatch):
+    with app.app_context():
+        s3_client = ExternalStorageService.client()
+    put_object = s3_client.put_object
+
+    def unavailable(**kwargs):
+        raise ConnectionError('S3 unavailable')
+    monkeypatch.setattr(s3_client, 'put_object', unavailable)
+
+    upload_png(client)
+    started = time.time()
+    drain(app)
+    failed = {job['path']: job for job in jobs(app)}
+    assert keys(s3) == []
+    for job in failed.values():
+        assert job['status'] == 'queued' and job['attempts'] == 1 and 'S3 unavailable' in job['error']
+        assert started + RETRY_DELAY <= job['available_at'] <= time.time() + RETRY_DELAY
+
+    # Not due yet: nothing is attempted
+    drain(app)
+    assert all(job['attempts'] == 1 for job in jobs(app))
+
+    def make_due():
+        with app.app_context():
+            conn = IndexService.connect()
+            with IndexService._transaction(conn):
+                conn.execute('UPDATE replication_jobs SET available_at = 0')
+
+    make_due()
+    started = time.time()
+    drain(app)
+    for job in jobs(app):
+        # Exponential backoff
+        assert job['attempts'] == 2 and job['available_at'] >= started + 2 * RETRY_DELAY
+
+    make_due()
+    drain(app)
+    assert {job['status'] for job in jobs(app)} == {'failed'}
+
+    monkeypatch.setattr(s3_client, 'put_object', put_object)
+    with app.app_context():
+        assert ReplicationQueue.retry_failed() == len(failed)
+    drain(app)
+    assert keys(s3) == ['bk/album/photo.json', 'bk/album/photo.png']
+    assert jobs(app) == []
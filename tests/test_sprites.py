@@ -0,0 +1,54 @@
+import io
+
+from PIL import Image
+
+from conftest import upload_png
+
+RED, GREEN, BLUE = (200, 30, 30), (30, 200, 30), (30, 30, 200)
+
+
+def sprite_colors(client, folder='album'):
+    """``{name: RGB}`` sampled from each file's cell on the folder's sprite sheet."""
+    page = client.get(f'/api/list?path={folder}&limit=100').get_json()
+    sheet = Image.open(io.BytesIO(client.get(f"/images/{page['sprite']['url']}").data)).convert('RGB')
+    colors = {}
+    for item in page['items']:
+        if item.get('sprite'):
+            x, y, width, height = item['sprite']
+            colors[item['name']] = sheet.getpixel((x + width // 2, y + height // 2))
+    return colors
+
+
+def close(color, expected):
+    return all(abs(a - b) < 40 for a, b in zip(color, expected))
+
+
+def test_sprite_sheet_follows_renames_deletes_and_new_files(make_app):
+    client = make_app(THUMBNAIL_SPRITES=True).test_client()
+    upload_png(client, 'a.png', color=RED)
+    upload_png(client, 'b.png', color=GREEN)
+    colors = sprite_colors(client)
+    assert close(colors['a.png'], RED) and close(colors['b.png'], GREEN)
+
+    client.post('/api/file/rename', json={'path': 'album/a.png', 'newName': 'c.png'})
+    client.delete('/api/file', json={'path': 'album/b.png'})
+    upload_png(client, 'd.png', color=BLUE)
+    colors = sprite_colors(client)
+    assert set(colors) == {'c.png', 'd.png'}
+    assert close(colors['c.png'], RED) and close(colors['d.png'], BLUE)
+
+
+def test_regenerated_thumbnails_are_drawn_again(make_app):
+    app = make_app(THUMBNAIL_SPRITES=True)
+    client = app.test_client()
+    upload_png(client, 'a.png', color=RED)
+    upload_png(client, 'b.png', color=GREEN)
+    sprite_colors(client)
+
+    # Replaced behind the index's back: only the regenerated thumbnail tells the sheet
+    original = f"{app.config['UPLOAD_FOLDER']}/album/a.png"
+    Image.new('RGB', (300, 200), BLUE).save(original, 'PNG')
+    result = app.test_cli_runner().invoke(args=['thumbs', 'backfill', '--workers', '1'])
+    assert result.exit_code == 0, result.output
+    colors = sprite_colors(client)
+    assert close(colors['a.png'], BLUE) and close(colors['b.png'], GREEN)